@@ -0,0 +1,966 @@
+from __future__ import division
+
+__copyright__ = "Copyright (C) 2018 Andreas Kloeckner"
+
+__license__ = """
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import numpy as np
+import pyopencl as cl
+import pyopencl.array  # noqa
+from pyopencl.elementwise import ElementwiseTemplate
+from mako.template import Template
+from pytools import memoize, log_process
+
+from boxtree.tools import AXIS_NAMES
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+__doc__ = """
+Laplace FMM on OpenCL devices
+-----------------------------
+
+.. autoclass:: CLLaplaceExpansionWrangler
+"""
+
+
+# {{{ multi-indices
+
+def _get_multi_indices(dimensions, max_degree):
+    """Return all multi-indices of length *dimensions* with total degree at
+    most *max_degree*, ordered by degree and, within a degree, by decreasing
+    entries from the left. The position of a multi-index in this order is
+    computed by ``coeff_index`` in the kernels.
+    """
+    result = []
+    for degree in range(max_degree + 1):
+        if dimensions == 2:
+            for k0 in range(degree, -1, -1):
+                result.append((k0, degree - k0))
+        elif dimensions == 3:
+            for k0 in range(degree, -1, -1):
+                rest = degree - k0
+                for k2 in range(rest + 1):
+                    result.append((k0, rest - k2, k2))
+        else:
+            raise ValueError("unsupported dimensionality")
+
+    return result
+
+# }}}
+
+
+# {{{ kernel preamble
+
+LAPLACE_PREAMBLE_TEMPLATE = Template(r"""//CL//
+#define DIMENSIONS ${dimensions}
+#define NCOEFFS ${ncoeffs}
+#define NDERIVS ${len(multi_indices)}
+
+// All multi-indices up to twice the expansion order, see
+// _get_multi_indices. The first NCOEFFS are those of the expansions.
+__constant int multi_indices[NDERIVS][DIMENSIONS] = {
+    %for mi in multi_indices:
+    { ${", ".join(str(k) for k in mi)} },
+    %endfor
+    };
+
+__constant coord_t binomials[${len(binomials)}][${len(binomials)}] = {
+    %for row in binomials:
+    { ${", ".join(repr(float(b)) for b in row)} },
+    %endfor
+    };
+
+inline int coeff_index(const int *k)
+{
+    int degree = 0;
+    for (int ax = 0; ax < DIMENSIONS; ++ax)
+        degree += k[ax];
+
+    %if dimensions == 2:
+    return degree*(degree+1)/2 + k[1];
+    %elif dimensions == 3:
+    int rest = degree - k[0];
+    return degree*(degree+1)*(degree+2)/6 + rest*(rest+1)/2 + k[2];
+    %endif
+}
+
+inline void get_multi_index(int *k, int i)
+{
+    for (int ax = 0; ax < DIMENSIONS; ++ax)
+        k[ax] = multi_indices[i][ax];
+}
+
+inline int get_degree(const int *k)
+{
+    int degree = 0;
+    for (int ax = 0; ax < DIMENSIONS; ++ax)
+        degree += k[ax];
+    return degree;
+}
+
+// m choose n, for multi-indices
+inline coord_t multi_binomial(const int *m, const int *n)
+{
+    coord_t result = 1;
+    for (int ax = 0; ax < DIMENSIONS; ++ax)
+        result *= binomials[m[ax]][n[ax]];
+    return result;
+}
+
+// Store h^k for the first count multi-indices k in mono.
+inline void get_monomials(coord_t *mono, const coord_t *h, int count)
+{
+    mono[0] = 1;
+
+    for (int i = 1; i < count; ++i)
+    {
+        int k[DIMENSIONS];
+        get_multi_index(k, i);
+
+        int ax = 0;
+        while (k[ax] == 0)
+            ++ax;
+
+        k[ax] -= 1;
+        mono[i] = mono[coeff_index(k)] * h[ax];
+    }
+}
+
+// local_exp[n] += sum_k (-1)^|k| (k+n choose n) mpole[k] deriv[k+n] for
+// all n, with the coefficients and indices computed ahead of time
+inline void add_m2l(coord_t *local_exp, const coord_t *mpole,
+        const coord_t *deriv)
+{
+    %for i_n, terms in enumerate(m2l_terms):
+    local_exp[${i_n}] += (
+        %for coeff, i_k, i_kn in terms:
+        ${"-" if coeff < 0 else "+"} ${repr(float(abs(coeff)))}
+            * mpole[${i_k}] * deriv[${i_kn}]
+        %endfor
+        );
+    %endfor
+}
+
+// The Green's function, in terms of the squared distance r2
+inline coord_t green(coord_t r2)
+{
+    %if dimensions == 2:
+    return 0.5*log(r2);
+    %elif dimensions == 3:
+    return rsqrt(r2);
+    %endif
+}
+
+// Store the Taylor coefficients D^k G(x) / k! of the Green's function G for
+// the first count multi-indices k in deriv, where count is the number of
+// multi-indices up to some degree. They are computed by the recurrence
+//
+//   |k| r^2 a_k + (2|k| + s - 2) sum_i x_i a_{k-e_i}
+//       + (|k| + s - 2) sum_i a_{k-2e_i} = 0
+//
+// for G = r^(-s), with s = 1 in 3D. In 2D, G = log(r) corresponds to s = 0,
+// except that the terms of degree one and two do not involve log(r). The
+// coefficients and indices of the recurrence are computed ahead of time.
+inline void get_derivatives(coord_t *deriv, const coord_t *x, int count)
+{
+    coord_t r2 = 0;
+    for (int ax = 0; ax < DIMENSIONS; ++ax)
+        r2 += x[ax]*x[ax];
+
+    coord_t inv_r2 = 1/r2;
+
+    deriv[0] = green(r2);
+
+    %for i, degree_start, expr in deriv_exprs:
+    %if degree_start:
+    if (count <= ${i})
+        return;
+    %endif
+    deriv[${i}] = inv_r2 * (${expr});
+    %endfor
+}
+""", strict_undefined=True)
+
+
+@memoize
+def _get_preamble(dimensions, order):
+    ncoeffs = len(_get_multi_indices(dimensions, order))
+    max_degree = 2*order
+
+    binomials = np.zeros((max_degree + 1, max_degree + 1), np.int64)
+    for m in range(max_degree + 1):
+        binomials[m, 0] = 1
+        binomials[m, 1:m+1] = binomials[m-1, 0:m] + binomials[m-1, 1:m+1]
+
+    multi_indices = _get_multi_indices(dimensions, max_degree)
+    index_of = dict((mi, i) for i, mi in enumerate(multi_indices))
+
+    # See get_derivatives for the recurrence.
+    s_exponent = 1 if dimensions == 3 else 0
+
+    deriv_exprs = []
+    for i, k in enumerate(multi_indices[1:], 1):
+        degree = sum(k)
+
+        sum1 = []
+        sum2 = []
+        for ax in range(dimensions):
+            if k[ax] >= 1:
+                sum1.append("x[%d]*deriv[%d]" % (
+                    ax, index_of[k[:ax] + (k[ax] - 1,) + k[ax+1:]]))
+            if k[ax] >= 2:
+                sum2.append("deriv[%d]" % (
+                    index_of[k[:ax] + (k[ax] - 2,) + k[ax+1:]]))
+
+        sum1 = " + ".join(sum1)
+        sum2 = " + ".join(sum2) or "0"
+
+        if dimensions == 2 and degree == 1:
+            expr = "x[%d]" % k.index(1)
+        elif dimensions == 2 and degree == 2:
+            # one for each entry 2 of k, in place of log(r)
+            expr = "%r - (%s)" % (k.count(2) / 2, sum1)
+        else:
+            expr = "%r*(%s) + %r*(%s)" % (
+                    -(2*degree + s_exponent - 2) / degree, sum1,
+                    -(degree + s_exponent - 2) / degree, sum2)
+
+        degree_start = sum(multi_indices[i-1]) != degree
+        deriv_exprs.append((i, degree_start, expr))
+
+    m2l_terms = []
+    for n in multi_indices[:ncoeffs]:
+        terms = []
+        for i_k, k in enumerate(multi_indices[:ncoeffs]):
+            k_plus_n = tuple(k_ax + n_ax for k_ax, n_ax in zip(k, n))
+            coeff = (-1)**sum(k) * np.prod([
+                binomials[kn_ax, n_ax]
+                for kn_ax, n_ax in zip(k_plus_n, n)])
+            terms.append((coeff, i_k, index_of[k_plus_n]))
+
+        m2l_terms.append(terms)
+
+    return LAPLACE_PREAMBLE_TEMPLATE.render(
+            dimensions=dimensions,
+            ncoeffs=ncoeffs,
+            multi_indices=multi_indices,
+            binomials=binomials,
+            deriv_exprs=deriv_exprs,
+            m2l_terms=m2l_terms)
+
+# }}}
+
+
+# {{{ kernel templates
+
+LAPLACE_MAKO_DEFS = r"""//CL:mako//
+<%def name="load_center(name, ibox)">
+    coord_t ${name}[DIMENSIONS];
+    for (int ax = 0; ax < DIMENSIONS; ++ax)
+        ${name}[ax] = box_centers[ax*aligned_nboxes + ${ibox}];
+</%def>
+
+<%def name="load_particle(name, kind, iparticle)">
+    coord_t ${name}[DIMENSIONS];
+    %for iax, ax in enumerate(AXIS_NAMES[:dimensions]):
+        ${name}[${iax}] = ${kind}s_${ax}[${iparticle}];
+    %endfor
+</%def>
+
+<%def name="difference(name, a, b)">
+    coord_t ${name}[DIMENSIONS];
+    for (int ax = 0; ax < DIMENSIONS; ++ax)
+        ${name}[ax] = ${a}[ax] - ${b}[ax];
+</%def>
+"""
+
+
+def _particle_args(kind):
+    return """
+        particle_id_t *box_{kind}_starts,
+        particle_id_t *box_{kind}_counts_nonchild,
+        %for ax in AXIS_NAMES[:dimensions]:
+            coord_t *{kind}s_${{ax}},
+        %endfor
+        """.format(kind=kind)
+
+
+P2M_TEMPLATE = ElementwiseTemplate(
+    arguments="//CL:mako//" + r"""
+        box_id_t *source_boxes,
+        """ + _particle_args("source") + r"""
+        coord_t *weights,
+        coord_t *box_centers,
+        box_id_t aligned_nboxes,
+        coord_t *mpoles
+        """,
+    operation=LAPLACE_MAKO_DEFS + r"""
+        box_id_t ibox = source_boxes[i];
+        ${load_center("center", "ibox")}
+
+        coord_t mpole[NCOEFFS];
+        for (int ik = 0; ik < NCOEFFS; ++ik)
+            mpole[ik] = 0;
+
+        coord_t mono[NCOEFFS];
+
+        particle_id_t start = box_source_starts[ibox];
+        particle_id_t stop = start + box_source_counts_nonchild[ibox];
+
+        for (particle_id_t isrc = start; isrc < stop; ++isrc)
+        {
+            ${load_particle("source", "source", "isrc")}
+            ${difference("h", "source", "center")}
+            get_monomials(mono, h, NCOEFFS);
+
+            for (int ik = 0; ik < NCOEFFS; ++ik)
+                mpole[ik] += weights[isrc] * mono[ik];
+        }
+
+        for (int ik = 0; ik < NCOEFFS; ++ik)
+            mpoles[ibox*NCOEFFS + ik] = mpole[ik];
+        """,
+    name="laplace_p2m")
+
+
+M2M_TEMPLATE = ElementwiseTemplate(
+    arguments=r"""
+        box_id_t *source_parent_boxes,
+        box_id_t *box_child_ids,
+        coord_t *box_centers,
+        box_id_t aligned_nboxes,
+        coord_t *mpoles
+        """,
+    operation=LAPLACE_MAKO_DEFS + r"""
+        box_id_t ibox = source_parent_boxes[i];
+        ${load_center("center", "ibox")}
+
+        coord_t mpole[NCOEFFS];
+        for (int ik = 0; ik < NCOEFFS; ++ik)
+            mpole[ik] = mpoles[ibox*NCOEFFS + ik];
+
+        coord_t mono[NCOEFFS];
+
+        for (int ichild = 0; ichild < ${2**dimensions}; ++ichild)
+        {
+            box_id_t child = box_child_ids[ichild*aligned_nboxes + ibox];
+            if (!child)
+                continue;
+
+            ${load_center("child_center", "child")}
+            ${difference("h", "child_center", "center")}
+            get_monomials(mono, h, NCOEFFS);
+
+            for (int ik = 0; ik < NCOEFFS; ++ik)
+            {
+                int k[DIMENSIONS];
+                get_multi_index(k, ik);
+
+                // j <= k implies ij <= ik.
+                for (int ij = 0; ij <= ik; ++ij)
+                {
+                    int j[DIMENSIONS];
+                    int k_minus_j[DIMENSIONS];
+                    get_multi_index(j, ij);
+
+                    int j_le_k = 1;
+                    for (int ax = 0; ax < DIMENSIONS; ++ax)
+                    {
+                        k_minus_j[ax] = k[ax] - j[ax];
+                        j_le_k = j_le_k && k_minus_j[ax] >= 0;
+                    }
+
+                    if (j_le_k)
+                        mpole[ik] += (
+                            multi_binomial(k, j)
+                            * mono[coeff_index(k_minus_j)]
+                            * mpoles[child*NCOEFFS + ij]);
+                }
+            }
+        }
+
+        for (int ik = 0; ik < NCOEFFS; ++ik)
+            mpoles[ibox*NCOEFFS + ik] = mpole[ik];
+        """,
+    name="laplace_m2m")
+
+
+M2L_TEMPLATE = ElementwiseTemplate(
+    arguments=r"""
+        box_id_t *target_or_target_parent_boxes,
+        box_id_t *starts,
+        box_id_t *lists,
+        coord_t *box_centers,
+        box_id_t aligned_nboxes,
+        coord_t *mpoles,
+        coord_t *local_exps
+        """,
+    operation=LAPLACE_MAKO_DEFS + r"""
+        box_id_t tgt_ibox = target_or_target_parent_boxes[i];
+        ${load_center("center", "tgt_ibox")}
+
+        coord_t local_exp[NCOEFFS];
+        for (int in = 0; in < NCOEFFS; ++in)
+            local_exp[in] = 0;
+
+        coord_t mpole[NCOEFFS];
+        coord_t deriv[NDERIVS];
+
+        for (box_id_t ilist = starts[i]; ilist < starts[i+1]; ++ilist)
+        {
+            box_id_t src_ibox = lists[ilist];
+            ${load_center("src_center", "src_ibox")}
+            ${difference("d", "center", "src_center")}
+            get_derivatives(deriv, d, NDERIVS);
+
+            for (int ik = 0; ik < NCOEFFS; ++ik)
+                mpole[ik] = mpoles[src_ibox*NCOEFFS + ik];
+
+            add_m2l(local_exp, mpole, deriv);
+        }
+
+        for (int in = 0; in < NCOEFFS; ++in)
+            local_exps[tgt_ibox*NCOEFFS + in] += local_exp[in];
+        """,
+    name="laplace_m2l")
+
+
+M2P_TEMPLATE = ElementwiseTemplate(
+    arguments="//CL:mako//" + r"""
+        box_id_t *target_boxes,
+        box_id_t *starts,
+        box_id_t *lists,
+        """ + _particle_args("target") + r"""
+        coord_t *box_centers,
+        box_id_t aligned_nboxes,
+        coord_t *mpoles,
+        coord_t *result
+        """,
+    operation=LAPLACE_MAKO_DEFS + r"""
+        box_id_t tgt_ibox = target_boxes[i];
+
+        coord_t deriv[NCOEFFS];
+
+        particle_id_t start = box_target_starts[tgt_ibox];
+        particle_id_t stop = start + box_target_counts_nonchild[tgt_ibox];
+
+        for (particle_id_t itgt = start; itgt < stop; ++itgt)
+        {
+            ${load_particle("target", "target", "itgt")}
+            coord_t pot = 0;
+
+            for (box_id_t ilist = starts[i]; ilist < starts[i+1]; ++ilist)
+            {
+                box_id_t src_ibox = lists[ilist];
+                ${load_center("src_center", "src_ibox")}
+                ${difference("d", "target", "src_center")}
+                get_derivatives(deriv, d, NCOEFFS);
+
+                for (int ik = 0; ik < NCOEFFS; ++ik)
+                {
+                    int k[DIMENSIONS];
+                    get_multi_index(k, ik);
+
+                    coord_t contrib = mpoles[src_ibox*NCOEFFS + ik] * deriv[ik];
+                    if (get_degree(k) % 2)
+                        pot -= contrib;
+                    else
+                        pot += contrib;
+                }
+            }
+
+            result[itgt] += pot;
+        }
+        """,
+    name="laplace_m2p")
+
+
+P2L_TEMPLATE = ElementwiseTemplate(
+    arguments="//CL:mako//" + r"""
+        box_id_t *target_or_target_parent_boxes,
+        box_id_t *starts,
+        box_id_t *lists,
+        """ + _particle_args("source") + r"""
+        coord_t *weights,
+        coord_t *box_centers,
+        box_id_t aligned_nboxes,
+        coord_t *local_exps
+        """,
+    operation=LAPLACE_MAKO_DEFS + r"""
+        box_id_t tgt_ibox = target_or_target_parent_boxes[i];
+        ${load_center("center", "tgt_ibox")}
+
+        coord_t local_exp[NCOEFFS];
+        for (int in = 0; in < NCOEFFS; ++in)
+            local_exp[in] = 0;
+
+        coord_t deriv[NCOEFFS];
+
+        for (box_id_t ilist = starts[i]; ilist < starts[i+1]; ++ilist)
+        {
+            box_id_t src_ibox = lists[ilist];
+
+            particle_id_t start = box_source_starts[src_ibox];
+            particle_id_t stop = start + box_source_counts_nonchild[src_ibox];
+
+            for (particle_id_t isrc = start; isrc < stop; ++isrc)
+            {
+                ${load_particle("source", "source", "isrc")}
+                ${difference("d", "center", "source")}
+                get_derivatives(deriv, d, NCOEFFS);
+
+                for (int in = 0; in < NCOEFFS; ++in)
+                    local_exp[in] += weights[isrc] * deriv[in];
+            }
+        }
+
+        for (int in = 0; in < NCOEFFS; ++in)
+            local_exps[tgt_ibox*NCOEFFS + in] += local_exp[in];
+        """,
+    name="laplace_p2l")
+
+
+L2L_TEMPLATE = ElementwiseTemplate(
+    arguments=r"""
+        box_id_t *target_or_target_parent_boxes,
+        box_id_t *box_parent_ids,
+        coord_t *box_centers,
+        box_id_t aligned_nboxes,
+        coord_t *local_exps
+        """,
+    operation=LAPLACE_MAKO_DEFS + r"""
+        box_id_t tgt_ibox = target_or_target_parent_boxes[i];
+        box_id_t src_ibox = box_parent_ids[tgt_ibox];
+
+        ${load_center("center", "tgt_ibox")}
+        ${load_center("src_center", "src_ibox")}
+        ${difference("h", "center", "src_center")}
+
+        coord_t mono[NCOEFFS];
+        get_monomials(mono, h, NCOEFFS);
+
+        for (int in = 0; in < NCOEFFS; ++in)
+        {
+            int n[DIMENSIONS];
+            get_multi_index(n, in);
+
+            coord_t sum = 0;
+
+            // m >= n implies im >= in.
+            for (int im = in; im < NCOEFFS; ++im)
+            {
+                int m[DIMENSIONS];
+                int m_minus_n[DIMENSIONS];
+                get_multi_index(m, im);
+
+                int n_le_m = 1;
+                for (int ax = 0; ax < DIMENSIONS; ++ax)
+                {
+                    m_minus_n[ax] = m[ax] - n[ax];
+                    n_le_m = n_le_m && m_minus_n[ax] >= 0;
+                }
+
+                if (n_le_m)
+                    sum += (
+                        multi_binomial(m, n)
+                        * mono[coeff_index(m_minus_n)]
+                        * local_exps[src_ibox*NCOEFFS + im]);
+            }
+
+            local_exps[tgt_ibox*NCOEFFS + in] += sum;
+        }
+        """,
+    name="laplace_l2l")
+
+
+L2P_TEMPLATE = ElementwiseTemplate(
+    arguments="//CL:mako//" + r"""
+        box_id_t *target_boxes,
+        """ + _particle_args("target") + r"""
+        coord_t *box_centers,
+        box_id_t aligned_nboxes,
+        coord_t *local_exps,
+        coord_t *result
+        """,
+    operation=LAPLACE_MAKO_DEFS + r"""
+        box_id_t tgt_ibox = target_boxes[i];
+        ${load_center("center", "tgt_ibox")}
+
+        coord_t mono[NCOEFFS];
+
+        particle_id_t start = box_target_starts[tgt_ibox];
+        particle_id_t stop = start + box_target_counts_nonchild[tgt_ibox];
+
+        for (particle_id_t itgt = start; itgt < stop; ++itgt)
+        {
+            ${load_particle("target", "target", "itgt")}
+            ${difference("h", "target", "center")}
+            get_monomials(mono, h, NCOEFFS);
+
+            coord_t pot = 0;
+            for (int in = 0; in < NCOEFFS; ++in)
+                pot += local_exps[tgt_ibox*NCOEFFS + in] * mono[in];
+
+            result[itgt] += pot;
+        }
+        """,
+    name="laplace_l2p")
+
+
+P2P_TEMPLATE = ElementwiseTemplate(
+    arguments="//CL:mako//" + r"""
+        box_id_t *target_boxes,
+        box_id_t *starts,
+        box_id_t *lists,
+        """ + _particle_args("target") + _particle_args("source") + r"""
+        coord_t *weights,
+        coord_t *result
+        """,
+    operation=LAPLACE_MAKO_DEFS + r"""
+        box_id_t tgt_ibox = target_boxes[i];
+
+        particle_id_t tgt_start = box_target_starts[tgt_ibox];
+        particle_id_t tgt_stop = tgt_start + box_target_counts_nonchild[tgt_ibox];
+
+        for (particle_id_t itgt = tgt_start; itgt < tgt_stop; ++itgt)
+        {
+            ${load_particle("target", "target", "itgt")}
+            coord_t pot = 0;
+
+            for (box_id_t ilist = starts[i]; ilist < starts[i+1]; ++ilist)
+            {
+                box_id_t src_ibox = lists[ilist];
+
+                particle_id_t src_start = box_source_starts[src_ibox];
+                particle_id_t src_stop = (
+                    src_start + box_source_counts_nonchild[src_ibox]);
+
+                for (particle_id_t isrc = src_start; isrc < src_stop; ++isrc)
+                {
+                    ${load_particle("source", "source", "isrc")}
+
+                    coord_t r2 = 0;
+                    for (int ax = 0; ax < DIMENSIONS; ++ax)
+                        r2 += (target[ax] - source[ax])*(target[ax] - source[ax]);
+
+                    // Skip the self-interaction.
+                    if (r2 != 0)
+                        pot += weights[isrc] * green(r2);
+                }
+            }
+
+            result[itgt] += pot;
+        }
+        """,
+    name="laplace_p2p")
+
+# }}}
+
+
+# {{{ wrangler
+
+class CLLaplaceExpansionWrangler(object):
+    """Implements the :class:`boxtree.fmm.ExpansionWranglerInterface` for the
+    Laplace kernel in two and three dimensions, with all stages carried out
+    by OpenCL kernels on the device holding the tree.
+
+    The potentials are the same as those of
+    :class:`boxtree.pyfmmlib_integration.FMMLibExpansionWrangler` for the
+    Laplace equation, i.e. sums of weights times :math:`-\\log(r)/(2\\pi)`
+    in 2D and :math:`1/(4\\pi r)` in 3D, except that coinciding sources and
+    targets do not interact. Multipole and local expansions are Cartesian
+    Taylor expansions of the same *order* on all levels. Each kernel processes
+    one box per work item.
+
+    The tree and the traversal passed to :func:`boxtree.fmm.drive_fmm` must
+    reside on the device (i.e. must not have been transferred with
+    ``get()``). Source weights may be given as :class:`numpy.ndarray` or
+    :class:`pyopencl.array.Array` and must be real. Only a single weight
+    vector per evaluation is supported. The potentials are returned as a
+    :class:`pyopencl.array.Array`.
+
+    Implements the in-place stage variants, see
+    :ref:`accumulating-stages`.
+
+    .. automethod:: __init__
+    """
+
+    def __init__(self, queue, tree, order):
+        """
+        :arg queue: the :class:`pyopencl.CommandQueue` on which the kernels
+            are run.
+        :arg order: the order of the multipole and local expansions, i.e.
+            the largest total degree of their Taylor coefficients.
+        """
+        if tree.dimensions not in [2, 3]:
+            raise ValueError("unsupported dimensionality")
+
+        if order < 0:
+            raise ValueError("order must be nonnegative")
+
+        self.queue = queue
+        self.tree = tree
+        self.order = order
+        self.dim = tree.dimensions
+
+        self.ncoeffs = len(_get_multi_indices(self.dim, order))
+
+    # {{{ kernels
+
+    def get_kernel(self, template):
+        tree = self.tree
+
+        # ElementwiseTemplate.build caches its results.
+        return template.build(
+                self.queue.context,
+                type_aliases=(
+                    ("coord_t", tree.coord_dtype),
+                    ("box_id_t", tree.box_id_dtype),
+                    ("particle_id_t", tree.particle_id_dtype),
+                    ),
+                var_values=(
+                    ("dimensions", self.dim),
+                    ("AXIS_NAMES", AXIS_NAMES),
+                    ),
+                more_preamble=_get_preamble(self.dim, self.order))
+
+    def _run(self, template, nitems, *args, **kwargs):
+        if nitems == 0:
+            return
+
+        self.get_kernel(template)(*args,
+                range=kwargs.pop("range", slice(nitems)),
+                queue=self.queue)
+
+    def _box_args(self):
+        return (self.tree.box_centers, self.tree.aligned_nboxes)
+
+    def _source_args(self):
+        tree = self.tree
+        return (
+                tree.box_source_starts,
+                tree.box_source_counts_nonchild,
+                ) + tuple(tree.sources)
+
+    def _target_args(self):
+        tree = self.tree
+        return (
+                tree.box_target_starts,
+                tree.box_target_counts_nonchild,
+                ) + tuple(tree.targets)
+
+    # }}}
+
+    # {{{ data vector utilities
+
+    def multipole_expansion_zeros(self):
+        return cl.array.zeros(self.queue,
+                (self.tree.nboxes, self.ncoeffs), self.tree.coord_dtype)
+
+    def local_expansion_zeros(self):
+        return cl.array.zeros(self.queue,
+                (self.tree.nboxes, self.ncoeffs), self.tree.coord_dtype)
+
+    def output_zeros(self):
+        return cl.array.zeros(self.queue,
+                self.tree.ntargets, self.tree.coord_dtype)
+
+    # }}}
+
+    @log_process(logger)
+    def reorder_sources(self, source_array):
+        if source_array.ndim != 1:
+            raise ValueError("only a single weight vector is supported")
+
+        if source_array.dtype.kind == "c":
+            raise TypeError("complex source weights are not supported")
+
+        if isinstance(source_array, np.ndarray):
+            source_array = cl.array.to_device(self.queue, source_array)
+
+        return cl.array.take(
+                source_array.astype(self.tree.coord_dtype, queue=self.queue),
+                self.tree.user_source_ids, queue=self.queue)
+
+    @log_process(logger)
+    def reorder_potentials(self, potentials):
+        return cl.array.take(
+                potentials, self.tree.sorted_target_ids, queue=self.queue)
+
+    @log_process(logger)
+    def form_multipoles(self, level_start_source_box_nrs, source_boxes,
+            src_weights):
+        mpoles = self.multipole_expansion_zeros()
+
+        self._run(P2M_TEMPLATE, len(source_boxes),
+                source_boxes,
+                *(self._source_args()
+                    + (src_weights,)
+                    + self._box_args()
+                    + (mpoles,)))
+
+        return mpoles
+
+    @log_process(logger)
+    def coarsen_multipoles(self, level_start_source_parent_box_nrs,
+            source_parent_boxes, mpoles):
+        tree = self.tree
+
+        # nlevels-1 is the last valid level index
+        # nlevels-2 is the last valid level that could have children
+        #
+        # 3 is the last relevant source_level.
+        # 2 is the last relevant target_level.
+        # (because no level 1 box will be well-separated from another)
+        for source_level in range(tree.nlevels-1, 2, -1):
+            target_level = source_level - 1
+            start, stop = level_start_source_parent_box_nrs[
+                            target_level:target_level+2]
+
+            self._run(M2M_TEMPLATE, stop - start,
+                    source_parent_boxes,
+                    tree.box_child_ids,
+                    *(self._box_args() + (mpoles,)),
+                    range=slice(start, stop))
+
+    def eval_direct(self, target_boxes, neighbor_sources_starts,
+            neighbor_sources_lists, src_weights):
+        output = self.output_zeros()
+        self.eval_direct_into(output, target_boxes, neighbor_sources_starts,
+                neighbor_sources_lists, src_weights)
+        return output
+
+    @log_process(logger)
+    def eval_direct_into(self, output, target_boxes, neighbor_sources_starts,
+            neighbor_sources_lists, src_weights):
+        self._run(P2P_TEMPLATE, len(target_boxes),
+                target_boxes,
+                neighbor_sources_starts,
+                neighbor_sources_lists,
+                *(self._target_args()
+                    + self._source_args()
+                    + (src_weights, output)))
+
+    @log_process(logger)
+    def multipole_to_local(self,
+            level_start_target_or_target_parent_box_nrs,
+            target_or_target_parent_boxes,
+            starts, lists, mpole_exps):
+        local_exps = self.local_expansion_zeros()
+
+        self._run(M2L_TEMPLATE, len(target_or_target_parent_boxes),
+                target_or_target_parent_boxes,
+                starts, lists,
+                *(self._box_args() + (mpole_exps, local_exps)))
+
+        return local_exps
+
+    def eval_multipoles(self,
+            target_boxes_by_source_level, sep_smaller_nonsiblings_by_level,
+            mpole_exps):
+        output = self.output_zeros()
+        self.eval_multipoles_into(output,
+                target_boxes_by_source_level, sep_smaller_nonsiblings_by_level,
+                mpole_exps)
+        return output
+
+    @log_process(logger)
+    def eval_multipoles_into(self, output,
+            target_boxes_by_source_level, sep_smaller_nonsiblings_by_level,
+            mpole_exps):
+        # Each target box occurs at most once per source level, so that the
+        # work items of one kernel invocation write to distinct targets.
+        for target_boxes, ssn in zip(
+                target_boxes_by_source_level, sep_smaller_nonsiblings_by_level):
+            self._run(M2P_TEMPLATE, len(target_boxes),
+                    target_boxes,
+                    ssn.starts, ssn.lists,
+                    *(self._target_args()
+                        + self._box_args()
+                        + (mpole_exps, output)))
+
+    def form_locals(self,
+            level_start_target_or_target_parent_box_nrs,
+            target_or_target_parent_boxes, starts, lists, src_weights):
+        local_exps = self.local_expansion_zeros()
+        self.form_locals_into(local_exps,
+                level_start_target_or_target_parent_box_nrs,
+                target_or_target_parent_boxes, starts, lists, src_weights)
+        return local_exps
+
+    @log_process(logger)
+    def form_locals_into(self, local_exps,
+            level_start_target_or_target_parent_box_nrs,
+            target_or_target_parent_boxes, starts, lists, src_weights):
+        self._run(P2L_TEMPLATE, len(target_or_target_parent_boxes),
+                target_or_target_parent_boxes,
+                starts, lists,
+                *(self._source_args()
+                    + (src_weights,)
+                    + self._box_args()
+                    + (local_exps,)))
+
+    @log_process(logger)
+    def refine_locals(self, level_start_target_or_target_parent_box_nrs,
+            target_or_target_parent_boxes, local_exps):
+        # Levels are processed in order, since each level's local
+        # expansions are refined from those of the level above.
+        for target_lev in range(1, self.tree.nlevels):
+            start, stop = level_start_target_or_target_parent_box_nrs[
+                    target_lev:target_lev+2]
+
+            self._run(L2L_TEMPLATE, stop - start,
+                    target_or_target_parent_boxes,
+                    self.tree.box_parent_ids,
+                    *(self._box_args() + (local_exps,)),
+                    range=slice(start, stop))
+
+        return local_exps
+
+    def eval_locals(self, level_start_target_box_nrs, target_boxes, local_exps):
+        output = self.output_zeros()
+        self.eval_locals_into(output,
+                level_start_target_box_nrs, target_boxes, local_exps)
+        return output
+
+    @log_process(logger)
+    def eval_locals_into(self, output,
+            level_start_target_box_nrs, target_boxes, local_exps):
+        self._run(L2P_TEMPLATE, len(target_boxes),
+                target_boxes,
+                *(self._target_args()
+                    + self._box_args()
+                    + (local_exps, output)))
+
+    @log_process(logger)
+    def finalize_potentials(self, potentials):
+        if self.dim == 2:
+            scale_factor = -1/(2*np.pi)
+        else:
+            scale_factor = 1/(4*np.pi)
+
+        return potentials * scale_factor
+
+# }}}
+
+# vim: filetype=pyopencl:fdm=marker
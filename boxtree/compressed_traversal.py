@@ -0,0 +1,622 @@
+from __future__ import division
+
+__copyright__ = "Copyright (C) 2018 Andreas Kloeckner"
+
+__license__ = """
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import numpy as np
+import pyopencl as cl
+import pyopencl.array  # noqa
+from pyopencl.elementwise import ElementwiseTemplate
+from pytools import memoize_method, ProcessLogger, Record
+from boxtree.tools import DeviceDataRecord, InlineBinarySearch
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+__doc__ = """
+Compressed storage for traversals
+---------------------------------
+
+The interaction lists in :class:`boxtree.traversal.FMMTraversalInfo` are
+stored as CSR arrays of global box numbers of type ``box_id_t``. For large
+trees, these can take up considerably more memory than the tree itself.
+:class:`TraversalCompressor` converts a traversal into a
+:class:`CompressedFMMTraversalInfo`, in which
+
+- each interaction list is stored either relative to the box that owns it
+  (*delta* encoding, i.e. ``list_entry - owner_box``), or as absolute box
+  numbers, whichever is smaller, and
+- all index arrays (box lists, *starts* and encoded *lists*) are narrowed to
+  the smallest integer type that can hold their values.
+
+Since boxes are numbered in level order, and entries of most lists are near
+their owner box, delta-encoded lists often fit into 8 or 16 bits.
+
+Compression and decompression work on traversals that live on the device
+(using the device) as well as on host-resident traversals (using :mod:`numpy`).
+A compressed traversal may be transferred to the host using
+:meth:`CompressedFMMTraversalInfo.get`, at a correspondingly reduced cost.
+
+.. autoclass:: CompressedBoxList()
+
+.. autoclass:: CompressedFMMTraversalInfo()
+
+    .. automethod:: get
+
+    .. automethod:: with_queue
+
+.. autoclass:: TraversalCompressor
+
+    .. automethod:: compress
+
+    .. automethod:: decompress
+"""
+
+
+# {{{ names of compressible fields
+
+# Plain arrays of box numbers. Stored width-narrowed.
+_BOX_ARRAY_NAMES = [
+        "source_boxes",
+        "target_boxes",
+        "source_parent_boxes",
+        "target_or_target_parent_boxes",
+        ]
+
+# CSR interaction lists, along with the name of the array of global box
+# numbers that *starts* is indexed by. *None* indicates that *starts* is
+# indexed by global box number itself.
+_CSR_LIST_NAMES_AND_OWNERS = [
+        ("same_level_non_well_sep_boxes", None),
+        ("neighbor_source_boxes", "target_boxes"),
+        ("from_sep_siblings", "target_or_target_parent_boxes"),
+        ("from_sep_close_smaller", "target_boxes"),
+        ("from_sep_bigger", "target_or_target_parent_boxes"),
+        ("from_sep_close_bigger", "target_or_target_parent_boxes"),
+        ]
+
+# }}}
+
+
+# {{{ kernel templates
+
+DELTA_ENCODER_TEMPLATE = ElementwiseTemplate(
+    arguments=r"""//CL:mako//
+        box_id_t *lists,
+        box_id_t *starts,
+        box_id_t starts_len,
+        %if have_owner_boxes:
+            box_id_t *owner_boxes,
+        %endif
+        box_id_t *deltas
+    """,
+    operation=r"""//CL:mako//
+        box_id_t ilist = bsearch(starts, starts_len, i);
+        %if have_owner_boxes:
+            deltas[i] = lists[i] - owner_boxes[ilist];
+        %else:
+            deltas[i] = lists[i] - ilist;
+        %endif
+    """,
+    name="encode_box_list_deltas",
+    preamble=str(InlineBinarySearch("box_id_t")))
+
+
+DELTA_DECODER_TEMPLATE = ElementwiseTemplate(
+    arguments=r"""//CL:mako//
+        enc_t *deltas,
+        starts_t *starts,
+        box_id_t starts_len,
+        %if have_owner_boxes:
+            box_id_t *owner_boxes,
+        %endif
+        box_id_t *lists
+    """,
+    operation=r"""//CL:mako//
+        box_id_t ilist = bsearch(starts, starts_len, i);
+        %if have_owner_boxes:
+            lists[i] = owner_boxes[ilist] + deltas[i];
+        %else:
+            lists[i] = ilist + deltas[i];
+        %endif
+    """,
+    name="decode_box_list_deltas",
+    preamble=str(InlineBinarySearch("starts_t")))
+
+# }}}
+
+
+# {{{ data structures
+
+class CompressedBoxList(DeviceDataRecord):
+    """A CSR list of global box numbers in compressed form.
+
+    .. attribute:: encoding
+
+        Either ``"delta"`` or ``"absolute"``. If ``"delta"``, entry *j* of the
+        list belonging to owner box *b* is stored as ``lists[j] - b``.
+
+    .. attribute:: starts
+
+        An unsigned integer array, narrowed to the smallest type able to hold
+        ``len(lists)``.
+
+    .. attribute:: lists
+
+        The (possibly delta-encoded) list entries, narrowed to the smallest
+        integer type able to hold all of them.
+
+    For the per-level lists of
+    :attr:`boxtree.traversal.FMMTraversalInfo.from_sep_smaller_by_level`,
+    the attributes *num_nonempty_lists* and *nonempty_indices* (narrowed) are
+    also present.
+    """
+
+
+class CompressedFMMTraversalInfo(DeviceDataRecord):
+    """A compressed version of a :class:`boxtree.traversal.FMMTraversalInfo`.
+    Use :meth:`TraversalCompressor.decompress` to obtain the original
+    traversal.
+
+    All attributes of the original traversal that do not hold box numbers
+    (such as :attr:`tree`, the ``level_start_*`` arrays and the box bounding
+    boxes) are carried over unchanged.
+
+    .. attribute:: box_id_dtype
+
+        The :attr:`boxtree.Tree.box_id_dtype` of the original traversal.
+
+    .. attribute:: source_boxes
+    .. attribute:: target_boxes
+    .. attribute:: source_parent_boxes
+    .. attribute:: target_or_target_parent_boxes
+    .. attribute:: target_boxes_sep_smaller_by_source_level
+
+        Width-narrowed versions of the corresponding traversal attributes.
+        :attr:`target_boxes` is *None* if
+        :attr:`boxtree.Tree.sources_are_targets`, in which case it is
+        identical to :attr:`source_boxes`.
+
+    .. attribute:: same_level_non_well_sep_boxes
+    .. attribute:: neighbor_source_boxes
+    .. attribute:: from_sep_siblings
+    .. attribute:: from_sep_close_smaller
+    .. attribute:: from_sep_bigger
+    .. attribute:: from_sep_close_bigger
+
+        Instances of :class:`CompressedBoxList`, or *None* if the corresponding
+        list was *None* in the original traversal.
+
+    .. attribute:: from_sep_smaller_by_level
+
+        A list of :class:`CompressedBoxList` instances, one per level.
+    """
+
+    def with_queue(self, queue):
+        """Return a copy of `self` in which all
+        :class:`pyopencl.array.Array` objects, including those inside the
+        nested :class:`CompressedBoxList` instances, are assigned to
+        :class:`pyopencl.CommandQueue` *queue*.
+        """
+        def box_list_with_queue(cbl):
+            if cbl is None:
+                return None
+            return cbl.with_queue(queue)
+
+        result = DeviceDataRecord.with_queue(self, queue)
+
+        updates = {}
+        for field_name in result.__class__.fields:
+            val = getattr(result, field_name, None)
+            if isinstance(val, CompressedBoxList):
+                updates[field_name] = box_list_with_queue(val)
+            elif (isinstance(val, list)
+                    and any(isinstance(v, CompressedBoxList) for v in val)):
+                updates[field_name] = [box_list_with_queue(v) for v in val]
+
+        return result.copy(**updates)
+
+# }}}
+
+
+# {{{ helpers
+
+def _narrowest_int_dtype(min_val, max_val):
+    if min_val >= 0:
+        candidates = [np.uint8, np.uint16, np.uint32, np.uint64]
+    else:
+        candidates = [np.int8, np.int16, np.int32, np.int64]
+
+    for dtype in candidates:
+        info = np.iinfo(dtype)
+        if info.min <= min_val and max_val <= info.max:
+            return np.dtype(dtype)
+
+    raise ValueError("no integer type can hold range [%d, %d]"
+            % (min_val, max_val))
+
+
+def _get_nbytes(val):
+    if val is None:
+        return 0
+    elif isinstance(val, (np.ndarray, cl.array.Array)):
+        return val.nbytes
+    elif isinstance(val, list):
+        return sum(_get_nbytes(v) for v in val)
+    elif isinstance(val, dict):
+        return sum(_get_nbytes(v) for v in val.values())
+    elif isinstance(val, Record):
+        return _get_nbytes(val.__dict__)
+    else:
+        return 0
+
+
+def _get_traversal_nbytes(trav):
+    """Return the number of bytes taken up by the index data of *trav*,
+    excluding the tree and the (deprecated, aliased) colleagues lists.
+    """
+    return sum(
+            _get_nbytes(getattr(trav, name))
+            for name in trav.__class__.fields
+            if name not in ["tree", "colleagues_starts", "colleagues_lists"]
+            and hasattr(trav, name))
+
+# }}}
+
+
+# {{{ compressor
+
+class TraversalCompressor(object):
+    """Converts :class:`boxtree.traversal.FMMTraversalInfo` instances to and
+    from :class:`CompressedFMMTraversalInfo`.
+    """
+
+    def __init__(self, context):
+        self.context = context
+
+    # {{{ kernels
+
+    @memoize_method
+    def get_delta_encoder_kernel(self, box_id_dtype, have_owner_boxes):
+        return DELTA_ENCODER_TEMPLATE.build(
+                self.context,
+                type_aliases=(
+                    ("box_id_t", box_id_dtype),
+                    ),
+                var_values=(
+                    ("have_owner_boxes", have_owner_boxes),
+                    ))
+
+    @memoize_method
+    def get_delta_decoder_kernel(self, box_id_dtype, starts_dtype, enc_dtype,
+            have_owner_boxes):
+        return DELTA_DECODER_TEMPLATE.build(
+                self.context,
+                type_aliases=(
+                    ("box_id_t", box_id_dtype),
+                    ("starts_t", starts_dtype),
+                    ("enc_t", enc_dtype),
+                    ),
+                var_values=(
+                    ("have_owner_boxes", have_owner_boxes),
+                    ))
+
+    # }}}
+
+    # {{{ array-level helpers
+
+    @staticmethod
+    def _narrow(queue, ary, min_val, max_val):
+        dtype = _narrowest_int_dtype(min_val, max_val)
+        if isinstance(ary, np.ndarray):
+            return ary.astype(dtype)
+        else:
+            return ary.astype(dtype, queue=queue)
+
+    def _narrow_box_array(self, queue, ary, nboxes):
+        if ary is None:
+            return None
+        return self._narrow(queue, ary, 0, max(nboxes - 1, 0))
+
+    def _compress_box_list(self, queue, starts, lists, owner_boxes, nboxes,
+            **extra):
+        box_id_dtype = lists.dtype
+        nentries = len(lists)
+        nlists = len(starts) - 1
+
+        # {{{ compute deltas
+
+        on_host = isinstance(lists, np.ndarray)
+
+        if on_host:
+            owners = np.repeat(
+                    np.arange(nlists, dtype=box_id_dtype),
+                    np.diff(starts))
+            if owner_boxes is not None:
+                owners = owner_boxes[owners]
+            deltas = lists - owners
+
+            if nentries:
+                min_delta = int(deltas.min())
+                max_delta = int(deltas.max())
+
+        else:
+            deltas = cl.array.empty(queue, nentries, box_id_dtype)
+
+            if nentries:
+                knl = self.get_delta_encoder_kernel(
+                        box_id_dtype, owner_boxes is not None)
+
+                args = (lists, starts, nlists + 1)
+                if owner_boxes is not None:
+                    args += (owner_boxes,)
+                args += (deltas,)
+
+                knl(*args, range=slice(nentries), queue=queue)
+
+                min_delta = int(cl.array.min(deltas, queue=queue).get())
+                max_delta = int(cl.array.max(deltas, queue=queue).get())
+
+        if not nentries:
+            min_delta = max_delta = 0
+
+        # }}}
+
+        delta_dtype = _narrowest_int_dtype(min_delta, max_delta)
+        absolute_dtype = _narrowest_int_dtype(0, max(nboxes - 1, 0))
+
+        if delta_dtype.itemsize < absolute_dtype.itemsize:
+            encoding = "delta"
+            enc_lists = self._narrow(queue, deltas, min_delta, max_delta)
+        else:
+            # Decoding absolute lists is just a type conversion, so prefer
+            # them unless deltas save space.
+            encoding = "absolute"
+            enc_lists = self._narrow(queue, lists, 0, max(nboxes - 1, 0))
+
+        del deltas
+
+        return CompressedBoxList(
+                encoding=encoding,
+                starts=self._narrow(queue, starts, 0, nentries),
+                lists=enc_lists,
+                **extra)
+
+    def _decompress_box_list(self, queue, cbl, owner_boxes, box_id_dtype):
+        on_host = isinstance(cbl.lists, np.ndarray)
+        nentries = len(cbl.lists)
+        nlists = len(cbl.starts) - 1
+
+        if on_host:
+            starts = cbl.starts.astype(box_id_dtype)
+        else:
+            starts = cbl.starts.astype(box_id_dtype, queue=queue)
+
+        if cbl.encoding == "absolute":
+            if on_host:
+                lists = cbl.lists.astype(box_id_dtype)
+            else:
+                lists = cbl.lists.astype(box_id_dtype, queue=queue)
+
+        elif cbl.encoding == "delta":
+            if on_host:
+                owners = np.repeat(
+                        np.arange(nlists, dtype=box_id_dtype),
+                        np.diff(starts))
+                if owner_boxes is not None:
+                    owners = owner_boxes[owners]
+                lists = (owners + cbl.lists).astype(box_id_dtype)
+
+            else:
+                lists = cl.array.empty(queue, nentries, box_id_dtype)
+
+                if nentries:
+                    knl = self.get_delta_decoder_kernel(
+                            box_id_dtype, cbl.starts.dtype, cbl.lists.dtype,
+                            owner_boxes is not None)
+
+                    args = (cbl.lists, cbl.starts, nlists + 1)
+                    if owner_boxes is not None:
+                        args += (owner_boxes,)
+                    args += (lists,)
+
+                    knl(*args, range=slice(nentries), queue=queue)
+
+        else:
+            raise ValueError("unknown box list encoding: '%s'" % cbl.encoding)
+
+        return starts, lists
+
+    # }}}
+
+    def compress(self, queue, trav):
+        """
+        :arg queue: a :class:`pyopencl.CommandQueue`. May be *None* if *trav*
+            resides on the host.
+        :arg trav: a :class:`boxtree.traversal.FMMTraversalInfo`, with its
+            data residing either on the device or on the host.
+        :returns: a :class:`CompressedFMMTraversalInfo`, with its data residing
+            in the same place as that of *trav*.
+        """
+
+        compress_plog = ProcessLogger(logger, "compress traversal")
+
+        nboxes = trav.tree.nboxes
+        box_id_dtype = trav.tree.box_id_dtype
+
+        fields = {}
+        for field_name in trav.__class__.fields:
+            try:
+                fields[field_name] = getattr(trav, field_name)
+            except AttributeError:
+                pass
+
+        # The deprecated colleagues lists are either *None* or aliases of
+        # same_level_non_well_sep_boxes. They get restored on decompression.
+        fields["colleagues_are_aliases"] = (
+                trav.colleagues_starts is not None)
+        fields.pop("colleagues_starts")
+        fields.pop("colleagues_lists")
+
+        for list_name, owner_name in _CSR_LIST_NAMES_AND_OWNERS:
+            starts = fields.pop(list_name + "_starts")
+            lists = fields.pop(list_name + "_lists")
+
+            if starts is None:
+                fields[list_name] = None
+                continue
+
+            owner_boxes = None
+            if owner_name is not None:
+                owner_boxes = getattr(trav, owner_name)
+
+            fields[list_name] = self._compress_box_list(
+                    queue, starts, lists, owner_boxes, nboxes)
+
+        fields["from_sep_smaller_by_level"] = [
+                self._compress_box_list(
+                    queue, lev_list.starts, lev_list.lists, owner_boxes, nboxes,
+                    num_nonempty_lists=lev_list.num_nonempty_lists,
+                    nonempty_indices=self._narrow_box_array(
+                        queue, lev_list.nonempty_indices,
+                        len(trav.target_boxes)))
+                for lev_list, owner_boxes in zip(
+                    trav.from_sep_smaller_by_level,
+                    trav.target_boxes_sep_smaller_by_source_level)]
+
+        fields["target_boxes_sep_smaller_by_source_level"] = [
+                self._narrow_box_array(queue, ary, nboxes)
+                for ary in trav.target_boxes_sep_smaller_by_source_level]
+
+        # target_boxes holds the same data as source_boxes in this case, but
+        # generally in a distinct array object.
+        if trav.tree.sources_are_targets:
+            fields["target_boxes"] = None
+
+        for name in _BOX_ARRAY_NAMES:
+            fields[name] = self._narrow_box_array(queue, fields[name], nboxes)
+
+        result = CompressedFMMTraversalInfo(
+                box_id_dtype=box_id_dtype,
+                **fields)
+
+        compress_plog.done("%d -> %d bytes",
+                _get_traversal_nbytes(trav), _get_traversal_nbytes(result))
+
+        return result
+
+    def decompress(self, queue, ctrav):
+        """
+        :arg queue: a :class:`pyopencl.CommandQueue`. May be *None* if *ctrav*
+            resides on the host.
+        :arg ctrav: a :class:`CompressedFMMTraversalInfo`.
+        :returns: a :class:`boxtree.traversal.FMMTraversalInfo`, with its data
+            residing in the same place as that of *ctrav*.
+        """
+
+        box_id_dtype = ctrav.box_id_dtype
+        on_host = isinstance(ctrav.source_boxes, np.ndarray)
+
+        def widen(ary):
+            if ary is None:
+                return None
+            elif on_host:
+                return ary.astype(box_id_dtype)
+            else:
+                return ary.astype(box_id_dtype, queue=queue)
+
+        fields = {}
+        for field_name in ctrav.__class__.fields:
+            try:
+                fields[field_name] = getattr(ctrav, field_name)
+            except AttributeError:
+                pass
+
+        del fields["box_id_dtype"]
+
+        for name in _BOX_ARRAY_NAMES:
+            fields[name] = widen(fields[name])
+
+        if fields["target_boxes"] is None:
+            fields["target_boxes"] = fields["source_boxes"]
+
+        fields["target_boxes_sep_smaller_by_source_level"] = [
+                widen(ary)
+                for ary in ctrav.target_boxes_sep_smaller_by_source_level]
+
+        colleagues_are_aliases = fields.pop("colleagues_are_aliases")
+
+        for list_name, owner_name in _CSR_LIST_NAMES_AND_OWNERS:
+            cbl = fields.pop(list_name)
+
+            if cbl is None:
+                fields[list_name + "_starts"] = None
+                fields[list_name + "_lists"] = None
+                continue
+
+            owner_boxes = None
+            if owner_name is not None:
+                owner_boxes = fields[owner_name]
+
+            (fields[list_name + "_starts"], fields[list_name + "_lists"]) = \
+                    self._decompress_box_list(
+                            queue, cbl, owner_boxes, box_id_dtype)
+
+        if colleagues_are_aliases:
+            fields["colleagues_starts"] = \
+                    fields["same_level_non_well_sep_boxes_starts"]
+            fields["colleagues_lists"] = \
+                    fields["same_level_non_well_sep_boxes_lists"]
+        else:
+            fields["colleagues_starts"] = None
+            fields["colleagues_lists"] = None
+
+        from pyopencl.algorithm import BuiltList
+
+        from_sep_smaller_by_level = []
+        for cbl, owner_boxes in zip(
+                ctrav.from_sep_smaller_by_level,
+                fields["target_boxes_sep_smaller_by_source_level"]):
+            starts, lists = self._decompress_box_list(
+                    queue, cbl, owner_boxes, box_id_dtype)
+            from_sep_smaller_by_level.append(
+                    BuiltList(
+                        count=len(lists),
+                        starts=starts,
+                        lists=lists,
+                        num_nonempty_lists=cbl.num_nonempty_lists,
+                        nonempty_indices=widen(cbl.nonempty_indices)))
+
+        fields["from_sep_smaller_by_level"] = from_sep_smaller_by_level
+
+        from boxtree.traversal import FMMTraversalInfo
+        result = FMMTraversalInfo(**fields)
+
+        if not on_host:
+            result = result.with_queue(None)
+
+        return result
+
+# }}}
+
+# vim: filetype=pyopencl:fdm=marker
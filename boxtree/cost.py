@@ -0,0 +1,555 @@
+from __future__ import division
+
+__copyright__ = "Copyright (C) 2018 Andreas Kloeckner"
+
+__license__ = """
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import six
+from six.moves import range, zip
+
+import numpy as np
+from pytools import Record
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+__doc__ = """
+Cost model
+----------
+
+This module estimates the amount of work implied by each stage of
+:func:`boxtree.fmm.drive_fmm` for a given traversal, without running the FMM.
+
+Work is first counted per box by :func:`count_fmm_work`, in terms of
+order-independent quantities (particle pairs, translations, particle-expansion
+interactions). An :class:`FMMCostModel` then weights these counts by the
+number of expansion coefficients implied by the expansion order on each
+level, and by per-stage calibration constants, to obtain costs (e.g. in
+seconds). :func:`calibrate_cost_model` fits the calibration constants from
+timed runs, which may be obtained using :func:`time_fmm_stages`.
+
+Work is attributed to the following stages, named after the corresponding
+methods of :class:`boxtree.fmm.ExpansionWranglerInterface`:
+
+=========================== ============================ =====================
+Stage                       Counted quantity             Attributed to
+=========================== ============================ =====================
+``form_multipoles``         sources (P2M)                source box
+``coarsen_multipoles``      child boxes (M2M)            source parent box
+``eval_direct``             source-target pairs (P2P),   target box (List 1,
+                            from List 1 and the "close"  List 3 close), target
+                            lists                        or target parent box
+                                                         (List 4 close)
+``multipole_to_local``      List 2 boxes (M2L)           target or target
+                                                         parent box
+``eval_multipoles``         targets times List 3         target box
+                            boxes (M2P)
+``form_locals``             sources in List 4            target or target
+                            boxes (P2L)                  parent box
+``refine_locals``           parent boxes (L2L)           target or target
+                                                         parent box
+``eval_locals``             targets (L2P)                target box
+=========================== ============================ =====================
+
+Here, "target or target parent box" refers to
+:attr:`boxtree.traversal.FMMTraversalInfo.target_or_target_parent_boxes`,
+many of which are not leaves. Work attributed to such boxes is therefore not
+included in the work of
+:attr:`boxtree.traversal.FMMTraversalInfo.target_boxes`.
+
+.. autodata:: FMM_STAGES
+
+.. autoclass:: FMMWorkCounts()
+
+.. autofunction:: count_fmm_work
+
+.. autoclass:: FMMCostModel
+
+.. autofunction:: calibrate_cost_model
+
+.. autofunction:: time_fmm_stages
+"""
+
+
+#: The stages of :func:`boxtree.fmm.drive_fmm` for which work is counted,
+#: in order of execution.
+FMM_STAGES = [
+        "form_multipoles",
+        "coarsen_multipoles",
+        "eval_direct",
+        "multipole_to_local",
+        "eval_multipoles",
+        "form_locals",
+        "refine_locals",
+        "eval_locals",
+        ]
+
+
+# {{{ work counting
+
+class FMMWorkCounts(Record):
+    """Per-box work counts for the stages of an FMM. See :func:`count_fmm_work`.
+
+    .. attribute:: tree
+
+        The (host-resident) :class:`boxtree.Tree` the counts refer to.
+
+    .. attribute:: box_counts
+
+        A dictionary mapping each entry of :data:`FMM_STAGES` to an integer
+        array of shape ``[nboxes]`` containing the amount of work attributed
+        to each box.
+
+    .. attribute:: eval_multipoles_by_source_level
+
+        A list with one entry per level, each an integer array of shape
+        ``[nboxes]`` containing the ``eval_multipoles`` work of each target
+        box due to source boxes on that level. These sum to
+        ``box_counts["eval_multipoles"]``.
+
+    .. automethod:: get_level_counts
+    .. automethod:: get_total_counts
+    """
+
+    def get_level_counts(self, stage):
+        """Return an array of shape ``[nlevels]`` containing the work of
+        *stage* summed over all boxes on each level.
+        """
+        return np.bincount(
+                self.tree.box_levels,
+                weights=self.box_counts[stage],
+                minlength=self.tree.nlevels).astype(np.int64)
+
+    def get_total_counts(self):
+        """Return a dictionary mapping each entry of :data:`FMM_STAGES` to the
+        total amount of work in that stage.
+        """
+        return dict(
+                (stage, int(np.sum(self.box_counts[stage])))
+                for stage in FMM_STAGES)
+
+
+def _csr_sums(starts, lists, values):
+    """Return, for each list of the CSR structure given by *starts* and
+    *lists*, the sum of *values* over the entries of the list.
+    """
+    cumul = np.zeros(len(lists) + 1, dtype=np.int64)
+    np.cumsum(values[lists], out=cumul[1:])
+    return cumul[starts[1:]] - cumul[starts[:-1]]
+
+
+def count_fmm_work(traversal):
+    """Count the work implied by each stage of :func:`boxtree.fmm.drive_fmm`
+    for *traversal*.
+
+    :arg traversal: a :class:`boxtree.traversal.FMMTraversalInfo` residing on
+        the host. (Use :meth:`boxtree.traversal.FMMTraversalInfo.get` to obtain
+        one.)
+    :returns: a :class:`FMMWorkCounts`
+    """
+    tree = traversal.tree
+    nboxes = tree.nboxes
+
+    nsources = tree.box_source_counts_nonchild.astype(np.int64)
+    ntargets = tree.box_target_counts_nonchild.astype(np.int64)
+
+    box_counts = dict(
+            (stage, np.zeros(nboxes, dtype=np.int64))
+            for stage in FMM_STAGES)
+
+    source_boxes = traversal.source_boxes
+    target_boxes = traversal.target_boxes
+    source_parent_boxes = traversal.source_parent_boxes
+    target_or_target_parent_boxes = traversal.target_or_target_parent_boxes
+
+    # {{{ form_multipoles, coarsen_multipoles
+
+    box_counts["form_multipoles"][source_boxes] = nsources[source_boxes]
+
+    nchildren = np.sum(tree.box_child_ids[:, :nboxes] != 0, axis=0)
+    box_counts["coarsen_multipoles"][source_parent_boxes] = \
+            nchildren[source_parent_boxes]
+
+    # }}}
+
+    # {{{ eval_direct (List 1, List 3 close, List 4 close)
+
+    direct = box_counts["eval_direct"]
+
+    direct[target_boxes] += ntargets[target_boxes] * _csr_sums(
+            traversal.neighbor_source_boxes_starts,
+            traversal.neighbor_source_boxes_lists,
+            nsources)
+
+    if traversal.from_sep_close_smaller_starts is not None:
+        direct[target_boxes] += ntargets[target_boxes] * _csr_sums(
+                traversal.from_sep_close_smaller_starts,
+                traversal.from_sep_close_smaller_lists,
+                nsources)
+
+    if traversal.from_sep_close_bigger_starts is not None:
+        direct[target_or_target_parent_boxes] += (
+                ntargets[target_or_target_parent_boxes]
+                * _csr_sums(
+                    traversal.from_sep_close_bigger_starts,
+                    traversal.from_sep_close_bigger_lists,
+                    nsources))
+
+    # }}}
+
+    # {{{ multipole_to_local (List 2)
+
+    box_counts["multipole_to_local"][target_or_target_parent_boxes] = \
+            np.diff(traversal.from_sep_siblings_starts)
+
+    # }}}
+
+    # {{{ eval_multipoles (List 3)
+
+    eval_multipoles_by_source_level = []
+    for lev_boxes, lev_list in zip(
+            traversal.target_boxes_sep_smaller_by_source_level,
+            traversal.from_sep_smaller_by_level):
+        lev_counts = np.zeros(nboxes, dtype=np.int64)
+        lev_counts[lev_boxes] = (
+                ntargets[lev_boxes]
+                * np.diff(lev_list.starts))
+        eval_multipoles_by_source_level.append(lev_counts)
+
+        box_counts["eval_multipoles"] += lev_counts
+
+    # }}}
+
+    # {{{ form_locals (List 4)
+
+    box_counts["form_locals"][target_or_target_parent_boxes] = _csr_sums(
+            traversal.from_sep_bigger_starts,
+            traversal.from_sep_bigger_lists,
+            nsources)
+
+    # }}}
+
+    # {{{ refine_locals, eval_locals
+
+    box_counts["refine_locals"][target_or_target_parent_boxes] = (
+            tree.box_levels[target_or_target_parent_boxes] > 0)
+
+    box_counts["eval_locals"][target_boxes] = ntargets[target_boxes]
+
+    # }}}
+
+    return FMMWorkCounts(
+            tree=tree,
+            box_counts=box_counts,
+            eval_multipoles_by_source_level=eval_multipoles_by_source_level)
+
+# }}}
+
+
+# {{{ cost model
+
+def _default_ncoeffs(dimensions, order):
+    if dimensions == 2:
+        return 2*order + 1
+    elif dimensions == 3:
+        return (order + 1)**2
+    else:
+        raise ValueError("unsupported dimensionality: %d" % dimensions)
+
+
+class FMMCostModel(object):
+    """Turns :class:`FMMWorkCounts` into cost estimates.
+
+    The cost of a stage for a box is the work count of that box, multiplied
+    by a factor accounting for the number of expansion coefficients involved
+    (see below), multiplied by the calibration constant for that stage.
+
+    Order factors are, with *c(l)* the number of coefficients in an expansion
+    on level *l* (of the box the work is attributed to):
+
+    - ``form_multipoles``, ``eval_locals``, ``form_locals``: *c(l)*
+    - ``eval_multipoles``: *c* on the level of the source box
+    - ``coarsen_multipoles``: *c(l) c(l+1)*
+    - ``multipole_to_local``: *c(l)**2*
+    - ``refine_locals``: *c(l-1) c(l)*
+    - ``eval_direct``: 1
+
+    .. attribute:: calibration_params
+
+        A dictionary mapping entries of :data:`FMM_STAGES` to the cost of one
+        (order-weighted) unit of work in that stage. Missing stages default
+        to 1.
+
+    .. automethod:: __init__
+    .. automethod:: with_calibration_params
+    .. automethod:: get_weighted_box_counts
+    .. automethod:: get_box_costs
+    .. automethod:: get_level_costs
+    .. automethod:: get_stage_costs
+    .. automethod:: predict_time
+    .. automethod:: get_close_list_thresholds
+    """
+
+    def __init__(self, calibration_params=None, level_to_order=None,
+            ncoeffs=None):
+        """
+        :arg calibration_params: see :attr:`calibration_params`.
+        :arg level_to_order: a callable taking arguments *(tree, level)* and
+            returning the expansion order used on *level*, with the same
+            interface as the *fmm_level_to_nterms* argument of
+            :class:`boxtree.pyfmmlib_integration.FMMLibExpansionWrangler`.
+            If *None*, all order factors are 1, i.e. costs are proportional to
+            raw work counts.
+        :arg ncoeffs: a callable taking arguments *(dimensions, order)* and
+            returning the number of coefficients of an expansion. Defaults to
+            *2p+1* in 2D and *(p+1)**2* in 3D.
+        """
+        if calibration_params is None:
+            calibration_params = {}
+        if ncoeffs is None:
+            ncoeffs = _default_ncoeffs
+
+        self.calibration_params = calibration_params
+        self.level_to_order = level_to_order
+        self.ncoeffs = ncoeffs
+
+    def with_calibration_params(self, calibration_params):
+        """Return a copy of *self* with :attr:`calibration_params` replaced."""
+        return type(self)(
+                calibration_params=calibration_params,
+                level_to_order=self.level_to_order,
+                ncoeffs=self.ncoeffs)
+
+    def _get_level_ncoeffs(self, tree):
+        if self.level_to_order is None:
+            return np.ones(tree.nlevels, dtype=np.float64)
+
+        return np.array([
+            self.ncoeffs(tree.dimensions, self.level_to_order(tree, lev))
+            for lev in range(tree.nlevels)], dtype=np.float64)
+
+    def get_weighted_box_counts(self, work):
+        """
+        :arg work: a :class:`FMMWorkCounts`
+        :returns: a dictionary mapping each entry of :data:`FMM_STAGES` to a
+            floating point array of shape ``[nboxes]`` containing the work
+            counts of *work*, multiplied by the order factors.
+        """
+        tree = work.tree
+        c = self._get_level_ncoeffs(tree)
+        box_levels = tree.box_levels
+
+        # c(l+1) and c(l-1), extended by c(l) at the ends where they don't
+        # matter
+        c_next = np.concatenate([c[1:], c[-1:]])
+        c_prev = np.concatenate([c[:1], c[:-1]])
+
+        level_factors = {
+                "form_multipoles": c,
+                "coarsen_multipoles": c * c_next,
+                "eval_direct": np.ones_like(c),
+                "multipole_to_local": c**2,
+                "form_locals": c,
+                "refine_locals": c_prev * c,
+                "eval_locals": c,
+                }
+
+        result = {}
+        for stage in FMM_STAGES:
+            if stage == "eval_multipoles":
+                result[stage] = sum(
+                        (c[src_lev] * lev_counts
+                            for src_lev, lev_counts in enumerate(
+                                work.eval_multipoles_by_source_level)),
+                        np.zeros(tree.nboxes, dtype=np.float64))
+            else:
+                result[stage] = (
+                        level_factors[stage][box_levels]
+                        * work.box_counts[stage])
+
+        return result
+
+    def get_stage_costs(self, work):
+        """
+        :arg work: a :class:`FMMWorkCounts`
+        :returns: a dictionary mapping each entry of :data:`FMM_STAGES` to a
+            floating point array of shape ``[nboxes]`` containing the cost
+            of each box in that stage.
+        """
+        weighted = self.get_weighted_box_counts(work)
+        return dict(
+                (stage, self.calibration_params.get(stage, 1) * weighted[stage])
+                for stage in FMM_STAGES)
+
+    def get_box_costs(self, work, stages=None):
+        """
+        :arg work: a :class:`FMMWorkCounts`
+        :arg stages: a list of entries of :data:`FMM_STAGES` to include. If
+            *None*, all stages are included.
+        :returns: a floating point array of shape ``[nboxes]`` containing the
+            total cost attributed to each box.
+        """
+        if stages is None:
+            stages = FMM_STAGES
+
+        stage_costs = self.get_stage_costs(work)
+        return sum(
+                (stage_costs[stage] for stage in stages),
+                np.zeros(work.tree.nboxes, dtype=np.float64))
+
+    def get_level_costs(self, work):
+        """
+        :arg work: a :class:`FMMWorkCounts`
+        :returns: a dictionary mapping each entry of :data:`FMM_STAGES` to an
+            array of shape ``[nlevels]`` containing the cost of that stage on
+            each level.
+        """
+        tree = work.tree
+        return dict(
+                (stage, np.bincount(
+                    tree.box_levels, weights=box_costs,
+                    minlength=tree.nlevels))
+                for stage, box_costs in six.iteritems(
+                    self.get_stage_costs(work)))
+
+    def predict_time(self, work):
+        """Return the predicted total cost of the FMM described by *work*.
+        If the calibration parameters were obtained from
+        :func:`calibrate_cost_model`, this is in seconds.
+        """
+        return sum(
+                np.sum(box_costs)
+                for box_costs in six.itervalues(self.get_stage_costs(work)))
+
+    def get_close_list_thresholds(self, tree):
+        """Compare the cost of a List 3 or List 4 interaction through an
+        expansion with that of direct evaluation (``eval_direct``).
+
+        The cost of ``eval_multipoles`` for a List 3 box on level *l* is
+        proportional to *c(l)*, that of direct evaluation to the number of
+        sources in and below that box. Likewise, the cost of ``form_locals``
+        for a List 4 interaction with a target (or target parent) box on
+        level *l* is proportional to *c(l)*, that of direct evaluation to the
+        number of targets in and below that box.
+
+        :returns: a tuple *(min_nsources_cumul, min_ntargets_cumul)* of
+            integer arrays of shape ``[nlevels]``. List 3 boxes on level *l*
+            with fewer than ``min_nsources_cumul[l]`` sources, and List 4
+            interactions of target boxes on level *l* with fewer than
+            ``min_ntargets_cumul[l]`` targets, are cheaper to evaluate
+            directly. These are used by
+            :meth:`boxtree.traversal.FMMTraversalBuilder.__call__` if the
+            cost model is passed as its *cost_model* argument.
+        """
+        c = self._get_level_ncoeffs(tree)
+        direct_cost = self.calibration_params.get("eval_direct", 1)
+
+        def get_thresholds(stage):
+            return np.ceil(
+                    c * self.calibration_params.get(stage, 1) / direct_cost
+                    ).astype(tree.particle_id_dtype)
+
+        return (
+                get_thresholds("eval_multipoles"),
+                get_thresholds("form_locals"))
+
+# }}}
+
+
+# {{{ calibration
+
+def calibrate_cost_model(cost_model, works, timings):
+    """Fit the calibration constants of *cost_model* to observed stage
+    timings. For each stage, the constant is found by a least-squares fit of
+    the observed times to the order-weighted work counts, across all runs.
+
+    :arg cost_model: an :class:`FMMCostModel` whose order factors should be
+        used. Its calibration parameters are ignored.
+    :arg works: a list of :class:`FMMWorkCounts`, one per timed run
+    :arg timings: a list of the same length as *works*, each entry a
+        dictionary mapping (some) entries of :data:`FMM_STAGES` to the
+        observed time of that stage, as returned by :func:`time_fmm_stages`.
+    :returns: a new :class:`FMMCostModel` with fitted
+        :attr:`FMMCostModel.calibration_params`.
+    """
+    if len(works) != len(timings):
+        raise ValueError("works and timings must have the same length")
+
+    uncalibrated_model = cost_model.with_calibration_params({})
+
+    weighted_totals = [
+            dict(
+                (stage, np.sum(box_counts))
+                for stage, box_counts in six.iteritems(
+                    uncalibrated_model.get_weighted_box_counts(work)))
+            for work in works]
+
+    calibration_params = {}
+    for stage in FMM_STAGES:
+        x = []
+        t = []
+        for wt, timing in zip(weighted_totals, timings):
+            if stage in timing:
+                x.append(wt[stage])
+                t.append(timing[stage])
+
+        x = np.array(x, dtype=np.float64)
+        t = np.array(t, dtype=np.float64)
+
+        xx = np.dot(x, x)
+        if xx == 0:
+            continue
+
+        calibration_params[stage] = np.dot(x, t) / xx
+
+    logger.info("calibrated cost model: %s", calibration_params)
+
+    return cost_model.with_calibration_params(calibration_params)
+
+
+def time_fmm_stages(traversal, expansion_wrangler, src_weights):
+    """Run :func:`boxtree.fmm.drive_fmm` while recording the wall time spent
+    in each stage.
+
+    Note that the time recorded is that spent in the methods of
+    *expansion_wrangler*. For wranglers that work asynchronously (e.g. on an
+    OpenCL device), this may not reflect the actual cost of the stage.
+
+    :returns: a tuple *(potentials, timings)*, where *timings* is a
+        dictionary mapping entries of :data:`FMM_STAGES` to the time (in
+        seconds) spent in each. See also the *return_timing* argument of
+        :func:`boxtree.fmm.drive_fmm`, which provides more detail.
+    """
+    from boxtree.fmm import drive_fmm
+    potentials, timing_record = drive_fmm(
+            traversal, expansion_wrangler, src_weights, return_timing=True)
+
+    timings = dict(
+            (stage, timing.wall_elapsed)
+            for stage, timing in six.iteritems(timing_record.stages)
+            if stage in FMM_STAGES)
+
+    return potentials, timings
+
+# }}}
+
+# vim: filetype=pyopencl:fdm=marker
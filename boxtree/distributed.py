@@ -0,0 +1,835 @@
+from __future__ import division
+
+__copyright__ = "Copyright (C) 2018 Andreas Kloeckner"
+
+__license__ = """
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+from six.moves import range, zip
+
+import numpy as np
+from pytools import Record
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+__doc__ = """
+Support for distributed FMMs
+----------------------------
+
+The routines in this module operate on host-resident trees and traversals
+(see :meth:`boxtree.traversal.FMMTraversalInfo.get`).
+
+Partitioning target boxes
+^^^^^^^^^^^^^^^^^^^^^^^^^
+
+.. autofunction:: get_box_morton_order
+
+.. autofunction:: partition_target_boxes
+
+.. autoclass:: TargetBoxPartition()
+
+.. autoclass:: TargetBoxPartitioning()
+
+Local essential trees
+^^^^^^^^^^^^^^^^^^^^^
+
+.. autofunction:: get_local_essential_tree
+
+.. autoclass:: LocalEssentialTree()
+"""
+
+
+# {{{ helpers
+
+def _expand_ranges(starts, lengths):
+    """Return the concatenation of ``arange(start, start+length)`` for all
+    entries of *starts* and *lengths*.
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+
+    ntotal = int(np.sum(lengths))
+    offsets = np.cumsum(lengths) - lengths
+    return (
+            np.repeat(starts - offsets, lengths)
+            + np.arange(ntotal, dtype=np.int64))
+
+
+def _gather_csr_entries(starts, lists, rows):
+    """Return the concatenation of the lists numbered *rows* in the CSR
+    structure given by *starts* and *lists*.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    row_starts = starts[rows].astype(np.int64)
+    return lists[_expand_ranges(
+        row_starts, starts[rows + 1].astype(np.int64) - row_starts)]
+
+
+def _get_box_to_index(boxes, nboxes):
+    """Return an array mapping global box numbers to their index in *boxes*,
+    or -1 if they do not occur.
+    """
+    result = np.empty(nboxes, dtype=np.int64)
+    result.fill(-1)
+    result[boxes] = np.arange(len(boxes))
+    return result
+
+
+def _get_ancestor_closure(tree, boxes):
+    """Return a boolean mask of shape ``[nboxes]`` marking *boxes* and all
+    their ancestors.
+    """
+    mask = np.zeros(tree.nboxes, dtype=bool)
+    current = np.unique(boxes)
+    while len(current):
+        mask[current] = True
+        current = np.unique(tree.box_parent_ids[current[current != 0]])
+        current = current[~mask[current]]
+
+    return mask
+
+
+def _get_subtree_closure(tree, boxes):
+    """Return a boolean mask of shape ``[nboxes]`` marking *boxes* and all
+    their descendants.
+    """
+    nboxes = tree.nboxes
+    child_ids = tree.box_child_ids[:, :nboxes]
+
+    mask = np.zeros(nboxes, dtype=bool)
+    mask[boxes] = True
+
+    for level in range(tree.nlevels - 1):
+        start, stop = tree.level_start_box_nrs[level:level+2]
+        lev_child_ids = child_ids[:, start:stop][:, mask[start:stop]]
+        mask[lev_child_ids[lev_child_ids != 0]] = True
+
+    return mask
+
+# }}}
+
+
+# {{{ partitioning
+
+def _get_box_morton_order_and_subtree_sizes(tree):
+    nboxes = tree.nboxes
+    child_ids = tree.box_child_ids[:, :nboxes]
+    has_child = child_ids != 0
+    level_start_box_nrs = tree.level_start_box_nrs
+
+    # {{{ subtree sizes, bottom-up
+
+    subtree_sizes = np.ones(nboxes, dtype=np.int64)
+    for level in range(tree.nlevels - 1, -1, -1):
+        start, stop = level_start_box_nrs[level:level+2]
+        lev_child_ids = child_ids[:, start:stop]
+        subtree_sizes[start:stop] += np.sum(
+                np.where(has_child[:, start:stop],
+                    subtree_sizes[lev_child_ids], 0),
+                axis=0)
+
+    # }}}
+
+    # {{{ positions, top-down
+
+    positions = np.zeros(nboxes, dtype=np.int64)
+    for level in range(tree.nlevels - 1):
+        start, stop = level_start_box_nrs[level:level+2]
+        lev_child_ids = child_ids[:, start:stop]
+        lev_has_child = has_child[:, start:stop]
+
+        child_sizes = np.where(lev_has_child, subtree_sizes[lev_child_ids], 0)
+        preceding_sizes = np.cumsum(child_sizes, axis=0) - child_sizes
+
+        child_positions = positions[start:stop] + 1 + preceding_sizes
+        positions[lev_child_ids[lev_has_child]] = child_positions[lev_has_child]
+
+    # }}}
+
+    return positions, subtree_sizes
+
+
+def get_box_morton_order(tree):
+    """Return an array of shape ``[nboxes]`` containing the position of each
+    box in a depth-first (pre-order) traversal of *tree*, in which children
+    are visited in the order in which they occur in
+    :attr:`boxtree.Tree.box_child_ids`, i.e. in Morton order. Boxes whose
+    positions are consecutive are therefore spatially close.
+    """
+    positions, _ = _get_box_morton_order_and_subtree_sizes(tree)
+    return positions
+
+
+def _push_costs_to_target_boxes(traversal, box_costs, positions, subtree_sizes,
+        morton_sorted_target_boxes):
+    """Return an array of the same length as *morton_sorted_target_boxes*
+    containing the cost of each target box plus its share of the cost of all
+    other boxes. The cost of a box that is not a target box is split evenly
+    among the target boxes in its subtree. If there are none (e.g. for boxes
+    with only sources), it is charged to the next target box in Morton order.
+    """
+    nboxes = traversal.tree.nboxes
+    ntarget_boxes = len(morton_sorted_target_boxes)
+
+    box_costs = np.asarray(box_costs, dtype=np.float64)
+    result = box_costs[morton_sorted_target_boxes].copy()
+
+    is_target_box = np.zeros(nboxes, dtype=bool)
+    is_target_box[morton_sorted_target_boxes] = True
+    other_boxes = np.nonzero(~is_target_box & (box_costs != 0))[0]
+
+    target_positions = positions[morton_sorted_target_boxes]
+    lo = np.searchsorted(target_positions, positions[other_boxes])
+    hi = np.searchsorted(
+            target_positions,
+            positions[other_boxes] + subtree_sizes[other_boxes])
+
+    # {{{ boxes with target boxes beneath them: spread over the subtree
+
+    spread = hi > lo
+    spread_costs = box_costs[other_boxes[spread]] / (hi - lo)[spread]
+
+    cost_increments = np.zeros(ntarget_boxes + 1, dtype=np.float64)
+    np.add.at(cost_increments, lo[spread], spread_costs)
+    np.add.at(cost_increments, hi[spread], -spread_costs)
+    result += np.cumsum(cost_increments)[:-1]
+
+    # }}}
+
+    # {{{ other boxes: charge to the next target box
+
+    np.add.at(
+            result,
+            np.minimum(lo[~spread], ntarget_boxes - 1),
+            box_costs[other_boxes[~spread]])
+
+    # }}}
+
+    return result
+
+
+class TargetBoxPartition(Record):
+    """The part of an FMM computed by one partition. All box numbers are
+    global.
+
+    .. attribute:: target_boxes
+
+        The target boxes owned by this partition, in Morton order.
+
+    .. attribute:: target_or_target_parent_boxes
+
+        The owned target boxes along with all their ancestors that are in
+        :attr:`boxtree.traversal.FMMTraversalInfo.target_or_target_parent_boxes`,
+        i.e. the boxes whose local expansions this partition needs. Sorted.
+
+    .. attribute:: direct_source_boxes
+
+        Source boxes whose particles are needed, i.e. the source boxes in
+        List 1, List 4 and the "close" lists of the boxes above. Sorted.
+
+    .. attribute:: multipole_source_boxes
+
+        Boxes whose multipole expansions are needed, i.e. the boxes in List 2
+        and List 3 of the boxes above. Sorted.
+
+    .. attribute:: cost
+
+        The sum of the costs of :attr:`target_boxes`, including the costs
+        pushed down onto them (see :func:`partition_target_boxes`).
+    """
+
+
+class TargetBoxPartitioning(Record):
+    """
+    .. attribute:: nparts
+
+    .. attribute:: target_box_to_part
+
+        An integer array of the same length as
+        :attr:`boxtree.traversal.FMMTraversalInfo.target_boxes`, containing
+        the number of the partition that owns each target box.
+
+    .. attribute:: parts
+
+        A list of :attr:`nparts` instances of :class:`TargetBoxPartition`.
+
+    .. attribute:: part_costs
+
+        An array of shape ``[nparts]`` containing the cost of each partition.
+
+    .. attribute:: load_imbalance
+
+        The ratio of the largest partition cost to the mean partition cost.
+        1 indicates perfect balance.
+    """
+
+
+def _get_needed_source_boxes(traversal, target_boxes):
+    tree = traversal.tree
+    nboxes = tree.nboxes
+
+    target_box_to_index = _get_box_to_index(traversal.target_boxes, nboxes)
+    ttp_box_to_index = _get_box_to_index(
+            traversal.target_or_target_parent_boxes, nboxes)
+
+    ancestor_mask = _get_ancestor_closure(tree, target_boxes)
+    ttp_boxes = np.nonzero(ancestor_mask & (ttp_box_to_index >= 0))[0]
+
+    tgt_rows = target_box_to_index[target_boxes]
+    ttp_rows = ttp_box_to_index[ttp_boxes]
+
+    direct = [
+            _gather_csr_entries(
+                traversal.neighbor_source_boxes_starts,
+                traversal.neighbor_source_boxes_lists,
+                tgt_rows),
+            _gather_csr_entries(
+                traversal.from_sep_bigger_starts,
+                traversal.from_sep_bigger_lists,
+                ttp_rows),
+            ]
+
+    if traversal.from_sep_close_smaller_starts is not None:
+        direct.append(_gather_csr_entries(
+            traversal.from_sep_close_smaller_starts,
+            traversal.from_sep_close_smaller_lists,
+            tgt_rows))
+
+    if traversal.from_sep_close_bigger_starts is not None:
+        direct.append(_gather_csr_entries(
+            traversal.from_sep_close_bigger_starts,
+            traversal.from_sep_close_bigger_lists,
+            ttp_rows))
+
+    multipole = [
+            _gather_csr_entries(
+                traversal.from_sep_siblings_starts,
+                traversal.from_sep_siblings_lists,
+                ttp_rows),
+            ]
+
+    target_box_mask = np.zeros(nboxes, dtype=bool)
+    target_box_mask[target_boxes] = True
+
+    for lev_boxes, lev_list in zip(
+            traversal.target_boxes_sep_smaller_by_source_level,
+            traversal.from_sep_smaller_by_level):
+        multipole.append(_gather_csr_entries(
+            lev_list.starts, lev_list.lists,
+            np.nonzero(target_box_mask[lev_boxes])[0]))
+
+    return (
+            ttp_boxes.astype(tree.box_id_dtype),
+            np.unique(np.concatenate(direct)).astype(tree.box_id_dtype),
+            np.unique(np.concatenate(multipole)).astype(tree.box_id_dtype))
+
+
+def partition_target_boxes(traversal, nparts, box_costs=None):
+    """Split :attr:`boxtree.traversal.FMMTraversalInfo.target_boxes` into
+    *nparts* partitions of (approximately) equal cost. Each partition is a
+    contiguous chunk of the target boxes in the order given by
+    :func:`get_box_morton_order`, so that partitions are spatially compact.
+
+    :arg traversal: a host-resident
+        :class:`boxtree.traversal.FMMTraversalInfo`
+    :arg box_costs: an array of shape ``[nboxes]`` containing the cost of each
+        box, e.g. as obtained from
+        :meth:`boxtree.cost.FMMCostModel.get_box_costs`. If *None*, the costs
+        are obtained from :func:`boxtree.cost.count_fmm_work`, using a default
+        :class:`boxtree.cost.FMMCostModel`.
+    :returns: a :class:`TargetBoxPartitioning`
+
+    Work attributed to boxes that are not target boxes (e.g. translations on
+    parent boxes, or multipole formation on boxes with only sources) is
+    pushed down onto the target boxes: the cost of such a box is split evenly
+    among the target boxes in its subtree or, if there are none, charged to
+    the next target box in Morton order. The partition costs therefore add up
+    to the total cost of the FMM.
+    """
+    tree = traversal.tree
+
+    if box_costs is None:
+        from boxtree.cost import count_fmm_work, FMMCostModel
+        box_costs = FMMCostModel().get_box_costs(count_fmm_work(traversal))
+
+    positions, subtree_sizes = _get_box_morton_order_and_subtree_sizes(tree)
+
+    target_boxes = traversal.target_boxes
+    morton_order = np.argsort(positions[target_boxes], kind="mergesort")
+    sorted_costs = _push_costs_to_target_boxes(
+            traversal, box_costs, positions, subtree_sizes,
+            target_boxes[morton_order])
+
+    total_cost = np.sum(sorted_costs)
+    if total_cost > 0:
+        # Assign each box to the partition that contains the midpoint of its
+        # cost interval. This is monotonic in Morton order, so that
+        # partitions are contiguous.
+        cost_midpoints = np.cumsum(sorted_costs) - sorted_costs / 2
+        sorted_parts = np.floor(cost_midpoints / (total_cost / nparts))
+    else:
+        sorted_parts = np.floor(
+                np.arange(len(target_boxes)) * nparts / len(target_boxes))
+
+    sorted_parts = np.minimum(sorted_parts, nparts - 1).astype(np.int32)
+
+    target_box_to_part = np.empty(len(target_boxes), dtype=np.int32)
+    target_box_to_part[morton_order] = sorted_parts
+
+    part_costs = np.bincount(
+            sorted_parts, weights=sorted_costs, minlength=nparts)
+
+    parts = []
+    for ipart in range(nparts):
+        part_target_boxes = target_boxes[morton_order[sorted_parts == ipart]]
+
+        ttp_boxes, direct_source_boxes, multipole_source_boxes = \
+                _get_needed_source_boxes(traversal, part_target_boxes)
+
+        parts.append(TargetBoxPartition(
+            target_boxes=part_target_boxes,
+            target_or_target_parent_boxes=ttp_boxes,
+            direct_source_boxes=direct_source_boxes,
+            multipole_source_boxes=multipole_source_boxes,
+            cost=part_costs[ipart]))
+
+    mean_cost = np.mean(part_costs)
+    if mean_cost > 0:
+        load_imbalance = np.max(part_costs) / mean_cost
+    else:
+        load_imbalance = 1
+
+    logger.info("partitioned %d target boxes into %d parts, "
+            "load imbalance %g", len(target_boxes), nparts, load_imbalance)
+
+    return TargetBoxPartitioning(
+            nparts=nparts,
+            target_box_to_part=target_box_to_part,
+            parts=parts,
+            part_costs=part_costs,
+            load_imbalance=load_imbalance)
+
+# }}}
+
+
+# {{{ local essential tree
+
+class LocalEssentialTree(Record):
+    """The part of a global tree and traversal needed to evaluate the
+    potential at the targets in a given set of target boxes. See
+    :func:`get_local_essential_tree`.
+
+    .. attribute:: tree
+
+        A host-resident :class:`boxtree.Tree` containing only the needed
+        boxes and particles, numbered locally.
+        :attr:`boxtree.Tree.sources_are_targets` is always *False*. User
+        order and tree order of the particles coincide, i.e.
+        :attr:`boxtree.Tree.user_source_ids` and
+        :attr:`boxtree.Tree.sorted_target_ids` are identity maps.
+
+    .. attribute:: traversal
+
+        A host-resident :class:`boxtree.traversal.FMMTraversalInfo` for
+        :attr:`tree`, containing those parts of the global interaction lists
+        that are needed by the owned target boxes, in local numbering.
+
+    .. attribute:: box_to_global_box
+
+        An array of shape ``[nboxes]`` (local) mapping local box numbers to
+        global ones.
+
+    .. attribute:: source_to_global_user_source
+
+        An array mapping local source numbers to source numbers in the
+        global user order.
+
+    .. attribute:: target_to_global_user_target
+
+        An array mapping local target numbers to target numbers in the
+        global user order.
+    """
+
+
+def _remap_csr(starts, lists, rows, global_to_local, box_id_dtype):
+    """Extract the lists numbered *rows* from a CSR structure of global box
+    numbers, renumber their entries using *global_to_local* and drop entries
+    that are not present locally.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    row_starts = starts[rows].astype(np.int64)
+    lengths = starts[rows + 1].astype(np.int64) - row_starts
+
+    entries = global_to_local[lists[_expand_ranges(row_starts, lengths)]]
+    keep = entries >= 0
+
+    new_lengths = np.bincount(
+            np.repeat(np.arange(len(rows)), lengths)[keep],
+            minlength=len(rows))
+
+    new_starts = np.zeros(len(rows) + 1, dtype=box_id_dtype)
+    np.cumsum(new_lengths, out=new_starts[1:])
+
+    return new_starts, entries[keep].astype(box_id_dtype)
+
+
+def _get_level_starts(box_levels, boxes, nlevels, dtype):
+    result = np.zeros(nlevels + 1, dtype=dtype)
+    np.cumsum(
+            np.bincount(box_levels[boxes], minlength=nlevels),
+            out=result[1:])
+    return result
+
+
+def _select_particles(box_starts, box_counts_nonchild, box_counts_cumul,
+        selected_boxes, box_to_global_box, nparticles):
+    """Select the (non-child) particles of *selected_boxes*, preserving tree
+    order. Return the selected particle numbers and the local versions of
+    the box particle arrays.
+    """
+    selected_boxes = selected_boxes[box_counts_nonchild[selected_boxes] > 0]
+
+    particle_ids = np.sort(_expand_ranges(
+            box_starts[selected_boxes], box_counts_nonchild[selected_boxes]))
+
+    # number of selected particles preceding each global particle number
+    particle_prefix = np.zeros(nparticles + 1, dtype=np.int64)
+    particle_prefix[particle_ids + 1] = 1
+    particle_prefix = np.cumsum(particle_prefix)
+
+    starts = box_starts[box_to_global_box]
+    cumul_stops = starts + box_counts_cumul[box_to_global_box]
+
+    is_selected = np.zeros(len(box_starts), dtype=bool)
+    is_selected[selected_boxes] = True
+
+    particle_dtype = box_starts.dtype
+    local_starts = particle_prefix[starts].astype(particle_dtype)
+    local_counts_cumul = (
+            particle_prefix[cumul_stops]
+            - particle_prefix[starts]).astype(particle_dtype)
+    local_counts_nonchild = np.where(
+            is_selected[box_to_global_box],
+            box_counts_nonchild[box_to_global_box],
+            0).astype(particle_dtype)
+
+    return (particle_ids,
+            local_starts, local_counts_nonchild, local_counts_cumul)
+
+
+def get_local_essential_tree(traversal, target_boxes):
+    """Extract the part of a global tree and traversal needed to evaluate
+    the FMM at the targets in *target_boxes*, e.g. one of the partitions
+    found by :func:`partition_target_boxes`.
+
+    The result contains
+
+    - *target_boxes* and their targets,
+    - the source boxes in List 1, List 4 and the "close" lists of
+      *target_boxes* and their ancestors, along with their sources,
+    - the boxes in List 2 and List 3 of *target_boxes* and their ancestors,
+      along with their entire subtrees and sources, so that their multipole
+      expansions can be formed locally, and
+    - all ancestors of these boxes.
+
+    Boxes are renumbered locally, preserving their relative order (and hence
+    the ordering by level). The interaction lists of the local traversal are
+    those of the global traversal, restricted to the local target boxes and
+    renumbered. Running an FMM with the local tree and traversal therefore
+    yields the same potentials at the local targets as the global FMM.
+
+    :arg traversal: a host-resident
+        :class:`boxtree.traversal.FMMTraversalInfo`
+    :arg target_boxes: an array of global box numbers, a subset of
+        :attr:`boxtree.traversal.FMMTraversalInfo.target_boxes`.
+    :returns: a :class:`LocalEssentialTree`
+    """
+    from pytools.obj_array import make_obj_array
+    from pyopencl.algorithm import BuiltList
+    from boxtree.tree import Tree, box_flags_enum
+
+    tree = traversal.tree
+    nboxes = tree.nboxes
+    nlevels = tree.nlevels
+    box_id_dtype = tree.box_id_dtype
+
+    target_boxes = np.sort(np.asarray(target_boxes, dtype=box_id_dtype))
+
+    ttp_boxes, direct_source_boxes, multipole_source_boxes = \
+            _get_needed_source_boxes(traversal, target_boxes)
+
+    # {{{ find needed boxes, renumber
+
+    source_particle_box_mask = _get_subtree_closure(tree, multipole_source_boxes)
+    source_particle_box_mask[direct_source_boxes] = True
+
+    box_mask = _get_ancestor_closure(
+            tree,
+            np.concatenate([
+                target_boxes,
+                np.nonzero(source_particle_box_mask)[0].astype(box_id_dtype)]))
+
+    box_to_global_box = np.nonzero(box_mask)[0].astype(box_id_dtype)
+    global_box_to_box = _get_box_to_index(box_to_global_box, nboxes)
+    local_nboxes = len(box_to_global_box)
+
+    def to_local(global_boxes):
+        return global_box_to_box[global_boxes].astype(box_id_dtype)
+
+    # }}}
+
+    # {{{ select particles
+
+    (source_ids,
+            box_source_starts, box_source_counts_nonchild,
+            box_source_counts_cumul) = _select_particles(
+                    tree.box_source_starts, tree.box_source_counts_nonchild,
+                    tree.box_source_counts_cumul,
+                    np.nonzero(source_particle_box_mask)[0],
+                    box_to_global_box, tree.nsources)
+
+    (target_ids,
+            box_target_starts, box_target_counts_nonchild,
+            box_target_counts_cumul) = _select_particles(
+                    tree.box_target_starts, tree.box_target_counts_nonchild,
+                    tree.box_target_counts_cumul,
+                    target_boxes,
+                    box_to_global_box, tree.ntargets)
+
+    # tree order -> global user order
+    global_target_user_ids = np.empty(tree.ntargets, dtype=np.int64)
+    global_target_user_ids[tree.sorted_target_ids] = np.arange(tree.ntargets)
+
+    source_to_global_user_source = tree.user_source_ids[source_ids]
+    target_to_global_user_target = global_target_user_ids[target_ids]
+
+    # }}}
+
+    # {{{ build local tree
+
+    box_flags = np.zeros(local_nboxes, dtype=box_flags_enum.dtype)
+    box_flags[box_source_counts_nonchild > 0] |= box_flags_enum.HAS_OWN_SOURCES
+    box_flags[box_source_counts_cumul > box_source_counts_nonchild] |= \
+            box_flags_enum.HAS_CHILD_SOURCES
+    box_flags[box_target_counts_nonchild > 0] |= box_flags_enum.HAS_OWN_TARGETS
+    box_flags[box_target_counts_cumul > box_target_counts_nonchild] |= \
+            box_flags_enum.HAS_CHILD_TARGETS
+
+    global_child_ids = tree.box_child_ids[:, box_to_global_box]
+    box_child_ids = np.where(
+            global_child_ids != 0,
+            global_box_to_box[global_child_ids],
+            -1)
+    box_child_ids = np.where(box_child_ids >= 0, box_child_ids, 0).astype(
+            box_id_dtype)
+
+    box_levels = tree.box_levels[box_to_global_box]
+    level_start_box_nrs = _get_level_starts(
+            box_levels, np.arange(local_nboxes), nlevels,
+            tree.level_start_box_nrs.dtype)
+
+    extra_tree_attrs = {}
+    if tree.sources_have_extent:
+        extra_tree_attrs["source_radii"] = tree.source_radii[source_ids]
+    if tree.targets_have_extent:
+        extra_tree_attrs["target_radii"] = tree.target_radii[target_ids]
+
+    local_tree = Tree(
+            sources_are_targets=False,
+            sources_have_extent=tree.sources_have_extent,
+            targets_have_extent=tree.targets_have_extent,
+
+            particle_id_dtype=tree.particle_id_dtype,
+            box_id_dtype=box_id_dtype,
+            coord_dtype=tree.coord_dtype,
+            box_level_dtype=tree.box_level_dtype,
+
+            root_extent=tree.root_extent,
+            stick_out_factor=tree.stick_out_factor,
+            extent_norm=tree.extent_norm,
+
+            bounding_box=tree.bounding_box,
+            level_start_box_nrs=level_start_box_nrs,
+            level_start_box_nrs_dev=level_start_box_nrs.copy(),
+
+            sources=make_obj_array([
+                coord[source_ids] for coord in tree.sources]),
+            targets=make_obj_array([
+                coord[target_ids] for coord in tree.targets]),
+
+            box_source_starts=box_source_starts,
+            box_source_counts_nonchild=box_source_counts_nonchild,
+            box_source_counts_cumul=box_source_counts_cumul,
+            box_target_starts=box_target_starts,
+            box_target_counts_nonchild=box_target_counts_nonchild,
+            box_target_counts_cumul=box_target_counts_cumul,
+
+            box_parent_ids=to_local(tree.box_parent_ids[box_to_global_box]),
+            box_child_ids=box_child_ids,
+            box_centers=tree.box_centers[:, box_to_global_box],
+            box_levels=box_levels,
+            box_flags=box_flags,
+
+            user_source_ids=np.arange(
+                len(source_ids), dtype=tree.particle_id_dtype),
+            sorted_target_ids=np.arange(
+                len(target_ids), dtype=tree.particle_id_dtype),
+
+            _is_pruned=tree._is_pruned,
+
+            **extra_tree_attrs)
+
+    # }}}
+
+    # {{{ build local traversal
+
+    global_source_box_mask = np.zeros(nboxes, dtype=bool)
+    global_source_box_mask[traversal.source_boxes] = True
+    source_boxes = to_local(np.nonzero(
+        global_source_box_mask & source_particle_box_mask)[0])
+
+    source_parent_boxes = np.nonzero(
+            box_flags & box_flags_enum.HAS_CHILD_SOURCES)[0].astype(
+                    box_id_dtype)
+
+    local_target_boxes = to_local(target_boxes)
+    target_or_target_parent_boxes = to_local(ttp_boxes)
+
+    global_target_box_to_index = _get_box_to_index(
+            traversal.target_boxes, nboxes)
+    global_ttp_box_to_index = _get_box_to_index(
+            traversal.target_or_target_parent_boxes, nboxes)
+
+    target_rows = global_target_box_to_index[target_boxes]
+    ttp_rows = global_ttp_box_to_index[ttp_boxes]
+
+    def remap(what, rows):
+        starts = getattr(traversal, what + "_starts")
+        if starts is None:
+            return None, None
+
+        return _remap_csr(
+                starts, getattr(traversal, what + "_lists"), rows,
+                global_box_to_box, box_id_dtype)
+
+    level_start_dtype = traversal.level_start_source_box_nrs.dtype
+
+    lists = {}
+    for what, rows in [
+            ("same_level_non_well_sep_boxes", box_to_global_box),
+            ("neighbor_source_boxes", target_rows),
+            ("from_sep_siblings", ttp_rows),
+            ("from_sep_close_smaller", target_rows),
+            ("from_sep_bigger", ttp_rows),
+            ("from_sep_close_bigger", ttp_rows),
+            ]:
+        lists[what + "_starts"], lists[what + "_lists"] = remap(what, rows)
+
+    if traversal.colleagues_starts is not None:
+        lists["colleagues_starts"] = lists["same_level_non_well_sep_boxes_starts"]
+        lists["colleagues_lists"] = lists["same_level_non_well_sep_boxes_lists"]
+    else:
+        lists["colleagues_starts"] = None
+        lists["colleagues_lists"] = None
+
+    local_target_box_to_index = _get_box_to_index(
+            local_target_boxes, local_nboxes)
+
+    is_local_target_box = np.zeros(nboxes, dtype=bool)
+    is_local_target_box[target_boxes] = True
+
+    target_boxes_sep_smaller_by_source_level = []
+    from_sep_smaller_by_level = []
+    for lev_boxes, lev_list in zip(
+            traversal.target_boxes_sep_smaller_by_source_level,
+            traversal.from_sep_smaller_by_level):
+        rows, = np.nonzero(is_local_target_box[lev_boxes])
+        lev_local_boxes = to_local(lev_boxes[rows])
+
+        starts, lev_lists = _remap_csr(
+                lev_list.starts, lev_list.lists, rows,
+                global_box_to_box, box_id_dtype)
+
+        target_boxes_sep_smaller_by_source_level.append(lev_local_boxes)
+        from_sep_smaller_by_level.append(BuiltList(
+            count=len(lev_lists),
+            starts=starts,
+            lists=lev_lists,
+            num_nonempty_lists=len(rows),
+            nonempty_indices=local_target_box_to_index[
+                lev_local_boxes].astype(box_id_dtype)))
+
+    from boxtree.traversal import FMMTraversalInfo
+    local_traversal = FMMTraversalInfo(
+            tree=local_tree,
+            well_sep_is_n_away=traversal.well_sep_is_n_away,
+            level_well_sep_is_n_away=traversal.level_well_sep_is_n_away,
+
+            source_boxes=source_boxes,
+            target_boxes=local_target_boxes,
+
+            level_start_source_box_nrs=_get_level_starts(
+                box_levels, source_boxes, nlevels, level_start_dtype),
+            level_start_target_box_nrs=_get_level_starts(
+                box_levels, local_target_boxes, nlevels, level_start_dtype),
+
+            source_parent_boxes=source_parent_boxes,
+            level_start_source_parent_box_nrs=_get_level_starts(
+                box_levels, source_parent_boxes, nlevels, level_start_dtype),
+
+            target_or_target_parent_boxes=target_or_target_parent_boxes,
+            level_start_target_or_target_parent_box_nrs=_get_level_starts(
+                box_levels, target_or_target_parent_boxes, nlevels,
+                level_start_dtype),
+
+            box_source_bounding_box_min=(
+                traversal.box_source_bounding_box_min[:, box_to_global_box]),
+            box_source_bounding_box_max=(
+                traversal.box_source_bounding_box_max[:, box_to_global_box]),
+            box_target_bounding_box_min=(
+                traversal.box_target_bounding_box_min[:, box_to_global_box]),
+            box_target_bounding_box_max=(
+                traversal.box_target_bounding_box_max[:, box_to_global_box]),
+
+            from_sep_smaller_by_level=from_sep_smaller_by_level,
+            target_boxes_sep_smaller_by_source_level=(
+                target_boxes_sep_smaller_by_source_level),
+
+            **lists)
+
+    # }}}
+
+    logger.info("local essential tree: %d of %d boxes, %d of %d sources, "
+            "%d of %d targets",
+            local_nboxes, nboxes, len(source_ids), tree.nsources,
+            len(target_ids), tree.ntargets)
+
+    return LocalEssentialTree(
+            tree=local_tree,
+            traversal=local_traversal,
+            box_to_global_box=box_to_global_box,
+            source_to_global_user_source=source_to_global_user_source,
+            target_to_global_user_target=target_to_global_user_target)
+
+# }}}
+
+# vim: filetype=pyopencl:fdm=marker
@@ -0,0 +1,546 @@
+from __future__ import division
+
+__copyright__ = "Copyright (C) 2018 Andreas Kloeckner"
+
+__license__ = """
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+from six.moves import range
+
+import numpy as np
+from pytools import Record
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+__doc__ = """
+Dual-tree traversals
+--------------------
+
+When sources and targets are very different point sets, a single tree built
+for their union is refined where either population is dense, producing many
+boxes that contain only sources or only targets. The routines in this module
+instead find the interaction lists between two independently built trees, a
+*source tree* refined for the sources and a *target tree* refined for the
+targets.
+
+Both trees must share their root box, which is achieved by passing the same
+*bbox* to :class:`boxtree.TreeBuilder`::
+
+    bbox = (np.min(all_coords, axis=1), np.max(all_coords, axis=1))
+    source_tree, _ = tb(queue, sources, bbox=bbox, max_particles_in_box=30)
+    target_tree, _ = tb(queue, targets, bbox=bbox, max_particles_in_box=30)
+
+    dual_trav = build_dual_tree_traversal(
+            source_tree.get(queue), target_tree.get(queue))
+    pot = drive_fmm(dual_trav.traversal,
+            SomeExpansionWrangler(dual_trav.tree, ...), weights)
+
+The interaction lists are found by a simultaneous descent of both trees.
+Pairs of non-well-separated boxes are refined by splitting the box on the
+coarser level (or both, if on the same level) until the pair is either
+well-separated or consists of two leaves. Depending on the relative levels
+at which this happens, a well-separated pair ends up in List 2, 3 or 4, and
+a pair of adjacent leaves in List 1.
+
+So that existing expansion wranglers can be used unchanged, the result is
+expressed in terms of a combined :class:`boxtree.Tree` whose boxes are the
+disjoint union of the boxes of both trees. On each level, the boxes of the
+source tree come first, followed by those of the target tree. Boxes from the
+source tree have no targets and boxes from the target tree have no sources.
+
+The routines in this module operate on host-resident trees (see
+:meth:`boxtree.Tree.get`). Particles with extent are not supported.
+
+.. autofunction:: build_dual_tree_traversal
+
+.. autoclass:: DualTreeTraversal()
+"""
+
+
+# {{{ helpers
+
+def _get_box_coords(tree):
+    """Return the integer coordinates of each box on its own level, of shape
+    ``[dimensions, nboxes]``.
+    """
+    nboxes = tree.nboxes
+    box_sizes = tree.root_extent * 0.5**tree.box_levels.astype(np.int64)
+    return np.floor(
+            (tree.box_centers[:, :nboxes] - tree.bounding_box[0][:, np.newaxis])
+            / box_sizes).astype(np.int64)
+
+
+def _are_adjacent(levels_a, coords_a, levels_b, coords_b):
+    """Return whether the boxes given by *levels_a*/*coords_a* and
+    *levels_b*/*coords_b* overlap or touch, elementwise.
+    """
+    level = np.maximum(levels_a, levels_b)
+    shift_a = level - levels_a
+    shift_b = level - levels_b
+
+    lo_a = coords_a << shift_a
+    hi_a = (coords_a + 1) << shift_a
+    lo_b = coords_b << shift_b
+    hi_b = (coords_b + 1) << shift_b
+
+    return np.all((lo_a <= hi_b) & (lo_b <= hi_a), axis=0)
+
+
+def _pairs_to_csr(rows, entries, nrows, box_id_dtype):
+    """Turn a list of *(row, entry)* pairs into a CSR structure with *nrows*
+    rows. Entries of each row are sorted.
+    """
+    order = np.lexsort((entries, rows))
+
+    starts = np.zeros(nrows + 1, dtype=box_id_dtype)
+    np.cumsum(np.bincount(rows, minlength=nrows), out=starts[1:])
+
+    return starts, entries[order].astype(box_id_dtype)
+
+
+def _get_box_map(tree, level_start_box_nrs, offset_in_level):
+    """Return an array mapping box numbers in *tree* to box numbers in a
+    combined numbering with *level_start_box_nrs*, in which the boxes of each
+    level of *tree* start *offset_in_level[level]* boxes after the level
+    start.
+    """
+    box_levels = tree.box_levels.astype(np.int64)
+    return (
+            np.arange(tree.nboxes)
+            - tree.level_start_box_nrs[box_levels]
+            + level_start_box_nrs[box_levels]
+            + offset_in_level[box_levels]).astype(tree.box_id_dtype)
+
+# }}}
+
+
+class DualTreeTraversal(Record):
+    """Interaction lists between a source tree and a target tree. See
+    :func:`build_dual_tree_traversal`.
+
+    .. attribute:: tree
+
+        A host-resident :class:`boxtree.Tree` whose boxes are the disjoint
+        union of the boxes of :attr:`source_tree` and :attr:`target_tree`.
+        Its sources and their order are those of :attr:`source_tree`, its
+        targets and their order those of :attr:`target_tree`.
+        :attr:`boxtree.Tree.sources_are_targets` is *False*.
+
+    .. attribute:: traversal
+
+        A host-resident :class:`boxtree.traversal.FMMTraversalInfo` for
+        :attr:`tree`. Source boxes (and entries of the interaction lists) are
+        boxes of the source tree, target boxes are boxes of the target tree.
+        Since colleagues are not meaningful across two trees,
+        :attr:`boxtree.traversal.FMMTraversalInfo.same_level_non_well_sep_boxes_starts`
+        and the "close" lists are *None*, as are the box bounding boxes.
+
+    .. attribute:: source_tree
+    .. attribute:: target_tree
+
+    .. attribute:: source_box_to_box
+
+        An array mapping box numbers of :attr:`source_tree` to box numbers in
+        :attr:`tree`.
+
+    .. attribute:: target_box_to_box
+
+        An array mapping box numbers of :attr:`target_tree` to box numbers in
+        :attr:`tree`.
+    """
+
+
+def _build_combined_tree(source_tree, target_tree):
+    from pytools.obj_array import make_obj_array
+    from boxtree.tree import Tree, box_flags_enum
+
+    nlevels = max(source_tree.nlevels, target_tree.nlevels)
+    box_id_dtype = source_tree.box_id_dtype
+    particle_id_dtype = source_tree.particle_id_dtype
+
+    def get_level_nboxes(tree):
+        result = np.zeros(nlevels, dtype=np.int64)
+        result[:tree.nlevels] = np.diff(tree.level_start_box_nrs)
+        return result
+
+    src_level_nboxes = get_level_nboxes(source_tree)
+    tgt_level_nboxes = get_level_nboxes(target_tree)
+
+    level_start_box_nrs = np.zeros(
+            nlevels + 1, dtype=source_tree.level_start_box_nrs.dtype)
+    np.cumsum(src_level_nboxes + tgt_level_nboxes, out=level_start_box_nrs[1:])
+    nboxes = level_start_box_nrs[-1]
+
+    source_box_to_box = _get_box_map(
+            source_tree, level_start_box_nrs, np.zeros(nlevels, np.int64))
+    target_box_to_box = _get_box_map(
+            target_tree, level_start_box_nrs, src_level_nboxes)
+
+    def combine(src_values, tgt_values):
+        result = np.zeros(src_values.shape[:-1] + (nboxes,),
+                dtype=src_values.dtype)
+        result[..., source_box_to_box] = src_values[..., :source_tree.nboxes]
+        result[..., target_box_to_box] = tgt_values[..., :target_tree.nboxes]
+        return result
+
+    def zeros_like_particle_ids(tree):
+        return np.zeros(tree.nboxes, dtype=particle_id_dtype)
+
+    def map_box_ids(box_map, box_ids):
+        # box id 0 marks a nonexistent child, and the root is nobody's child
+        return np.where(box_ids != 0, box_map[box_ids], 0).astype(box_id_dtype)
+
+    source_flags = source_tree.box_flags & (
+            box_flags_enum.HAS_OWN_SOURCES | box_flags_enum.HAS_CHILD_SOURCES)
+    target_flags = target_tree.box_flags & (
+            box_flags_enum.HAS_OWN_TARGETS | box_flags_enum.HAS_CHILD_TARGETS)
+
+    tree = Tree(
+            sources_are_targets=False,
+            sources_have_extent=False,
+            targets_have_extent=False,
+
+            particle_id_dtype=particle_id_dtype,
+            box_id_dtype=box_id_dtype,
+            coord_dtype=source_tree.coord_dtype,
+            box_level_dtype=source_tree.box_level_dtype,
+
+            root_extent=source_tree.root_extent,
+            stick_out_factor=source_tree.stick_out_factor,
+            extent_norm=source_tree.extent_norm,
+
+            bounding_box=source_tree.bounding_box,
+            level_start_box_nrs=level_start_box_nrs,
+            level_start_box_nrs_dev=level_start_box_nrs.copy(),
+
+            sources=make_obj_array([coord for coord in source_tree.sources]),
+            targets=make_obj_array([coord for coord in target_tree.targets]),
+
+            box_source_starts=combine(
+                source_tree.box_source_starts,
+                zeros_like_particle_ids(target_tree)),
+            box_source_counts_nonchild=combine(
+                source_tree.box_source_counts_nonchild,
+                zeros_like_particle_ids(target_tree)),
+            box_source_counts_cumul=combine(
+                source_tree.box_source_counts_cumul,
+                zeros_like_particle_ids(target_tree)),
+            box_target_starts=combine(
+                zeros_like_particle_ids(source_tree),
+                target_tree.box_target_starts),
+            box_target_counts_nonchild=combine(
+                zeros_like_particle_ids(source_tree),
+                target_tree.box_target_counts_nonchild),
+            box_target_counts_cumul=combine(
+                zeros_like_particle_ids(source_tree),
+                target_tree.box_target_counts_cumul),
+
+            box_parent_ids=combine(
+                source_box_to_box[source_tree.box_parent_ids],
+                target_box_to_box[target_tree.box_parent_ids]),
+            box_child_ids=combine(
+                map_box_ids(source_box_to_box, source_tree.box_child_ids),
+                map_box_ids(target_box_to_box, target_tree.box_child_ids)),
+            box_centers=combine(source_tree.box_centers, target_tree.box_centers),
+            box_levels=combine(source_tree.box_levels, target_tree.box_levels),
+            box_flags=combine(source_flags, target_flags),
+
+            user_source_ids=source_tree.user_source_ids,
+            sorted_target_ids=target_tree.sorted_target_ids,
+
+            _is_pruned=True)
+
+    return tree, source_box_to_box, target_box_to_box
+
+
+def _find_interaction_pairs(source_tree, target_tree):
+    """Descend both trees simultaneously. Return a dictionary mapping
+    ``"list1"`` through ``"list4"`` to tuples *(target_boxes, source_boxes)*
+    of box numbers in the respective trees.
+    """
+    src_coords = _get_box_coords(source_tree)
+    tgt_coords = _get_box_coords(target_tree)
+    src_levels = source_tree.box_levels.astype(np.int64)
+    tgt_levels = target_tree.box_levels.astype(np.int64)
+
+    src_child_ids = source_tree.box_child_ids[:, :source_tree.nboxes]
+    tgt_child_ids = target_tree.box_child_ids[:, :target_tree.nboxes]
+    src_is_leaf = np.all(src_child_ids == 0, axis=0)
+    tgt_is_leaf = np.all(tgt_child_ids == 0, axis=0)
+
+    nchildren = 2**source_tree.dimensions
+
+    pairs = dict((which, ([], [])) for which in
+            ["list1", "list2", "list3", "list4"])
+
+    def add_pairs(which, tgt_boxes, src_boxes):
+        pairs[which][0].append(tgt_boxes)
+        pairs[which][1].append(src_boxes)
+
+    # Invariant: pairs in the frontier are not well-separated, and if their
+    # levels differ, the coarser box is a leaf.
+    tgt_frontier = np.zeros(1, dtype=np.int64)
+    src_frontier = np.zeros(1, dtype=np.int64)
+
+    while len(tgt_frontier):
+        tgt_leaf = tgt_is_leaf[tgt_frontier]
+        src_leaf = src_is_leaf[src_frontier]
+        tgt_lev = tgt_levels[tgt_frontier]
+        src_lev = src_levels[src_frontier]
+
+        both_leaves = tgt_leaf & src_leaf
+        add_pairs("list1",
+                tgt_frontier[both_leaves], src_frontier[both_leaves])
+
+        split_tgt = ~tgt_leaf & (src_leaf | (tgt_lev <= src_lev))
+        split_src = ~src_leaf & (tgt_leaf | (src_lev <= tgt_lev))
+
+        split_both = split_tgt & split_src
+        split_src_only = split_src & ~split_tgt
+        split_tgt_only = split_tgt & ~split_src
+
+        # (which list separated pairs go to, target boxes, source boxes)
+        candidates = []
+
+        tgt_children = tgt_child_ids[:, tgt_frontier[split_both]]
+        src_children = src_child_ids[:, src_frontier[split_both]]
+        for i in range(nchildren):
+            for j in range(nchildren):
+                candidates.append(("list2", tgt_children[i], src_children[j]))
+
+        tgt_boxes = tgt_frontier[split_src_only]
+        src_children = src_child_ids[:, src_frontier[split_src_only]]
+        for j in range(nchildren):
+            candidates.append(("list3", tgt_boxes, src_children[j]))
+
+        tgt_children = tgt_child_ids[:, tgt_frontier[split_tgt_only]]
+        src_boxes = src_frontier[split_tgt_only]
+        for i in range(nchildren):
+            candidates.append(("list4", tgt_children[i], src_boxes))
+
+        tgt_frontier_parts = []
+        src_frontier_parts = []
+        for which, tgt_boxes, src_boxes in candidates:
+            exist = (tgt_boxes != 0) & (src_boxes != 0)
+            tgt_boxes = tgt_boxes[exist].astype(np.int64)
+            src_boxes = src_boxes[exist].astype(np.int64)
+
+            adjacent = _are_adjacent(
+                    tgt_levels[tgt_boxes], tgt_coords[:, tgt_boxes],
+                    src_levels[src_boxes], src_coords[:, src_boxes])
+            add_pairs(which, tgt_boxes[~adjacent], src_boxes[~adjacent])
+            tgt_frontier_parts.append(tgt_boxes[adjacent])
+            src_frontier_parts.append(src_boxes[adjacent])
+
+        tgt_frontier = np.concatenate(tgt_frontier_parts + [np.empty(0, np.int64)])
+        src_frontier = np.concatenate(src_frontier_parts + [np.empty(0, np.int64)])
+
+    return dict(
+            (which, (
+                np.concatenate(tgt_list + [np.empty(0, np.int64)]),
+                np.concatenate(src_list + [np.empty(0, np.int64)])))
+            for which, (tgt_list, src_list) in pairs.items())
+
+
+def build_dual_tree_traversal(source_tree, target_tree):
+    """Find the FMM interaction lists between the sources in *source_tree*
+    and the targets in *target_tree*, each refined for its own particles.
+
+    :arg source_tree: a host-resident :class:`boxtree.Tree`. Its sources
+        are used.
+    :arg target_tree: a host-resident :class:`boxtree.Tree` with the same
+        root box as *source_tree* (see the *bbox* argument of
+        :meth:`boxtree.TreeBuilder.__call__`). Its targets are used.
+    :returns: a :class:`DualTreeTraversal`
+    """
+    from pyopencl.algorithm import BuiltList
+    from boxtree.tree import box_flags_enum
+
+    # {{{ check arguments
+
+    if source_tree.dimensions != target_tree.dimensions:
+        raise ValueError("source_tree and target_tree must have the same "
+                "dimension")
+
+    for attr in ["coord_dtype", "box_id_dtype", "particle_id_dtype"]:
+        if getattr(source_tree, attr) != getattr(target_tree, attr):
+            raise ValueError("source_tree and target_tree must have the same "
+                    "%s" % attr)
+
+    if (source_tree.root_extent != target_tree.root_extent
+            or not np.array_equal(
+                source_tree.bounding_box[0], target_tree.bounding_box[0])):
+        raise ValueError("source_tree and target_tree must share their root box "
+                "(pass the same bbox when building them)")
+
+    if source_tree.sources_have_extent or target_tree.targets_have_extent:
+        raise NotImplementedError("dual-tree traversals of particles with extent")
+
+    if not (source_tree._is_pruned and target_tree._is_pruned):
+        raise ValueError("source_tree and target_tree must be pruned")
+
+    # }}}
+
+    tree, source_box_to_box, target_box_to_box = _build_combined_tree(
+            source_tree, target_tree)
+
+    nboxes = tree.nboxes
+    nlevels = tree.nlevels
+    box_id_dtype = tree.box_id_dtype
+    level_start_dtype = tree.level_start_box_nrs.dtype
+    box_levels = tree.box_levels
+
+    # {{{ box lists
+
+    def get_level_starts(boxes):
+        result = np.zeros(nlevels + 1, dtype=level_start_dtype)
+        np.cumsum(
+                np.bincount(box_levels[boxes], minlength=nlevels),
+                out=result[1:])
+        return result
+
+    def get_flagged_boxes(flags):
+        return np.nonzero(tree.box_flags & flags)[0].astype(box_id_dtype)
+
+    source_boxes = get_flagged_boxes(box_flags_enum.HAS_OWN_SOURCES)
+    source_parent_boxes = get_flagged_boxes(box_flags_enum.HAS_CHILD_SOURCES)
+    target_boxes = get_flagged_boxes(box_flags_enum.HAS_OWN_TARGETS)
+    target_or_target_parent_boxes = get_flagged_boxes(
+            box_flags_enum.HAS_OWN_TARGETS | box_flags_enum.HAS_CHILD_TARGETS)
+
+    target_box_to_index = np.empty(nboxes, dtype=np.int64)
+    target_box_to_index.fill(-1)
+    target_box_to_index[target_boxes] = np.arange(len(target_boxes))
+
+    ttp_box_to_index = np.empty(nboxes, dtype=np.int64)
+    ttp_box_to_index.fill(-1)
+    ttp_box_to_index[target_or_target_parent_boxes] = np.arange(
+            len(target_or_target_parent_boxes))
+
+    # }}}
+
+    # {{{ interaction lists
+
+    pairs = dict(
+            (which, (target_box_to_box[tgt_boxes], source_box_to_box[src_boxes]))
+            for which, (tgt_boxes, src_boxes) in _find_interaction_pairs(
+                source_tree, target_tree).items())
+
+    lists = {}
+    for name, which, row_boxes, box_to_index in [
+            ("neighbor_source_boxes", "list1",
+                target_boxes, target_box_to_index),
+            ("from_sep_siblings", "list2",
+                target_or_target_parent_boxes, ttp_box_to_index),
+            ("from_sep_bigger", "list4",
+                target_or_target_parent_boxes, ttp_box_to_index),
+            ]:
+        tgt_boxes, src_boxes = pairs[which]
+        rows = box_to_index[tgt_boxes]
+        assert (rows >= 0).all()
+
+        lists[name + "_starts"], lists[name + "_lists"] = _pairs_to_csr(
+                rows, src_boxes, len(row_boxes), box_id_dtype)
+
+    target_boxes_sep_smaller_by_source_level = []
+    from_sep_smaller_by_level = []
+
+    list3_tgt_boxes, list3_src_boxes = pairs["list3"]
+    list3_src_levels = box_levels[list3_src_boxes]
+    for level in range(nlevels):
+        level_mask = list3_src_levels == level
+        lev_tgt_boxes = list3_tgt_boxes[level_mask]
+        lev_src_boxes = list3_src_boxes[level_mask]
+
+        lev_target_boxes, rows = np.unique(lev_tgt_boxes, return_inverse=True)
+        lev_target_boxes = lev_target_boxes.astype(box_id_dtype)
+
+        starts, lev_lists = _pairs_to_csr(
+                rows, lev_src_boxes, len(lev_target_boxes), box_id_dtype)
+
+        target_boxes_sep_smaller_by_source_level.append(lev_target_boxes)
+        from_sep_smaller_by_level.append(BuiltList(
+            count=len(lev_lists),
+            starts=starts,
+            lists=lev_lists,
+            num_nonempty_lists=len(lev_target_boxes),
+            nonempty_indices=target_box_to_index[
+                lev_target_boxes].astype(box_id_dtype)))
+
+    # }}}
+
+    from boxtree.traversal import FMMTraversalInfo
+    traversal = FMMTraversalInfo(
+            tree=tree,
+            well_sep_is_n_away=1,
+            level_well_sep_is_n_away=np.ones(tree.nlevels, np.int32),
+
+            source_boxes=source_boxes,
+            target_boxes=target_boxes,
+
+            level_start_source_box_nrs=get_level_starts(source_boxes),
+            level_start_target_box_nrs=get_level_starts(target_boxes),
+
+            source_parent_boxes=source_parent_boxes,
+            level_start_source_parent_box_nrs=get_level_starts(
+                source_parent_boxes),
+
+            target_or_target_parent_boxes=target_or_target_parent_boxes,
+            level_start_target_or_target_parent_box_nrs=get_level_starts(
+                target_or_target_parent_boxes),
+
+            box_source_bounding_box_min=None,
+            box_source_bounding_box_max=None,
+            box_target_bounding_box_min=None,
+            box_target_bounding_box_max=None,
+
+            same_level_non_well_sep_boxes_starts=None,
+            same_level_non_well_sep_boxes_lists=None,
+            colleagues_starts=None,
+            colleagues_lists=None,
+
+            from_sep_smaller_by_level=from_sep_smaller_by_level,
+            target_boxes_sep_smaller_by_source_level=(
+                target_boxes_sep_smaller_by_source_level),
+
+            from_sep_close_smaller_starts=None,
+            from_sep_close_smaller_lists=None,
+            from_sep_close_bigger_starts=None,
+            from_sep_close_bigger_lists=None,
+
+            **lists)
+
+    logger.info("dual-tree traversal: %d source tree boxes, "
+            "%d target tree boxes, %s interactions in lists 1-4",
+            source_tree.nboxes, target_tree.nboxes,
+            "/".join(str(len(pairs[which][0]))
+                for which in ["list1", "list2", "list3", "list4"]))
+
+    return DualTreeTraversal(
+            tree=tree,
+            traversal=traversal,
+            source_tree=source_tree,
+            target_tree=target_tree,
+            source_box_to_box=source_box_to_box,
+            target_box_to_box=target_box_to_box)
+
+# vim: filetype=pyopencl:fdm=marker
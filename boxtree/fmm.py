@@ -22,13 +22,19 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
+import numpy as np
+import six
+
+from contextlib import contextmanager
+from time import perf_counter, process_time
+
 import logging
 logger = logging.getLogger(__name__)
 
-from pytools import ProcessLogger
+from pytools import ProcessLogger, Record, memoize_method
 
 
-def drive_fmm(traversal, expansion_wrangler, src_weights):
+def drive_fmm(traversal, expansion_wrangler, src_weights, return_timing=False):
     """Top-level driver routine for a fast multipole calculation.
 
     In part, this is intended as a template for custom FMMs, in the sense that
@@ -39,38 +45,53 @@ def drive_fmm(traversal, expansion_wrangler, src_weights):
     Nonetheless, many common applications (such as point-to-point FMMs) can be
     covered by supplying the right *expansion_wrangler* to this routine.
 
-    :arg traversal: A :class:`boxtree.traversal.FMMTraversalInfo` instance.
+    :arg traversal: A :class:`boxtree.traversal.FMMTraversalInfo` instance,
+        or a :class:`PreparedTraversal` of one.
     :arg expansion_wrangler: An object exhibiting the
         :class:`ExpansionWranglerInterface`.
     :arg src_weights: Source 'density/weights/charges'.
-        Passed unmodified to *expansion_wrangler*.
-
-    Returns the potentials computed by *expansion_wrangler*.
+        Passed unmodified to *expansion_wrangler*. For wranglers that
+        support it, this may hold several weight vectors at once, see
+        :ref:`multiple-rhs`.
+    :arg return_timing: If *True*, measure the time spent in each stage and
+        collect the counters reported by *expansion_wrangler* (see
+        :ref:`fmm-timing`).
+
+    Returns the potentials computed by *expansion_wrangler*, or, if
+    *return_timing* is *True*, a tuple *(potentials, timing_record)*, where
+    *timing_record* is an :class:`FMMTimingRecord`.
     """
     wrangler = expansion_wrangler
 
+    if isinstance(traversal, PreparedTraversal):
+        traversal = traversal.traversal
+
     # Interface guidelines: Attributes of the tree are assumed to be known
     # to the expansion wrangler and should not be passed.
 
     fmm_proc = ProcessLogger(logger, "qbx fmm")
+    timer = _FMMTimer(wrangler, enabled=return_timing)
 
-    src_weights = wrangler.reorder_sources(src_weights)
+    with timer.stage("reorder_sources"):
+        src_weights = wrangler.reorder_sources(src_weights)
 
     # {{{ "Step 2.1:" Construct local multipoles
 
-    mpole_exps = wrangler.form_multipoles(
-            traversal.level_start_source_box_nrs,
-            traversal.source_boxes,
-            src_weights)
+    with timer.stage("form_multipoles"):
+        mpole_exps = wrangler.form_multipoles(
+                traversal.level_start_source_box_nrs,
+                traversal.source_boxes,
+                src_weights)
 
     # }}}
 
     # {{{ "Step 2.2:" Propagate multipoles upward
 
-    wrangler.coarsen_multipoles(
-            traversal.level_start_source_parent_box_nrs,
-            traversal.source_parent_boxes,
-            mpole_exps)
+    with timer.stage("coarsen_multipoles"):
+        wrangler.coarsen_multipoles(
+                traversal.level_start_source_parent_box_nrs,
+                traversal.source_parent_boxes,
+                mpole_exps)
 
     # mpole_exps is called Phi in [1]
 
@@ -78,11 +99,12 @@ def drive_fmm(traversal, expansion_wrangler, src_weights):
 
     # {{{ "Stage 3:" Direct evaluation from neighbor source boxes ("list 1")
 
-    potentials = wrangler.eval_direct(
-            traversal.target_boxes,
-            traversal.neighbor_source_boxes_starts,
-            traversal.neighbor_source_boxes_lists,
-            src_weights)
+    with timer.stage("eval_direct"):
+        potentials = wrangler.eval_direct(
+                traversal.target_boxes,
+                traversal.neighbor_source_boxes_starts,
+                traversal.neighbor_source_boxes_lists,
+                src_weights)
 
     # these potentials are called alpha in [1]
 
@@ -90,12 +112,13 @@ def drive_fmm(traversal, expansion_wrangler, src_weights):
 
     # {{{ "Stage 4:" translate separated siblings' ("list 2") mpoles to local
 
-    local_exps = wrangler.multipole_to_local(
-            traversal.level_start_target_or_target_parent_box_nrs,
-            traversal.target_or_target_parent_boxes,
-            traversal.from_sep_siblings_starts,
-            traversal.from_sep_siblings_lists,
-            mpole_exps)
+    with timer.stage("multipole_to_local"):
+        local_exps = wrangler.multipole_to_local(
+                traversal.level_start_target_or_target_parent_box_nrs,
+                traversal.target_or_target_parent_boxes,
+                traversal.from_sep_siblings_starts,
+                traversal.from_sep_siblings_lists,
+                mpole_exps)
 
     # local_exps represents both Gamma and Delta in [1]
 
@@ -106,10 +129,11 @@ def drive_fmm(traversal, expansion_wrangler, src_weights):
     # (the point of aiming this stage at particles is specifically to keep its
     # contribution *out* of the downward-propagating local expansions)
 
-    potentials = potentials + wrangler.eval_multipoles(
-            traversal.target_boxes_sep_smaller_by_source_level,
-            traversal.from_sep_smaller_by_level,
-            mpole_exps)
+    with timer.stage("eval_multipoles"):
+        potentials = _accumulate(wrangler, "eval_multipoles", potentials,
+                traversal.target_boxes_sep_smaller_by_source_level,
+                traversal.from_sep_smaller_by_level,
+                mpole_exps)
 
     # these potentials are called beta in [1]
 
@@ -117,50 +141,447 @@ def drive_fmm(traversal, expansion_wrangler, src_weights):
         logger.debug("evaluate separated close smaller interactions directly "
                 "('list 3 close')")
 
-        potentials = potentials + wrangler.eval_direct(
-                traversal.target_boxes,
-                traversal.from_sep_close_smaller_starts,
-                traversal.from_sep_close_smaller_lists,
-                src_weights)
+        with timer.stage("eval_direct"):
+            potentials = _accumulate(wrangler, "eval_direct", potentials,
+                    traversal.target_boxes,
+                    traversal.from_sep_close_smaller_starts,
+                    traversal.from_sep_close_smaller_lists,
+                    src_weights)
 
     # }}}
 
     # {{{ "Stage 6:" form locals for separated bigger source boxes ("list 4")
 
-    local_exps = local_exps + wrangler.form_locals(
-            traversal.level_start_target_or_target_parent_box_nrs,
-            traversal.target_or_target_parent_boxes,
-            traversal.from_sep_bigger_starts,
-            traversal.from_sep_bigger_lists,
-            src_weights)
-
-    if traversal.from_sep_close_bigger_starts is not None:
-        potentials = potentials + wrangler.eval_direct(
+    with timer.stage("form_locals"):
+        local_exps = _accumulate(wrangler, "form_locals", local_exps,
+                traversal.level_start_target_or_target_parent_box_nrs,
                 traversal.target_or_target_parent_boxes,
-                traversal.from_sep_close_bigger_starts,
-                traversal.from_sep_close_bigger_lists,
+                traversal.from_sep_bigger_starts,
+                traversal.from_sep_bigger_lists,
                 src_weights)
 
+    if traversal.from_sep_close_bigger_starts is not None:
+        with timer.stage("eval_direct"):
+            potentials = _accumulate(wrangler, "eval_direct", potentials,
+                    traversal.target_or_target_parent_boxes,
+                    traversal.from_sep_close_bigger_starts,
+                    traversal.from_sep_close_bigger_lists,
+                    src_weights)
+
     # }}}
 
     # {{{ "Stage 7:" propagate local_exps downward
 
-    wrangler.refine_locals(
-            traversal.level_start_target_or_target_parent_box_nrs,
-            traversal.target_or_target_parent_boxes,
-            local_exps)
+    with timer.stage("refine_locals"):
+        wrangler.refine_locals(
+                traversal.level_start_target_or_target_parent_box_nrs,
+                traversal.target_or_target_parent_boxes,
+                local_exps)
 
     # }}}
 
     # {{{ "Stage 8:" evaluate locals
 
-    potentials = potentials + wrangler.eval_locals(
-            traversal.level_start_target_box_nrs,
-            traversal.target_boxes,
-            local_exps)
+    with timer.stage("eval_locals"):
+        potentials = _accumulate(wrangler, "eval_locals", potentials,
+                traversal.level_start_target_box_nrs,
+                traversal.target_boxes,
+                local_exps)
 
     # }}}
 
+    with timer.stage("reorder_potentials"):
+        result = wrangler.reorder_potentials(potentials)
+
+    with timer.stage("finalize_potentials"):
+        result = wrangler.finalize_potentials(result)
+
+    fmm_proc.done()
+
+    if return_timing:
+        return result, timer.get_record()
+    else:
+        return result
+
+
+def _accumulate(wrangler, method_name, accumulator, *args):
+    """Add the result of calling the wrangler method *method_name* with
+    *args* onto *accumulator* and return the sum. If the wrangler provides
+    the method's ``_into`` variant, the sum is formed in place, without
+    allocating new arrays.
+    """
+    accumulate_into = getattr(wrangler, method_name + "_into", None)
+    if accumulate_into is not None:
+        accumulate_into(accumulator, *args)
+        return accumulator
+
+    return accumulator + getattr(wrangler, method_name)(*args)
+
+
+# {{{ timing
+
+class FMMStageTiming(Record):
+    """Timing of one stage of :func:`drive_fmm`, summed over all calls of the
+    stage (e.g. :meth:`ExpansionWranglerInterface.eval_direct` is called
+    once for each of List 1 and the close lists).
+
+    .. attribute:: wall_elapsed
+
+        Elapsed wall time, in seconds.
+
+    .. attribute:: process_elapsed
+
+        Elapsed process (CPU) time, in seconds, summed over all threads of
+        the process.
+
+    .. attribute:: ncalls
+
+    .. attribute:: counters
+
+        A dictionary mapping counter names to the counts reported by the
+        wrangler during the stage, see :ref:`fmm-timing`.
+
+    .. automethod:: __add__
+    """
+
+    def __add__(self, other):
+        """Return the sum of the timings and counters of *self* and
+        *other*.
+        """
+        counters = dict(self.counters)
+        for name, count in six.iteritems(other.counters):
+            counters[name] = counters.get(name, 0) + count
+
+        return FMMStageTiming(
+                wall_elapsed=self.wall_elapsed + other.wall_elapsed,
+                process_elapsed=self.process_elapsed + other.process_elapsed,
+                ncalls=self.ncalls + other.ncalls,
+                counters=counters)
+
+
+class FMMTimingRecord(Record):
+    """Timing of one or more runs of :func:`drive_fmm`, as returned with
+    *return_timing*.
+
+    .. attribute:: stages
+
+        A :class:`collections.OrderedDict` mapping the names of the
+        :class:`ExpansionWranglerInterface` methods called by
+        :func:`drive_fmm` to :class:`FMMStageTiming` instances, in order of
+        their first call.
+
+    .. attribute:: wall_elapsed
+
+        Total elapsed wall time, in seconds.
+
+    .. attribute:: process_elapsed
+
+        Total elapsed process time, in seconds.
+
+    .. attribute:: nruns
+
+        The number of runs of :func:`drive_fmm` that the record covers.
+
+    .. automethod:: __add__
+    .. automethod:: aggregate
+    .. automethod:: get_counter_totals
+    .. automethod:: to_dict
+    """
+
+    def __add__(self, other):
+        """Return a record covering the runs of both *self* and *other*."""
+        from collections import OrderedDict
+        stages = OrderedDict(self.stages)
+        for name, timing in six.iteritems(other.stages):
+            if name in stages:
+                stages[name] = stages[name] + timing
+            else:
+                stages[name] = timing
+
+        return FMMTimingRecord(
+                stages=stages,
+                wall_elapsed=self.wall_elapsed + other.wall_elapsed,
+                process_elapsed=self.process_elapsed + other.process_elapsed,
+                nruns=self.nruns + other.nruns)
+
+    @staticmethod
+    def aggregate(records):
+        """Return a record covering the runs of all entries of the iterable
+        *records*, which must not be empty.
+        """
+        from functools import reduce
+        from operator import add
+        return reduce(add, records)
+
+    def get_counter_totals(self):
+        """Return a dictionary mapping counter names to their sums over all
+        stages.
+        """
+        totals = {}
+        for timing in six.itervalues(self.stages):
+            for name, count in six.iteritems(timing.counters):
+                totals[name] = totals.get(name, 0) + count
+
+        return totals
+
+    def to_dict(self):
+        """Return the record as nested dictionaries of numbers, e.g. for
+        serialization as JSON.
+        """
+        return {
+                "wall_elapsed": self.wall_elapsed,
+                "process_elapsed": self.process_elapsed,
+                "nruns": self.nruns,
+                "stages": dict(
+                    (name, {
+                        "wall_elapsed": timing.wall_elapsed,
+                        "process_elapsed": timing.process_elapsed,
+                        "ncalls": timing.ncalls,
+                        "counters": dict(timing.counters),
+                        })
+                    for name, timing in six.iteritems(self.stages)),
+                }
+
+
+class _FMMTimer(object):
+    def __init__(self, wrangler, enabled):
+        self.enabled = enabled
+
+        if not enabled:
+            return
+
+        from collections import OrderedDict
+        self.stages = OrderedDict()
+        self.get_counters = getattr(wrangler, "get_counters", None)
+
+        self.wall_start = perf_counter()
+        self.process_start = process_time()
+
+    def _get_counters(self):
+        counters = None
+        if self.get_counters is not None:
+            counters = self.get_counters()
+
+        if counters is None:
+            return {}
+
+        return dict(counters)
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        counters_before = self._get_counters()
+        wall_start = perf_counter()
+        process_start = process_time()
+
+        yield
+
+        wall_elapsed = perf_counter() - wall_start
+        process_elapsed = process_time() - process_start
+
+        counters = dict(
+                (counter, count - counters_before.get(counter, 0))
+                for counter, count in six.iteritems(self._get_counters()))
+
+        timing = FMMStageTiming(
+                wall_elapsed=wall_elapsed,
+                process_elapsed=process_elapsed,
+                ncalls=1,
+                counters=counters)
+
+        if name in self.stages:
+            self.stages[name] = self.stages[name] + timing
+        else:
+            self.stages[name] = timing
+
+    def get_record(self):
+        return FMMTimingRecord(
+                stages=self.stages,
+                wall_elapsed=perf_counter() - self.wall_start,
+                process_elapsed=process_time() - self.process_start,
+                nruns=1)
+
+# }}}
+
+
+# {{{ concurrent driver
+
+def _run_task_graph(tasks, executor):
+    """Run *tasks*, a list of tuples *(name, dependencies, func)*, on
+    *executor*. Each *func* is called with the results of the tasks named in
+    *dependencies* as positional arguments once these are available.
+
+    :returns: a dictionary mapping task names to results.
+    """
+    from concurrent.futures import wait, FIRST_COMPLETED
+
+    results = {}
+    pending = list(tasks)
+    running = {}
+
+    while pending or running:
+        still_pending = []
+        for name, dependencies, func in pending:
+            if all(dep in results for dep in dependencies):
+                future = executor.submit(
+                        func, *[results[dep] for dep in dependencies])
+                running[future] = name
+            else:
+                still_pending.append((name, dependencies, func))
+
+        pending = still_pending
+
+        if not running:
+            raise ValueError("unsatisfiable task dependencies: %s"
+                    % ", ".join(name for name, _, _ in pending))
+
+        done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+        for future in done:
+            results[running.pop(future)] = future.result()
+
+    return results
+
+
+def drive_fmm_concurrently(traversal, expansion_wrangler, src_weights,
+        executor=None):
+    """Like :func:`drive_fmm`, but expresses the stages of the FMM as a graph of
+    tasks, and runs each task on *executor* as soon as its inputs are
+    available. For example, the direct evaluations (for List 1 and the
+    "close" lists) and :meth:`ExpansionWranglerInterface.form_locals` depend
+    only on the source weights, and may run concurrently with the upward
+    pass.
+
+    The contributions of the stages are added in the same order as in
+    :func:`drive_fmm`, so that the result is the same.
+
+    The methods of *expansion_wrangler* may be called concurrently from
+    several threads, and must support this.
+
+    :arg executor: a :class:`concurrent.futures.Executor` whose tasks run in
+        the calling process, such as a
+        :class:`concurrent.futures.ThreadPoolExecutor`. (Since
+        :meth:`ExpansionWranglerInterface.coarsen_multipoles` and
+        :meth:`ExpansionWranglerInterface.refine_locals` modify their
+        arguments, a process pool cannot be used.) If *None*, a
+        :class:`concurrent.futures.ThreadPoolExecutor` is created for the
+        duration of the call.
+
+    Other arguments and the return value are as for :func:`drive_fmm`.
+    """
+    if executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor() as executor:
+            return drive_fmm_concurrently(
+                    traversal, expansion_wrangler, src_weights, executor)
+
+    wrangler = expansion_wrangler
+
+    if isinstance(traversal, PreparedTraversal):
+        traversal = traversal.traversal
+
+    fmm_proc = ProcessLogger(logger, "concurrent fmm")
+
+    src_weights = wrangler.reorder_sources(src_weights)
+
+    def coarsen_multipoles(mpole_exps):
+        wrangler.coarsen_multipoles(
+                traversal.level_start_source_parent_box_nrs,
+                traversal.source_parent_boxes,
+                mpole_exps)
+        return mpole_exps
+
+    def refine_locals(m2l_local_exps, p2l_local_exps):
+        local_exps = m2l_local_exps + p2l_local_exps
+        wrangler.refine_locals(
+                traversal.level_start_target_or_target_parent_box_nrs,
+                traversal.target_or_target_parent_boxes,
+                local_exps)
+        return local_exps
+
+    tasks = [
+            # {{{ upward pass
+
+            ("form_multipoles", (), lambda: wrangler.form_multipoles(
+                traversal.level_start_source_box_nrs,
+                traversal.source_boxes,
+                src_weights)),
+            ("coarsen_multipoles", ("form_multipoles",), coarsen_multipoles),
+
+            # }}}
+
+            # {{{ direct evaluation, depending only on the source weights
+
+            ("eval_direct", (), lambda: wrangler.eval_direct(
+                traversal.target_boxes,
+                traversal.neighbor_source_boxes_starts,
+                traversal.neighbor_source_boxes_lists,
+                src_weights)),
+            ("form_locals", (), lambda: wrangler.form_locals(
+                traversal.level_start_target_or_target_parent_box_nrs,
+                traversal.target_or_target_parent_boxes,
+                traversal.from_sep_bigger_starts,
+                traversal.from_sep_bigger_lists,
+                src_weights)),
+
+            # }}}
+
+            # {{{ downward pass
+
+            ("multipole_to_local", ("coarsen_multipoles",),
+                lambda mpole_exps: wrangler.multipole_to_local(
+                    traversal.level_start_target_or_target_parent_box_nrs,
+                    traversal.target_or_target_parent_boxes,
+                    traversal.from_sep_siblings_starts,
+                    traversal.from_sep_siblings_lists,
+                    mpole_exps)),
+            ("eval_multipoles", ("coarsen_multipoles",),
+                lambda mpole_exps: wrangler.eval_multipoles(
+                    traversal.target_boxes_sep_smaller_by_source_level,
+                    traversal.from_sep_smaller_by_level,
+                    mpole_exps)),
+            ("refine_locals", ("multipole_to_local", "form_locals"),
+                refine_locals),
+            ("eval_locals", ("refine_locals",),
+                lambda local_exps: wrangler.eval_locals(
+                    traversal.level_start_target_box_nrs,
+                    traversal.target_boxes,
+                    local_exps)),
+
+            # }}}
+            ]
+
+    if traversal.from_sep_close_smaller_starts is not None:
+        tasks.append(
+                ("eval_direct_close_smaller", (), lambda: wrangler.eval_direct(
+                    traversal.target_boxes,
+                    traversal.from_sep_close_smaller_starts,
+                    traversal.from_sep_close_smaller_lists,
+                    src_weights)))
+
+    if traversal.from_sep_close_bigger_starts is not None:
+        tasks.append(
+                ("eval_direct_close_bigger", (), lambda: wrangler.eval_direct(
+                    traversal.target_or_target_parent_boxes,
+                    traversal.from_sep_close_bigger_starts,
+                    traversal.from_sep_close_bigger_lists,
+                    src_weights)))
+
+    results = _run_task_graph(tasks, executor)
+
+    # Same order of summation as in drive_fmm
+    potentials = results["eval_direct"]
+    for name in [
+            "eval_multipoles",
+            "eval_direct_close_smaller",
+            "eval_direct_close_bigger",
+            "eval_locals",
+            ]:
+        if name in results:
+            potentials = potentials + results[name]
+
     result = wrangler.reorder_potentials(potentials)
 
     result = wrangler.finalize_potentials(result)
@@ -169,6 +590,191 @@ def drive_fmm(traversal, expansion_wrangler, src_weights):
 
     return result
 
+# }}}
+
+
+# {{{ prepared traversal
+
+class LevelInteractionLists(Record):
+    """The part of an interaction list (in :ref:`csr`) belonging to the
+    target boxes on one level, as returned by
+    :meth:`PreparedTraversal.get_level_interaction_lists`.
+
+    .. attribute:: level
+
+    .. attribute:: box_start
+
+        The index of the first target box on :attr:`level` in the array of
+        target boxes.
+
+    .. attribute:: box_stop
+
+    .. attribute:: boxes
+
+        The target boxes on :attr:`level`.
+
+    .. attribute:: boxes_level_indices
+
+        :attr:`boxes`, relative to the first box on :attr:`level` (i.e. the
+        indices of the target boxes in a per-level array of expansions).
+
+    .. attribute:: box_centers
+
+        Centers of :attr:`boxes`, with shape ``(dimensions, len(boxes))``, in
+        Fortran order.
+
+    .. attribute:: starts
+
+        Starts of the interaction lists of :attr:`boxes` in :attr:`lists`.
+        ``starts[0] == 0``.
+
+    .. attribute:: lists
+
+    .. attribute:: lists_level_indices
+
+        :attr:`lists`, relative to the first box on :attr:`level`. Only
+        meaningful if the listed boxes are on :attr:`level`.
+    """
+
+
+class PreparedTraversal(object):
+    """Host-side quantities derived from a
+    :class:`boxtree.traversal.FMMTraversalInfo` (with data on the host) that
+    depend neither on source weights nor on the kernel, such as per-box
+    particle slices and per-level interaction lists.
+
+    An expansion wrangler may accept a :class:`PreparedTraversal` (e.g. as a
+    constructor argument, see
+    :class:`boxtree.pyfmmlib_integration.FMMLibExpansionWrangler`), so
+    that these quantities are computed once and shared among all wranglers
+    (e.g. for different kernels) and all calls of :func:`drive_fmm` using the
+    same traversal. :func:`drive_fmm` accepts a :class:`PreparedTraversal`
+    in place of the traversal.
+
+    All quantities are computed on first use.
+
+    .. attribute:: traversal
+
+    .. attribute:: tree
+
+    .. autoattribute:: sources
+    .. autoattribute:: targets
+    .. autoattribute:: box_source_slices
+    .. autoattribute:: box_target_slices
+    .. autoattribute:: level_box_sizes
+
+    .. automethod:: get_level_interaction_lists
+    """
+
+    def __init__(self, traversal):
+        self.traversal = traversal
+        self.tree = traversal.tree
+
+        self._level_interaction_lists_cache = {}
+
+    @property
+    @memoize_method
+    def sources(self):
+        """The source coordinates, as an array of shape
+        ``(dimensions, nsources)`` in Fortran order.
+        """
+        return np.array(list(self.tree.sources), order="F")
+
+    @property
+    @memoize_method
+    def targets(self):
+        """The target coordinates, as an array of shape
+        ``(dimensions, ntargets)`` in Fortran order.
+        """
+        if self.tree.sources_are_targets:
+            return self.sources
+
+        return np.array(list(self.tree.targets), order="F")
+
+    @staticmethod
+    def _get_slices(starts, counts):
+        return [slice(start, start + count)
+                for start, count in zip(starts.tolist(), counts.tolist())]
+
+    @property
+    @memoize_method
+    def box_source_slices(self):
+        """A list of :class:`slice` objects, one per box, selecting the sources
+        owned by the box (in tree order).
+        """
+        return self._get_slices(
+                self.tree.box_source_starts, self.tree.box_source_counts_nonchild)
+
+    @property
+    @memoize_method
+    def box_target_slices(self):
+        """A list of :class:`slice` objects, one per box, selecting the targets
+        owned by the box (in tree order).
+        """
+        return self._get_slices(
+                self.tree.box_target_starts, self.tree.box_target_counts_nonchild)
+
+    @property
+    @memoize_method
+    def level_box_sizes(self):
+        """An array of shape ``(nlevels,)`` containing the size of the boxes on
+        each level.
+        """
+        return self.tree.root_extent * 2.0 ** -np.arange(self.tree.nlevels)
+
+    def get_level_interaction_lists(self, level_start_box_nrs, boxes,
+            starts, lists, level):
+        """Return a :class:`LevelInteractionLists` for the target boxes on
+        *level*. The arguments are as passed to the methods of
+        :class:`ExpansionWranglerInterface`. The result is cached for as long
+        as the arrays passed remain the same objects.
+        """
+        key = (id(level_start_box_nrs), id(boxes), id(starts), id(lists), level)
+
+        try:
+            cached_args, result = self._level_interaction_lists_cache[key]
+        except KeyError:
+            pass
+        else:
+            if all(cached_arg is arg for cached_arg, arg in zip(
+                    cached_args, (level_start_box_nrs, boxes, starts, lists))):
+                return result
+
+        result = get_level_interaction_lists(self.tree,
+                level_start_box_nrs, boxes, starts, lists, level)
+
+        # Keep the arguments alive, so that their ids remain valid.
+        self._level_interaction_lists_cache[key] = (
+                (level_start_box_nrs, boxes, starts, lists), result)
+
+        return result
+
+
+def get_level_interaction_lists(tree, level_start_box_nrs, boxes,
+        starts, lists, level):
+    """Like :meth:`PreparedTraversal.get_level_interaction_lists`, but without
+    caching.
+    """
+    box_start, box_stop = level_start_box_nrs[level:level+2]
+    level_start_ibox = tree.level_start_box_nrs[level]
+
+    level_boxes = boxes[box_start:box_stop]
+    list_start, list_stop = starts[box_start], starts[box_stop]
+    level_lists = lists[list_start:list_stop]
+
+    return LevelInteractionLists(
+            level=level,
+            box_start=box_start,
+            box_stop=box_stop,
+            boxes=level_boxes,
+            boxes_level_indices=level_boxes - level_start_ibox,
+            box_centers=np.asfortranarray(tree.box_centers[:, level_boxes]),
+            starts=starts[box_start:box_stop+1] - list_start,
+            lists=level_lists,
+            lists_level_indices=level_lists - level_start_ibox)
+
+# }}}
+
 
 # {{{ expansion wrangler interface
 
@@ -181,6 +787,75 @@ class ExpansionWranglerInterface:
 
     Will usually hold a reference (and thereby be specific to) a
     :class:`boxtree.Tree` instance.
+
+    .. _multiple-rhs:
+
+    .. rubric:: Multiple right-hand sides
+
+    A wrangler may accept *src_weights* of shape ``(nrhs, nsources)``, to
+    evaluate the same FMM for *nrhs* weight vectors at once. The expansions
+    and potentials it returns then carry the same leading axis of length
+    *nrhs*, and :meth:`reorder_sources` and :meth:`reorder_potentials` act
+    on the last axis. :class:`boxtree.pyfmmlib_integration.FMMLibExpansionWrangler`
+    supports this.
+
+    .. _fmm-timing:
+
+    .. rubric:: Timing and counters
+
+    When called with *return_timing*, :func:`drive_fmm` records the time
+    spent in each wrangler method. A wrangler may additionally report
+    counters by providing a method :meth:`get_counters`. The increase of each
+    counter during a method call is attributed to the corresponding stage in
+    :attr:`FMMStageTiming.counters`. Wranglers should use the following
+    counter names where they apply:
+
+    ================== ======================================================
+    Counter            Meaning
+    ================== ======================================================
+    ``particles``      Particles (sources or targets) touched, counted once
+                       per source or target box they are processed for
+    ``p2p_pairs``      Source-target pairs evaluated directly
+    ``translations``   Expansion-to-expansion translations (M2M, M2L, L2L)
+    ================== ======================================================
+
+    Counts do not depend on the number of right-hand sides.
+
+    .. _accumulating-stages:
+
+    .. rubric:: Accumulating in place
+
+    A wrangler may optionally provide the following methods. If present,
+    :func:`drive_fmm` uses them to add the results of these stages onto the
+    potentials and local expansions it already holds, rather than adding
+    newly allocated arrays, so that an FMM needs only a constant number of
+    potential-sized arrays. (They are not defined on this class, since
+    :func:`drive_fmm` checks for their presence.)
+
+    .. method:: eval_direct_into(output, target_boxes, \
+            neighbor_sources_starts, neighbor_sources_lists, src_weights)
+
+        Like :meth:`eval_direct`, but add the potentials onto *output*
+        (compatible with :meth:`output_zeros`) in place.
+
+    .. method:: eval_multipoles_into(output, target_boxes_by_source_level, \
+            from_sep_smaller_by_level, mpole_exps)
+
+        Like :meth:`eval_multipoles`, but add the potentials onto *output* in
+        place.
+
+    .. method:: form_locals_into(local_exps, \
+            level_start_target_or_target_parent_box_nrs, \
+            target_or_target_parent_boxes, starts, lists, src_weights)
+
+        Like :meth:`form_locals`, but add the local expansions onto
+        *local_exps* (compatible with :meth:`local_expansion_zeros`) in place.
+
+    .. method:: eval_locals_into(output, level_start_target_box_nrs, \
+            target_boxes, local_exps)
+
+        Like :meth:`eval_locals`, but add the potentials onto *output* in
+        place.
     """
 
     def multipole_expansion_zeros(self):
@@ -203,6 +878,12 @@ class ExpansionWranglerInterface:
         the potential, or arbitrary other per-target output data.
         """
 
+    def get_counters(self):
+        """Optional. Return a dictionary mapping counter names to the
+        cumulative counts since the creation of the wrangler. See
+        :ref:`fmm-timing`.
+        """
+
     def reorder_sources(self, source_array):
         """Return a copy of *source_array* in
         :ref:`tree source order <particle-orderings>`.
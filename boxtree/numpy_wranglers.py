@@ -0,0 +1,687 @@
+from __future__ import division
+
+__copyright__ = "Copyright (C) 2018 Andreas Kloeckner"
+
+__license__ = """
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import numpy as np
+from pytools import memoize, memoize_method
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+__doc__ = """
+Pure-NumPy expansion wranglers
+------------------------------
+
+These wranglers need nothing beyond :mod:`numpy`, and work on trees and
+traversals with data on the host. Each stage is carried out by a fixed number
+of vectorized operations (segmented sums using :func:`numpy.add.reduceat`
+over the interaction lists in :ref:`csr`, and indexing by box and by level),
+rather than by a loop over boxes. This makes them usable as correctness
+oracles and as baselines for large problems.
+
+.. autoclass:: ConstantOneExpansionWrangler
+
+.. autoclass:: Laplace2DExpansionWrangler
+"""
+
+
+# Stages that pair particles with boxes or with other particles are carried
+# out for groups of target boxes, each with at most about this many pairs.
+_MAX_PAIRS_PER_CHUNK = 2**20
+
+
+# {{{ segmented operations
+
+def _concat_ranges(starts, counts):
+    """Return the concatenation of the index ranges
+    ``starts[i]:starts[i]+counts[i]``.
+    """
+    counts = np.asarray(counts, dtype=np.intp)
+    offsets = np.cumsum(counts) - counts
+    return (
+            np.arange(counts.sum(), dtype=np.intp)
+            + np.repeat(np.asarray(starts, dtype=np.intp) - offsets, counts))
+
+
+def _counts_to_starts(counts):
+    result = np.zeros(len(counts) + 1, dtype=np.intp)
+    np.cumsum(counts, out=result[1:])
+    return result
+
+
+def _segment_sum(values, starts):
+    """Return the sums of *values* along the first axis over the segments
+    ``starts[i]:starts[i+1]``. *starts* must begin with zero and end with
+    ``len(values)``.
+    """
+    starts = np.asarray(starts, dtype=np.intp)
+    result = np.zeros((len(starts) - 1,) + values.shape[1:], values.dtype)
+
+    nonempty = starts[1:] > starts[:-1]
+    if nonempty.any():
+        # Empty segments in between nonempty ones do not affect the sums,
+        # since they share their start with the next segment.
+        result[nonempty] = np.add.reduceat(
+                values, starts[:-1][nonempty], axis=0)
+
+    return result
+
+
+def _iter_chunks(pair_counts):
+    """Yield :class:`slice` objects partitioning ``range(len(pair_counts))``
+    into groups with at most :data:`_MAX_PAIRS_PER_CHUNK` pairs (unless a
+    single entry has more).
+    """
+    if not len(pair_counts):
+        return
+
+    chunk_ids = (np.cumsum(pair_counts) - 1) // _MAX_PAIRS_PER_CHUNK
+    bounds = np.flatnonzero(np.diff(chunk_ids)) + 1
+    bounds = [0] + bounds.tolist() + [len(pair_counts)]
+
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        yield slice(start, stop)
+
+# }}}
+
+
+# {{{ base class
+
+class _NumpyExpansionWranglerBase(object):
+    def __init__(self, tree):
+        self.tree = tree
+
+    # {{{ particles
+
+    def _source_indices(self, boxes):
+        counts = self.tree.box_source_counts_nonchild[boxes]
+        return (
+                _concat_ranges(self.tree.box_source_starts[boxes], counts),
+                counts)
+
+    def _target_indices(self, boxes):
+        counts = self.tree.box_target_counts_nonchild[boxes]
+        return (
+                _concat_ranges(self.tree.box_target_starts[boxes], counts),
+                counts)
+
+    def _list_sources(self, starts, lists):
+        """Return the sources in the boxes of *lists*, concatenated, and the
+        starts of the sources of each list.
+        """
+        source_ids, counts = self._source_indices(lists)
+        return source_ids, _counts_to_starts(counts)[starts]
+
+    def _iter_target_particle_pairs(self, target_boxes, item_starts):
+        """Pair each target in *target_boxes* with the range of 'items' (e.g.
+        sources or interaction list entries) for its box given by
+        *item_starts*, which is indexed like *target_boxes*.
+
+        Yields tuples *(target_ids, item_ids, pair_starts)*, where the items
+        paired with ``target_ids[i]`` are
+        ``item_ids[pair_starts[i]:pair_starts[i+1]]``.
+        """
+        item_starts = np.asarray(item_starts, dtype=np.intp)
+        item_counts = np.diff(item_starts)
+        target_counts = self.tree.box_target_counts_nonchild[target_boxes]
+
+        for chunk in _iter_chunks(item_counts * target_counts):
+            target_ids, counts = self._target_indices(target_boxes[chunk])
+            target_item_counts = np.repeat(item_counts[chunk], counts)
+
+            item_ids = _concat_ranges(
+                    np.repeat(item_starts[:-1][chunk], counts),
+                    target_item_counts)
+
+            yield target_ids, item_ids, _counts_to_starts(target_item_counts)
+
+    # }}}
+
+    # {{{ reordering
+
+    def reorder_sources(self, source_array):
+        return source_array[self.tree.user_source_ids]
+
+    def reorder_potentials(self, potentials):
+        return potentials[self.tree.sorted_target_ids]
+
+    # }}}
+
+    def output_zeros(self):
+        return np.zeros(self.tree.ntargets, dtype=np.float64)
+
+    def _get_child_pairs(self, parent_boxes):
+        """Return the children of *parent_boxes* and the starts of the
+        children of each parent in the result.
+        """
+        child_ids = self.tree.box_child_ids[:, parent_boxes].T
+        has_child = child_ids != 0
+
+        return (
+                child_ids[has_child],
+                _counts_to_starts(has_child.sum(axis=1)))
+
+# }}}
+
+
+# {{{ constant kernel
+
+class ConstantOneExpansionWrangler(_NumpyExpansionWranglerBase):
+    """Implements the :class:`boxtree.fmm.ExpansionWranglerInterface` for a
+    Green's function that is constant 1 everywhere. For weights of all ones,
+    the FMM then gives every target the number of sources, which makes this a
+    check that every source-target interaction is carried out exactly once.
+
+    Expansions and potentials are real and have one entry per box and target,
+    respectively.
+
+    .. automethod:: __init__
+    """
+
+    def __init__(self, tree):
+        """
+        :arg tree: a :class:`boxtree.Tree` with data on the host.
+        """
+        _NumpyExpansionWranglerBase.__init__(self, tree)
+
+    def multipole_expansion_zeros(self):
+        return np.zeros(self.tree.nboxes, dtype=np.float64)
+
+    local_expansion_zeros = multipole_expansion_zeros
+
+    def _box_source_sums(self, boxes, src_weights):
+        source_ids, counts = self._source_indices(boxes)
+        return _segment_sum(src_weights[source_ids], _counts_to_starts(counts))
+
+    def _list_source_sums(self, starts, lists, src_weights):
+        return _segment_sum(self._box_source_sums(lists, src_weights), starts)
+
+    def _add_to_targets(self, pot, target_boxes, box_values):
+        target_ids, counts = self._target_indices(target_boxes)
+        pot[target_ids] += np.repeat(box_values, counts)
+
+    def form_multipoles(self, level_start_source_box_nrs, source_boxes,
+            src_weights):
+        mpoles = self.multipole_expansion_zeros()
+        mpoles[source_boxes] = self._box_source_sums(source_boxes, src_weights)
+        return mpoles
+
+    def coarsen_multipoles(self, level_start_source_parent_box_nrs,
+            source_parent_boxes, mpoles):
+        # See boxtree.fmm.drive_fmm for the relevant range of levels.
+        for source_level in range(self.tree.nlevels-1, 2, -1):
+            target_level = source_level - 1
+            start, stop = level_start_source_parent_box_nrs[
+                            target_level:target_level+2]
+            parent_boxes = source_parent_boxes[start:stop]
+
+            child_ids, child_starts = self._get_child_pairs(parent_boxes)
+            mpoles[parent_boxes] += _segment_sum(mpoles[child_ids], child_starts)
+
+        return mpoles
+
+    def eval_direct(self, target_boxes, neighbor_sources_starts,
+            neighbor_sources_lists, src_weights):
+        pot = self.output_zeros()
+        self._add_to_targets(pot, target_boxes,
+                self._list_source_sums(
+                    neighbor_sources_starts, neighbor_sources_lists,
+                    src_weights))
+        return pot
+
+    def multipole_to_local(self,
+            level_start_target_or_target_parent_box_nrs,
+            target_or_target_parent_boxes,
+            starts, lists, mpole_exps):
+        local_exps = self.local_expansion_zeros()
+        local_exps[target_or_target_parent_boxes] = _segment_sum(
+                mpole_exps[lists], starts)
+        return local_exps
+
+    def eval_multipoles(self,
+            target_boxes_by_source_level, from_sep_smaller_by_level,
+            mpole_exps):
+        pot = self.output_zeros()
+
+        for target_boxes, ssn in zip(
+                target_boxes_by_source_level, from_sep_smaller_by_level):
+            self._add_to_targets(pot, target_boxes,
+                    _segment_sum(mpole_exps[ssn.lists], ssn.starts))
+
+        return pot
+
+    def form_locals(self,
+            level_start_target_or_target_parent_box_nrs,
+            target_or_target_parent_boxes, starts, lists, src_weights):
+        local_exps = self.local_expansion_zeros()
+        local_exps[target_or_target_parent_boxes] = self._list_source_sums(
+                starts, lists, src_weights)
+        return local_exps
+
+    def refine_locals(self, level_start_target_or_target_parent_box_nrs,
+            target_or_target_parent_boxes, local_exps):
+        for target_lev in range(1, self.tree.nlevels):
+            start, stop = level_start_target_or_target_parent_box_nrs[
+                    target_lev:target_lev+2]
+            boxes = target_or_target_parent_boxes[start:stop]
+            local_exps[boxes] += local_exps[self.tree.box_parent_ids[boxes]]
+
+        return local_exps
+
+    def eval_locals(self, level_start_target_box_nrs, target_boxes, local_exps):
+        pot = self.output_zeros()
+        self._add_to_targets(pot, target_boxes, local_exps[target_boxes])
+        return pot
+
+    def finalize_potentials(self, potentials):
+        return potentials
+
+# }}}
+
+
+# {{{ 2D Laplace
+
+@memoize
+def _get_binomials(n):
+    """Return an array *b* of shape ``(n+1, n+1)`` with ``b[m, k]`` the
+    binomial coefficient *m* choose *k*.
+    """
+    binomials = np.zeros((n + 1, n + 1))
+    for m in range(n + 1):
+        binomials[m, 0] = 1
+        binomials[m, 1:m+1] = binomials[m-1, 0:m] + binomials[m-1, 1:m+1]
+
+    return binomials
+
+
+def _get_powers(z, order):
+    """Return an array of shape ``(len(z), order+1)`` containing the powers
+    ``z**k`` for *k* up to *order*.
+    """
+    result = np.empty((len(z), order + 1), dtype=z.dtype)
+    result[:, 0] = 1
+    if order:
+        result[:, 1:] = np.cumprod(
+                np.repeat(z[:, np.newaxis], order, axis=1), axis=1)
+    return result
+
+
+class Laplace2DExpansionWrangler(_NumpyExpansionWranglerBase):
+    r"""Implements the :class:`boxtree.fmm.ExpansionWranglerInterface` for
+    the 2D Laplace kernel :math:`-\log(r)/(2\pi)` using complex Taylor and
+    Laurent series, as in the original description of the FMM by Greengard
+    and Rokhlin. With complex coordinates :math:`z`, a box with center
+    :math:`c` and size :math:`h` carries the multipole and local expansions
+
+    .. math::
+
+        a_0 \log(z-c) + \sum_{k=1}^p a_k \left(\frac{h}{z-c}\right)^k,
+        \qquad
+        \sum_{l=0}^p b_l \left(\frac{z-c}{h}\right)^l,
+
+    whose real parts approximate the potential. These match the
+    approximations of :class:`boxtree.pyfmmlib_integration.FMMLibExpansionWrangler`
+    with the same order to rounding.
+
+    Sources and targets at the same location do not interact. Supports a
+    single real weight vector. Potentials are real.
+
+    .. automethod:: __init__
+    """
+
+    def __init__(self, tree, order):
+        """
+        :arg tree: a :class:`boxtree.Tree` with data on the host.
+        :arg order: the order *p* of the expansions on all levels.
+        """
+        if tree.dimensions != 2:
+            raise ValueError("Laplace2DExpansionWrangler requires a 2D tree")
+        if order < 0:
+            raise ValueError("order must be non-negative")
+
+        _NumpyExpansionWranglerBase.__init__(self, tree)
+        self.order = order
+
+    # {{{ geometry
+
+    @property
+    @memoize_method
+    def _sources(self):
+        return self.tree.sources[0] + 1j*self.tree.sources[1]
+
+    @property
+    @memoize_method
+    def _targets(self):
+        return self.tree.targets[0] + 1j*self.tree.targets[1]
+
+    @property
+    @memoize_method
+    def _box_centers(self):
+        return self.tree.box_centers[0] + 1j*self.tree.box_centers[1]
+
+    @property
+    @memoize_method
+    def _box_sizes(self):
+        return self.tree.root_extent * 2.0 ** -self.tree.box_levels.astype(
+                np.float64)
+
+    # }}}
+
+    def multipole_expansion_zeros(self):
+        return np.zeros((self.tree.nboxes, self.order + 1), dtype=np.complex128)
+
+    local_expansion_zeros = multipole_expansion_zeros
+
+    def _check_weights(self, src_weights):
+        if src_weights.ndim != 1:
+            raise ValueError("Laplace2DExpansionWrangler supports a single "
+                    "weight vector only")
+        if np.iscomplexobj(src_weights):
+            raise TypeError("Laplace2DExpansionWrangler supports real "
+                    "weights only")
+
+    def reorder_sources(self, source_array):
+        self._check_weights(source_array)
+        return _NumpyExpansionWranglerBase.reorder_sources(self, source_array)
+
+    # {{{ translation operators
+
+    def _translate_multipoles(self, mpoles, w, rho):
+        """Shift the multipoles *mpoles* by *w* (the old center minus the new
+        one, in units of the new box size) and rescale them by *rho* (the old
+        box size divided by the new one).
+        """
+        order = self.order
+        binomials = _get_binomials(order)
+        w_powers = _get_powers(w, order)
+
+        # b_l = -a_0 w^l / l + sum_{k=1}^l a_k binom(l-1, k-1) w^(l-k) rho^k
+        scaled_mpoles = mpoles * _get_powers(rho, order)
+        result = np.zeros_like(mpoles)
+        result[:, 0] = mpoles[:, 0]
+        result[:, 1:] = (
+                -mpoles[:, 0, np.newaxis] * w_powers[:, 1:]
+                / np.arange(1, order + 1))
+
+        for shift in range(order):
+            # the terms with l-k == shift
+            ks = np.arange(1, order + 1 - shift)
+            result[:, ks + shift] += (
+                    w_powers[:, shift, np.newaxis] * scaled_mpoles[:, ks]
+                    * binomials[ks + shift - 1, ks - 1])
+
+        return result
+
+    @memoize_method
+    def _get_m2l_matrix(self):
+        order = self.order
+        binomials = _get_binomials(2*order)
+
+        # b_l = v^l (-a_0/l + sum_{k>=1} (-u)^k a_k binom(l+k-1, k-1)),
+        # b_0 = a_0 log(-z0) + sum_{k>=1} (-u)^k a_k
+        ls = np.arange(order + 1)[:, np.newaxis]
+        ks = np.arange(order + 1)
+        result = binomials[ls + ks - 1, ks - 1]
+        result[0, 1:] = 1
+        result[1:, 0] = -1 / ls[1:, 0]
+        result[0, 0] = 0
+        return result
+
+    def _multipoles_to_locals(self, mpoles, z0, source_sizes, target_sizes):
+        """Return the local expansions due to the multipoles *mpoles*, where
+        *z0* is the multipole center minus the local center.
+        """
+        order = self.order
+        scaled_mpoles = mpoles * _get_powers(-source_sizes / z0, order)
+        result = scaled_mpoles.dot(self._get_m2l_matrix().T)
+        result[:, 0] += mpoles[:, 0] * np.log(-z0)
+        result *= _get_powers(target_sizes / z0, order)
+        return result
+
+    def _translate_locals(self, local_exps, w, rho):
+        """Shift the local expansions *local_exps* by *w* (the new center
+        minus the old one, in units of the old box size) and rescale them by
+        *rho* (the new box size divided by the old one).
+        """
+        order = self.order
+        binomials = _get_binomials(order)
+        w_powers = _get_powers(w, order)
+
+        # b'_l = rho^l sum_{k>=l} binom(k, l) w^(k-l) b_k
+        result = np.zeros_like(local_exps)
+        for shift in range(order + 1):
+            # the terms with k-l == shift
+            ls = np.arange(order + 1 - shift)
+            result[:, ls] += (
+                    w_powers[:, shift, np.newaxis] * local_exps[:, ls + shift]
+                    * binomials[ls + shift, ls])
+
+        result *= _get_powers(rho, order)
+        return result
+
+    def _eval_series(self, coeffs, x):
+        """Return ``sum(coeffs[:, k] * x**k)``, by Horner's scheme."""
+        result = coeffs[:, self.order].copy()
+        for k in range(self.order - 1, -1, -1):
+            result *= x
+            result += coeffs[:, k]
+        return result
+
+    # }}}
+
+    def form_multipoles(self, level_start_source_box_nrs, source_boxes,
+            src_weights):
+        mpoles = self.multipole_expansion_zeros()
+
+        source_ids, counts = self._source_indices(source_boxes)
+        particle_boxes = np.repeat(source_boxes, counts)
+        d = (
+                (self._sources[source_ids] - self._box_centers[particle_boxes])
+                / self._box_sizes[particle_boxes])
+
+        # a_0 = q, a_k = -q d^k / k
+        contribs = (
+                src_weights[source_ids, np.newaxis]
+                * _get_powers(d, self.order))
+        contribs[:, 1:] /= -np.arange(1, self.order + 1)
+
+        mpoles[source_boxes] = _segment_sum(contribs, _counts_to_starts(counts))
+        return mpoles
+
+    def coarsen_multipoles(self, level_start_source_parent_box_nrs,
+            source_parent_boxes, mpoles):
+        # See boxtree.fmm.drive_fmm for the relevant range of levels.
+        for source_level in range(self.tree.nlevels-1, 2, -1):
+            target_level = source_level - 1
+            start, stop = level_start_source_parent_box_nrs[
+                            target_level:target_level+2]
+            parent_boxes = source_parent_boxes[start:stop]
+
+            child_ids, child_starts = self._get_child_pairs(parent_boxes)
+            child_parents = np.repeat(parent_boxes, np.diff(child_starts))
+
+            parent_sizes = self._box_sizes[child_parents]
+            translated = self._translate_multipoles(mpoles[child_ids],
+                    (self._box_centers[child_ids]
+                        - self._box_centers[child_parents]) / parent_sizes,
+                    self._box_sizes[child_ids] / parent_sizes)
+
+            mpoles[parent_boxes] += _segment_sum(translated, child_starts)
+
+        return mpoles
+
+    def eval_direct_into(self, output, target_boxes, neighbor_sources_starts,
+            neighbor_sources_lists, src_weights):
+        source_ids, source_starts = self._list_sources(
+                neighbor_sources_starts, neighbor_sources_lists)
+
+        for target_ids, pair_sources, pair_starts in \
+                self._iter_target_particle_pairs(target_boxes, source_starts):
+            pair_sources = source_ids[pair_sources]
+            pair_targets = np.repeat(target_ids, np.diff(pair_starts))
+
+            r2 = np.abs(
+                    self._targets[pair_targets] - self._sources[pair_sources])**2
+            r2[r2 == 0] = 1
+
+            output[target_ids] += _segment_sum(
+                    0.5 * np.log(r2) * src_weights[pair_sources], pair_starts)
+
+        return output
+
+    def eval_direct(self, target_boxes, neighbor_sources_starts,
+            neighbor_sources_lists, src_weights):
+        return self.eval_direct_into(self.output_zeros(),
+                target_boxes, neighbor_sources_starts, neighbor_sources_lists,
+                src_weights)
+
+    def multipole_to_local(self,
+            level_start_target_or_target_parent_box_nrs,
+            target_or_target_parent_boxes,
+            starts, lists, mpole_exps):
+        local_exps = self.local_expansion_zeros()
+
+        starts = np.asarray(starts, dtype=np.intp)
+        boxes = target_or_target_parent_boxes
+
+        for chunk in _iter_chunks(np.diff(starts)):
+            chunk_boxes = boxes[chunk]
+            chunk_starts = starts[chunk.start:chunk.stop+1]
+
+            source_boxes = lists[chunk_starts[0]:chunk_starts[-1]]
+            pair_targets = np.repeat(chunk_boxes, np.diff(chunk_starts))
+
+            local_exps[chunk_boxes] += _segment_sum(
+                    self._multipoles_to_locals(
+                        mpole_exps[source_boxes],
+                        (self._box_centers[source_boxes]
+                            - self._box_centers[pair_targets]),
+                        self._box_sizes[source_boxes],
+                        self._box_sizes[pair_targets]),
+                    chunk_starts - chunk_starts[0])
+
+        return local_exps
+
+    def eval_multipoles_into(self, output,
+            target_boxes_by_source_level, from_sep_smaller_by_level,
+            mpole_exps):
+        for target_boxes, ssn in zip(
+                target_boxes_by_source_level, from_sep_smaller_by_level):
+            for target_ids, pair_entries, pair_starts in \
+                    self._iter_target_particle_pairs(target_boxes, ssn.starts):
+                source_boxes = ssn.lists[pair_entries]
+                pair_targets = np.repeat(target_ids, np.diff(pair_starts))
+
+                d = self._targets[pair_targets] - self._box_centers[source_boxes]
+                mpoles = mpole_exps[source_boxes]
+
+                values = self._eval_series(mpoles,
+                        self._box_sizes[source_boxes] / d)
+                # The series includes a_0 as its constant term.
+                values += mpoles[:, 0] * (np.log(d) - 1)
+
+                output[target_ids] += _segment_sum(values.real, pair_starts)
+
+        return output
+
+    def eval_multipoles(self,
+            target_boxes_by_source_level, from_sep_smaller_by_level,
+            mpole_exps):
+        return self.eval_multipoles_into(self.output_zeros(),
+                target_boxes_by_source_level, from_sep_smaller_by_level,
+                mpole_exps)
+
+    def form_locals_into(self, local_exps,
+            level_start_target_or_target_parent_box_nrs,
+            target_or_target_parent_boxes, starts, lists, src_weights):
+        source_ids, source_starts = self._list_sources(starts, lists)
+        boxes = target_or_target_parent_boxes
+
+        for chunk in _iter_chunks(np.diff(source_starts)):
+            chunk_boxes = boxes[chunk]
+            chunk_starts = source_starts[chunk.start:chunk.stop+1]
+
+            pair_sources = source_ids[chunk_starts[0]:chunk_starts[-1]]
+            pair_targets = np.repeat(chunk_boxes, np.diff(chunk_starts))
+
+            # b_0 = q log(-d), b_l = -q (h/d)^l / l
+            d = self._sources[pair_sources] - self._box_centers[pair_targets]
+            weights = src_weights[pair_sources]
+
+            contribs = (
+                    weights[:, np.newaxis]
+                    * _get_powers(self._box_sizes[pair_targets] / d, self.order))
+            contribs[:, 0] = weights * np.log(-d)
+            contribs[:, 1:] /= -np.arange(1, self.order + 1)
+
+            local_exps[chunk_boxes] += _segment_sum(
+                    contribs, chunk_starts - chunk_starts[0])
+
+        return local_exps
+
+    def form_locals(self,
+            level_start_target_or_target_parent_box_nrs,
+            target_or_target_parent_boxes, starts, lists, src_weights):
+        return self.form_locals_into(self.local_expansion_zeros(),
+                level_start_target_or_target_parent_box_nrs,
+                target_or_target_parent_boxes, starts, lists, src_weights)
+
+    def refine_locals(self, level_start_target_or_target_parent_box_nrs,
+            target_or_target_parent_boxes, local_exps):
+        for target_lev in range(1, self.tree.nlevels):
+            start, stop = level_start_target_or_target_parent_box_nrs[
+                    target_lev:target_lev+2]
+            boxes = target_or_target_parent_boxes[start:stop]
+            parents = self.tree.box_parent_ids[boxes]
+
+            parent_sizes = self._box_sizes[parents]
+            local_exps[boxes] += self._translate_locals(local_exps[parents],
+                    (self._box_centers[boxes] - self._box_centers[parents])
+                    / parent_sizes,
+                    self._box_sizes[boxes] / parent_sizes)
+
+        return local_exps
+
+    def eval_locals_into(self, output, level_start_target_box_nrs,
+            target_boxes, local_exps):
+        target_ids, counts = self._target_indices(target_boxes)
+        particle_boxes = np.repeat(target_boxes, counts)
+
+        output[target_ids] += self._eval_series(
+                local_exps[particle_boxes],
+                (self._targets[target_ids] - self._box_centers[particle_boxes])
+                / self._box_sizes[particle_boxes]).real
+
+        return output
+
+    def eval_locals(self, level_start_target_box_nrs, target_boxes, local_exps):
+        return self.eval_locals_into(self.output_zeros(),
+                level_start_target_box_nrs, target_boxes, local_exps)
+
+    def finalize_potentials(self, potentials):
+        return potentials * (-1/(2*np.pi))
+
+# }}}
+
+# vim: foldmethod=marker
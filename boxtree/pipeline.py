@@ -0,0 +1,170 @@
+from __future__ import division
+
+__copyright__ = "Copyright (C) 2018 Andreas Kloeckner"
+
+__license__ = """
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import pyopencl as cl
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+__doc__ = """
+Background tree and traversal builds
+------------------------------------
+
+Building a tree and its traversal involves a number of blocking reads from
+the device. :class:`TreeAndTraversalPipeline` moves these builds onto a
+background thread, so that, e.g. in a time-stepping loop, the host thread
+can evaluate an FMM using the tree of step *n* while the tree for step
+*n+1* is being built::
+
+    with TreeAndTraversalPipeline(ctx) as pipeline:
+        future = pipeline.submit(particles, max_particles_in_box=30)
+
+        for step in range(nsteps):
+            tree, trav = future.result()
+            if step + 1 < nsteps:
+                future = pipeline.submit(
+                        next_particles(step), max_particles_in_box=30)
+
+            evaluate_fmm(trav)
+
+.. autoclass:: TreeAndTraversalPipeline
+
+    .. automethod:: submit
+    .. automethod:: submit_async
+    .. automethod:: shutdown
+"""
+
+
+class TreeAndTraversalPipeline(object):
+    """Builds trees, traversals and (optionally) merged close lists on a
+    background thread, one build at a time, in the order in which they were
+    submitted.
+
+    The builds run on a separate :class:`pyopencl.CommandQueue`. Each build
+    allocates its own device memory (using *allocator*, if given), so a tree
+    and traversal that were returned earlier remain valid and usable while
+    the next ones are being built.
+
+    Can be used as a context manager, which calls :meth:`shutdown` on exit.
+
+    .. note::
+
+        :mod:`pyopencl` kernels may not be invoked concurrently from several
+        threads. The pipeline uses its own builders, but other threads
+        should avoid running :mod:`pyopencl` array operations of the same
+        kind (e.g. on the same context) while a build is in flight, unless
+        this is known to be safe for the :mod:`pyopencl` version in use.
+    """
+
+    def __init__(self, context, allocator=None, tree_builder=None,
+            traversal_builder=None):
+        """
+        :arg allocator: the allocator used for the trees, or *None*.
+        :arg tree_builder: a :class:`boxtree.TreeBuilder` to use. If *None*, a
+            new one is created.
+        :arg traversal_builder: a
+            :class:`boxtree.traversal.FMMTraversalBuilder` to use. If *None*,
+            a new one is created.
+        """
+        if tree_builder is None:
+            from boxtree import TreeBuilder
+            tree_builder = TreeBuilder(context)
+
+        if traversal_builder is None:
+            from boxtree.traversal import FMMTraversalBuilder
+            traversal_builder = FMMTraversalBuilder(context)
+
+        self.context = context
+        self.tree_builder = tree_builder
+        self.traversal_builder = traversal_builder
+
+        self.allocator = allocator
+
+        self.queue = cl.CommandQueue(context)
+
+        from concurrent.futures import ThreadPoolExecutor
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def _build(self, particles, merge_close_lists, wait_for,
+            traversal_kwargs, tree_kwargs):
+        queue = self.queue
+
+        tree, evt = self.tree_builder(queue, particles,
+                allocator=self.allocator, wait_for=wait_for, **tree_kwargs)
+
+        trav, evt = self.traversal_builder(queue, tree, wait_for=[evt],
+                merge_close_lists=merge_close_lists, **traversal_kwargs)
+
+        queue.finish()
+
+        trav = trav.with_queue(None)
+        return trav.tree, trav
+
+    def submit(self, particles, merge_close_lists=False, wait_for=None,
+            traversal_kwargs=None, **tree_kwargs):
+        """Start building a tree for *particles* and its traversal.
+
+        :arg particles: passed to :meth:`boxtree.TreeBuilder.__call__`. Must
+            remain unmodified until the build has completed.
+        :arg merge_close_lists: if *True*, build the traversal with its close
+            lists merged into List 1, as by
+            :meth:`boxtree.traversal.FMMTraversalInfo.merge_close_lists`.
+        :arg wait_for: a list of :class:`pyopencl.Event` instances that must
+            complete before the input arrays may be read, or *None*.
+        :arg traversal_kwargs: a dictionary of keyword arguments for
+            :meth:`boxtree.traversal.FMMTraversalBuilder.__call__`, or *None*.
+        :arg tree_kwargs: keyword arguments for
+            :meth:`boxtree.TreeBuilder.__call__`.
+        :returns: a :class:`concurrent.futures.Future` whose result is a tuple
+            *(tree, traversal)*. Both have completed on the device and are
+            not associated with a queue.
+        """
+        if traversal_kwargs is None:
+            traversal_kwargs = {}
+
+        return self.executor.submit(self._build,
+                particles, merge_close_lists, wait_for,
+                traversal_kwargs, tree_kwargs)
+
+    def submit_async(self, *args, **kwargs):
+        """Like :meth:`submit`, but return an :mod:`asyncio` future for use in
+        coroutines.
+        """
+        import asyncio
+        return asyncio.wrap_future(self.submit(*args, **kwargs))
+
+    def shutdown(self, wait=True):
+        """Stop accepting builds. If *wait*, wait for the pending builds to
+        complete.
+        """
+        self.executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+# vim: filetype=pyopencl:fdm=marker
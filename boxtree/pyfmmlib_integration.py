@@ -26,7 +26,7 @@ THE SOFTWARE.
 
 
 import numpy as np
-from pytools import memoize_method, log_process
+from pytools import memoize, memoize_method, log_process
 
 import logging
 logger = logging.getLogger(__name__)
@@ -40,16 +40,44 @@ __doc__ = """Integrates :mod:`boxtree` with
 class FMMLibExpansionWrangler(object):
     """Implements the :class:`boxtree.fmm.ExpansionWranglerInterface`
     by using pyfmmlib.
+
+    The translations (multipole-to-multipole, multipole-to-local and
+    local-to-local) and the formation of local expansions from sources each
+    use a single call to a batched (``_imany``) :mod:`pyfmmlib` routine for
+    all boxes on a level. Forming multipole expansions and evaluating
+    expansions at targets use one call per box, since :mod:`pyfmmlib` has no
+    batched routines for these.
+
+    Supports several weight vectors at once (see :ref:`multiple-rhs`). The
+    per-box work other than the :mod:`pyfmmlib` calls (finding particles,
+    centers and expansions) is then done once for all weight vectors, and the
+    batched calls cover all weight vectors.
+
+    Also implements the optional in-place variants of the stages that
+    produce potentials or local expansions (see :ref:`accumulating-stages`),
+    so that :func:`boxtree.fmm.drive_fmm` allocates one output array and one
+    array of local expansions per evaluation.
     """
 
     # {{{ constructor
 
     def __init__(self, tree, helmholtz_k, fmm_level_to_nterms=None, ifgrad=False,
-            dipole_vec=None, dipoles_already_reordered=False, nterms=None):
+            dipole_vec=None, dipoles_already_reordered=False, nterms=None,
+            prepared_traversal=None, nthreads=None):
         """
         :arg fmm_level_to_nterms: a callable that, upon being passed the tree
             and the tree level as an integer, returns the value of *nterms* for the
             multipole and local expansions on that level.
+        :arg prepared_traversal: a :class:`boxtree.fmm.PreparedTraversal` of
+            the traversal with which this wrangler will be used, or *None*. If
+            given, the particle slices, coordinate arrays and per-level
+            interaction lists it holds are used (and shared with other
+            wranglers using it), rather than computed by this wrangler.
+        :arg nthreads: if not *None*, the number of threads across which the
+            boxes processed by each stage are partitioned. The per-box
+            :mod:`pyfmmlib` calls only run in parallel if :mod:`pyfmmlib` was
+            built so as to release the GIL during them. If *None*, all boxes
+            are processed on the calling thread.
         """
 
         if nterms is not None and fmm_level_to_nterms is not None:
@@ -64,7 +92,12 @@ class FMMLibExpansionWrangler(object):
             def fmm_level_to_nterms(tree, level):
                 return nterms
 
+        if nthreads is not None and nthreads < 1:
+            raise ValueError("nthreads must be positive")
+
         self.tree = tree
+        self.prepared_traversal = prepared_traversal
+        self.nthreads = nthreads
 
         if helmholtz_k == 0:
             self.eqn_letter = "l"
@@ -101,6 +134,10 @@ class FMMLibExpansionWrangler(object):
             self.dipole_vec = None
             self.dp_suffix = ""
 
+        import threading
+        self._counters = {}
+        self._counters_lock = threading.Lock()
+
     # }}}
 
     def level_to_rscale(self, level):
@@ -122,8 +159,7 @@ class FMMLibExpansionWrangler(object):
 
         if self.dim == 3 and self.eqn_letter == "h":
             nquad = max(6, int(2.5*nterms))
-            from pyfmmlib import legewhts
-            xnodes, weights = legewhts(nquad, ifwhts=1)
+            xnodes, weights = _get_legendre_nodes_and_weights(nquad)
 
             common_extra_kwargs = {
                     "xnodes": xnodes,
@@ -311,68 +347,243 @@ class FMMLibExpansionWrangler(object):
         return self._expansions_level_starts(
                 lambda nterms: product(self.expansion_shape(nterms)))
 
-    def multipole_expansions_view(self, mpole_exps, level):
+    def _expansions_view(self, exps, level, level_starts):
         box_start, box_stop = self.tree.level_start_box_nrs[level:level+2]
+        expn_start, expn_stop = level_starts[level:level+2]
 
-        expn_start, expn_stop = \
-                self.multipole_expansions_level_starts()[level:level+2]
-        return (box_start,
-                mpole_exps[expn_start:expn_stop].reshape(
-                    box_stop-box_start,
-                    *self.expansion_shape(self.level_nterms[level])))
+        rhs_shape = exps.shape[:-1]
+        view = exps[..., expn_start:expn_stop].reshape(
+                rhs_shape + (box_stop-box_start,)
+                + self.expansion_shape(self.level_nterms[level]))
 
-    def local_expansions_view(self, local_exps, level):
-        box_start, box_stop = self.tree.level_start_box_nrs[level:level+2]
+        # Make the box axis the leading one.
+        return box_start, np.moveaxis(view, len(rhs_shape), 0)
 
-        expn_start, expn_stop = \
-                self.local_expansions_level_starts()[level:level+2]
-        return (box_start,
-                local_exps[expn_start:expn_stop].reshape(
-                    box_stop-box_start,
-                    *self.expansion_shape(self.level_nterms[level])))
+    def multipole_expansions_view(self, mpole_exps, level):
+        """Return a tuple *(box_start, view)*, where *view* has shape
+        ``(nboxes_on_level,) + rhs_shape + expansion_shape``.
+        """
+        return self._expansions_view(mpole_exps, level,
+                self.multipole_expansions_level_starts())
+
+    def local_expansions_view(self, local_exps, level):
+        """See :meth:`multipole_expansions_view`."""
+        return self._expansions_view(local_exps, level,
+                self.local_expansions_level_starts())
 
-    def multipole_expansion_zeros(self):
+    def multipole_expansion_zeros(self, rhs_shape=()):
         return np.zeros(
-                self.multipole_expansions_level_starts()[-1],
+                rhs_shape + (self.multipole_expansions_level_starts()[-1],),
                 dtype=self.dtype)
 
-    def local_expansion_zeros(self):
+    def local_expansion_zeros(self, rhs_shape=()):
         return np.zeros(
-                self.local_expansions_level_starts()[-1],
+                rhs_shape + (self.local_expansions_level_starts()[-1],),
                 dtype=self.dtype)
 
-    def output_zeros(self):
+    def output_zeros(self, rhs_shape=()):
         if self.ifgrad:
             from pytools import make_obj_array
             return make_obj_array([
-                    np.zeros(self.tree.ntargets, self.dtype)
+                    np.zeros(rhs_shape + (self.tree.ntargets,), self.dtype)
                     for i in range(1 + self.dim)])
         else:
-            return np.zeros(self.tree.ntargets, self.dtype)
+            return np.zeros(rhs_shape + (self.tree.ntargets,), self.dtype)
 
     def add_potgrad_onto_output(self, output, output_slice, pot, grad):
         if self.ifgrad:
             output[0, output_slice] += pot
             output[1:, output_slice] += grad
         else:
-            output[output_slice] += pot
+            output[..., output_slice] += pot
+
+    # }}}
+
+    # {{{ multiple right-hand sides
+
+    @staticmethod
+    def _get_rhs_shape(ary):
+        """Return the shape of the leading right-hand side axis of *ary*
+        (source weights, expansions or potentials), i.e. ``()`` or
+        ``(nrhs,)``.
+        """
+        if ary.ndim not in [1, 2]:
+            raise ValueError("expected one- or two-dimensional array, "
+                    "got %d dimensions" % ary.ndim)
+
+        return ary.shape[:-1]
+
+    @staticmethod
+    def _get_nrhs(rhs_shape):
+        return int(np.prod(rhs_shape, dtype=np.int64))
+
+    @staticmethod
+    def _get_rhs_rows(ary, rhs_shape):
+        """Return *ary*, whose leading axes are *rhs_shape*, with a single
+        leading axis of length *nrhs*.
+        """
+        return ary.reshape((-1,) + ary.shape[len(rhs_shape):])
+
+    @staticmethod
+    def _get_box_rhs_rows(view, rhs_shape):
+        """Like :meth:`_get_rhs_rows`, but for the result of
+        :meth:`multipole_expansions_view` or :meth:`local_expansions_view`,
+        whose leading axis is the box axis. Since there is at most one
+        right-hand side axis, the result is a view.
+        """
+        return view.reshape(view.shape[:1] + (-1,) + view.shape[1+len(rhs_shape):])
+
+    def _stack_rhs_potgrads(self, potgrads, rhs_shape):
+        """Stack the (potential, gradient) pairs in *potgrads*, one per
+        right-hand side, into arrays with leading axes *rhs_shape*.
+        """
+        pots, grads = zip(*potgrads)
+        pot = np.array(pots).reshape(rhs_shape + pots[0].shape)
+
+        if self.ifgrad:
+            grad = np.array(grads).reshape(rhs_shape + grads[0].shape)
+        else:
+            grad = 0
+
+        return pot, grad
+
+    # }}}
+
+    # {{{ batched translations
+
+    def _get_imany_expansions(self, exps_view, rhs_shape):
+        """Return the expansions in *exps_view* (as returned by
+        :meth:`multipole_expansions_view` or :meth:`local_expansions_view`)
+        in the Fortran layout expected by the ``_imany`` routines, with the
+        expansion of right-hand side *irhs* of the box with level index
+        *ibox* at index ``ibox*nrhs + irhs`` of the last axis.
+        """
+        rows = self._get_box_rhs_rows(exps_view, rhs_shape)
+        return np.ascontiguousarray(rows).reshape(
+                (-1,) + rows.shape[2:]).T
+
+    @staticmethod
+    def _get_imany_starts(starts, nrhs):
+        """Return the *starts* argument of an ``_imany`` routine computing
+        one result for each pair (right-hand side, *i*), numbered in this
+        order, from the entries ``starts[i]:starts[i+1]``, which are repeated
+        for each right-hand side.
+        """
+        nentries = starts[-1]
+        return np.append(
+                (np.arange(nrhs)[:, np.newaxis] * nentries
+                    + starts[:-1]).ravel(),
+                nrhs * nentries)
+
+    def _translate_many(self, translate, source_level, source_exps,
+            source_boxes, source_starts, target_level, target_boxes, nrhs):
+        """Sum the translations of the expansions of boxes
+        ``source_boxes[source_starts[i]:source_starts[i+1]]`` on
+        *source_level* to box ``target_boxes[i]`` on *target_level*, for
+        every *i* and every right-hand side, in a single call of the
+        ``_imany`` translation routine *translate*.
+
+        :arg source_exps: the expansions on *source_level*, as returned by
+            :meth:`_get_imany_expansions`.
+        :returns: an array of shape ``(len(target_boxes), nrhs)
+            + expansion_shape``.
+        """
+        tree = self.tree
+
+        ntgt_boxes = len(target_boxes)
+        nentries = len(source_boxes)
+        nvcount = nrhs * ntgt_boxes
+
+        entry_starts = self._get_imany_starts(source_starts, nrhs)
+        rhs_offsets = np.arange(nrhs)[:, np.newaxis]
+
+        source_level_indices = (
+                source_boxes - tree.level_start_box_nrs[source_level])
+
+        kwargs = {}
+        if self.dim == 3 and self.eqn_letter == "h":
+            kwargs["radius"] = (
+                    tree.root_extent * 2**(-target_level)
+                    * np.ones(nvcount))
+
+        # These get max'd/added onto: pass initialized versions.
+        if self.dim == 3:
+            kwargs["ier"] = np.zeros(nvcount, dtype=np.int32)
+
+        kwargs.update(self.kernel_kwargs)
+
+        nterms2 = self.level_nterms[target_level]
+        expn2 = np.zeros(
+                (nvcount,) + self.expansion_shape(nterms2),
+                dtype=self.dtype)
+
+        expn2 = translate(
+                rscale1=np.array([self.level_to_rscale(source_level)]),
+                rscale1_offsets=np.zeros(nrhs * nentries, dtype=np.int32),
+                rscale1_starts=entry_starts,
+
+                center1=tree.box_centers,
+                center1_offsets=np.tile(source_boxes, nrhs),
+                center1_starts=entry_starts,
+
+                expn1=source_exps,
+                expn1_offsets=(
+                    source_level_indices * nrhs + rhs_offsets).ravel(),
+                expn1_starts=entry_starts,
+
+                rscale2=(
+                    self.level_to_rscale(target_level) * np.ones(nvcount)),
+                center2=np.tile(tree.box_centers[:, target_boxes], nrhs),
+                expn2=expn2.T,
+
+                nterms2=nterms2,
+
+                **kwargs).T
+
+        return np.swapaxes(
+                expn2.reshape((nrhs, ntgt_boxes) + expn2.shape[1:]), 0, 1)
 
     # }}}
 
     # {{{ source/target particle wrangling
 
+    def _uses_tree_targets(self):
+        # The target lists may be overridden, see above.
+        return (
+                self.box_target_starts() is self.tree.box_target_starts
+                and self.box_target_counts_nonchild()
+                is self.tree.box_target_counts_nonchild
+                and self.targets() is self.tree.targets)
+
+    @memoize_method
+    def _get_source_slices(self):
+        if self.prepared_traversal is not None:
+            return self.prepared_traversal.box_source_slices
+
+        from boxtree.fmm import PreparedTraversal
+        return PreparedTraversal._get_slices(
+                self.tree.box_source_starts, self.tree.box_source_counts_nonchild)
+
     def _get_source_slice(self, ibox):
-        pstart = self.tree.box_source_starts[ibox]
-        return slice(
-                pstart, pstart + self.tree.box_source_counts_nonchild[ibox])
+        return self._get_source_slices()[ibox]
+
+    @memoize_method
+    def _get_target_slices(self):
+        if self.prepared_traversal is not None and self._uses_tree_targets():
+            return self.prepared_traversal.box_target_slices
+
+        from boxtree.fmm import PreparedTraversal
+        return PreparedTraversal._get_slices(
+                self.box_target_starts(), self.box_target_counts_nonchild())
 
     def _get_target_slice(self, ibox):
-        pstart = self.box_target_starts()[ibox]
-        return slice(
-                pstart, pstart + self.box_target_counts_nonchild()[ibox])
+        return self._get_target_slices()[ibox]
 
     @memoize_method
     def _get_single_sources_array(self):
+        if self.prepared_traversal is not None:
+            return self.prepared_traversal.sources
+
         return np.array([
             self.tree.sources[idim]
             for idim in range(self.dim)
@@ -383,6 +594,9 @@ class FMMLibExpansionWrangler(object):
 
     @memoize_method
     def _get_single_targets_array(self):
+        if self.prepared_traversal is not None and self._uses_tree_targets():
+            return self.prepared_traversal.targets
+
         return np.array([
             self.targets()[idim]
             for idim in range(self.dim)
@@ -391,6 +605,63 @@ class FMMLibExpansionWrangler(object):
     def _get_targets(self, pslice):
         return self._get_single_targets_array()[:, pslice]
 
+    def _get_level_interaction_lists(self, level_start_box_nrs, boxes,
+            starts, lists, level):
+        if self.prepared_traversal is not None:
+            return self.prepared_traversal.get_level_interaction_lists(
+                    level_start_box_nrs, boxes, starts, lists, level)
+
+        from boxtree.fmm import get_level_interaction_lists
+        return get_level_interaction_lists(self.tree,
+                level_start_box_nrs, boxes, starts, lists, level)
+
+    # }}}
+
+    # {{{ counters
+
+    def get_counters(self):
+        """Return the cumulative counters of the work done by this wrangler,
+        see :ref:`fmm-timing`.
+        """
+        with self._counters_lock:
+            return dict(self._counters)
+
+    def _add_counts(self, **counts):
+        # May be called from several threads.
+        with self._counters_lock:
+            for name, count in counts.items():
+                self._counters[name] = self._counters.get(name, 0) + int(count)
+
+    # }}}
+
+    # {{{ thread-parallel box loops
+
+    @memoize_method
+    def _get_executor(self):
+        from concurrent.futures import ThreadPoolExecutor
+        return ThreadPoolExecutor(max_workers=self.nthreads)
+
+    def _run_in_chunks(self, func, nitems):
+        """Call *func(start, stop)* on consecutive ranges that together cover
+        ``range(nitems)``. If *nthreads* was given, the ranges are processed
+        concurrently, so *func* may only write to data that no other range
+        writes to.
+        """
+        if nitems == 0:
+            return
+
+        if self.nthreads is None or nitems == 1:
+            func(0, nitems)
+            return
+
+        # Use more ranges than threads, to balance out boxes with differing
+        # amounts of work.
+        nchunks = min(nitems, self.nthreads * _CHUNKS_PER_THREAD)
+        bounds = np.linspace(0, nitems, nchunks + 1).astype(np.intp)
+
+        # Re-raises exceptions from func.
+        list(self._get_executor().map(func, bounds[:-1], bounds[1:]))
+
     # }}}
 
     @log_process(logger)
@@ -399,7 +670,7 @@ class FMMLibExpansionWrangler(object):
 
     @log_process(logger)
     def reorder_potentials(self, potentials):
-        return potentials[self.tree.sorted_target_ids]
+        return potentials[..., self.tree.sorted_target_ids]
 
     def get_source_kwargs(self, src_weights, pslice):
         if self.dipole_vec is None:
@@ -423,7 +694,10 @@ class FMMLibExpansionWrangler(object):
     def form_multipoles(self, level_start_source_box_nrs, source_boxes, src_weights):
         formmp = self.get_routine("%ddformmp" + self.dp_suffix)
 
-        mpoles = self.multipole_expansion_zeros()
+        rhs_shape = self._get_rhs_shape(src_weights)
+        rhs_weights_rows = self._get_rhs_rows(src_weights, rhs_shape)
+
+        mpoles = self.multipole_expansion_zeros(rhs_shape)
         for lev in range(self.tree.nlevels):
             start, stop = level_start_source_box_nrs[lev:lev+2]
             if start == stop:
@@ -433,28 +707,46 @@ class FMMLibExpansionWrangler(object):
                     mpoles, lev)
 
             rscale = self.level_to_rscale(lev)
+            level_source_boxes = source_boxes[start:stop]
 
-            for src_ibox in source_boxes[start:stop]:
-                pslice = self._get_source_slice(src_ibox)
+            def form_level_multipoles(chunk_start, chunk_stop):
+                nparticles = 0
 
-                if pslice.stop - pslice.start == 0:
-                    continue
+                for src_ibox in level_source_boxes[chunk_start:chunk_stop]:
+                    pslice = self._get_source_slice(src_ibox)
 
-                kwargs = {}
-                kwargs.update(self.kernel_kwargs)
-                kwargs.update(self.get_source_kwargs(src_weights, pslice))
+                    if pslice.stop - pslice.start == 0:
+                        continue
 
-                ier, mpole = formmp(
-                        rscale=rscale,
-                        source=self._get_sources(pslice),
-                        center=self.tree.box_centers[:, src_ibox],
-                        nterms=self.level_nterms[lev],
-                        **kwargs)
+                    nparticles += pslice.stop - pslice.start
+
+                    sources = self._get_sources(pslice)
+                    center = self.tree.box_centers[:, src_ibox]
 
-                if ier:
-                    raise RuntimeError("formmp failed")
+                    box_mpoles = []
+                    for rhs_weights in rhs_weights_rows:
+                        kwargs = {}
+                        kwargs.update(self.kernel_kwargs)
+                        kwargs.update(self.get_source_kwargs(rhs_weights, pslice))
 
-                mpoles_view[src_ibox-level_start_ibox] = mpole.T
+                        ier, mpole = formmp(
+                                rscale=rscale,
+                                source=sources,
+                                center=center,
+                                nterms=self.level_nterms[lev],
+                                **kwargs)
+
+                        if ier:
+                            raise RuntimeError("formmp failed")
+
+                        box_mpoles.append(mpole.T)
+
+                    mpoles_view[src_ibox-level_start_ibox] = np.reshape(
+                            box_mpoles, rhs_shape + box_mpoles[0].shape)
+
+                self._add_counts(particles=nparticles)
+
+            self._run_in_chunks(form_level_multipoles, len(level_source_boxes))
 
         return mpoles
 
@@ -463,7 +755,10 @@ class FMMLibExpansionWrangler(object):
             source_parent_boxes, mpoles):
         tree = self.tree
 
-        mpmp = self.get_translation_routine("%ddmpmp")
+        mpmp = self.get_translation_routine("%ddmpmp", vec_suffix="_imany")
+
+        rhs_shape = self._get_rhs_shape(mpoles)
+        nrhs = self._get_nrhs(rhs_shape)
 
         # nlevels-1 is the last valid level index
         # nlevels-2 is the last valid level that could have children
@@ -476,81 +771,114 @@ class FMMLibExpansionWrangler(object):
             start, stop = level_start_source_parent_box_nrs[
                             target_level:target_level+2]
 
-            source_level_start_ibox, source_mpoles_view = \
+            _, source_mpoles_view = \
                     self.multipole_expansions_view(mpoles, source_level)
             target_level_start_ibox, target_mpoles_view = \
                     self.multipole_expansions_view(mpoles, target_level)
 
-            source_rscale = self.level_to_rscale(source_level)
-            target_rscale = self.level_to_rscale(target_level)
+            source_mpoles = self._get_imany_expansions(
+                    source_mpoles_view, rhs_shape)
+            target_mpoles_rows = self._get_box_rhs_rows(
+                    target_mpoles_view, rhs_shape)
 
-            for ibox in source_parent_boxes[start:stop]:
-                parent_center = tree.box_centers[:, ibox]
-                for child in tree.box_child_ids[:, ibox]:
-                    if child:
-                        child_center = tree.box_centers[:, child]
+            level_parent_boxes = source_parent_boxes[start:stop]
 
-                        kwargs = {}
-                        if self.dim == 3 and self.eqn_letter == "h":
-                            kwargs["radius"] = tree.root_extent * 2**(-target_level)
+            # Each parent box only receives contributions from its own
+            # children, so parents may be processed in parallel.
+            def coarsen_level_multipoles(chunk_start, chunk_stop):
+                parent_boxes = level_parent_boxes[chunk_start:chunk_stop]
 
-                        kwargs.update(self.kernel_kwargs)
+                children = tree.box_child_ids[:, parent_boxes].T
+                has_child = children != 0
+                child_starts = np.zeros(len(parent_boxes) + 1, dtype=np.intp)
+                np.cumsum(has_child.sum(axis=1), out=child_starts[1:])
 
-                        new_mp = mpmp(
-                                rscale1=source_rscale,
-                                center1=child_center,
-                                expn1=source_mpoles_view[
-                                    child - source_level_start_ibox].T,
+                new_mpoles = self._translate_many(mpmp,
+                        source_level, source_mpoles,
+                        children[has_child], child_starts,
+                        target_level, parent_boxes, nrhs)
 
-                                rscale2=target_rscale,
-                                center2=parent_center,
-                                nterms2=self.level_nterms[target_level],
+                target_mpoles_rows[
+                        parent_boxes - target_level_start_ibox] += new_mpoles
 
-                                **kwargs)
+                self._add_counts(translations=child_starts[-1])
 
-                        target_mpoles_view[
-                                ibox - target_level_start_ibox] += new_mp[..., 0].T
+            self._run_in_chunks(coarsen_level_multipoles, len(level_parent_boxes))
 
-    @log_process(logger)
     def eval_direct(self, target_boxes, neighbor_sources_starts,
             neighbor_sources_lists, src_weights):
-        output = self.output_zeros()
+        output = self.output_zeros(self._get_rhs_shape(src_weights))
+        self.eval_direct_into(output, target_boxes, neighbor_sources_starts,
+                neighbor_sources_lists, src_weights)
+        return output
+
+    @log_process(logger)
+    def eval_direct_into(self, output, target_boxes, neighbor_sources_starts,
+            neighbor_sources_lists, src_weights):
+        rhs_shape = self._get_rhs_shape(src_weights)
+        rhs_weights_rows = self._get_rhs_rows(src_weights, rhs_shape)
 
         ev = self.get_direct_eval_routine()
 
-        for itgt_box, tgt_ibox in enumerate(target_boxes):
-            tgt_pslice = self._get_target_slice(tgt_ibox)
+        # Each target box owns its range of the output, so target boxes may be
+        # processed in parallel.
+        def eval_direct_chunk(chunk_start, chunk_stop):
+            nparticles = 0
+            npairs = 0
 
-            if tgt_pslice.stop - tgt_pslice.start == 0:
-                continue
+            for itgt_box in range(chunk_start, chunk_stop):
+                tgt_ibox = target_boxes[itgt_box]
+                tgt_pslice = self._get_target_slice(tgt_ibox)
 
-            #tgt_result = np.zeros(tgt_pslice.stop - tgt_pslice.start, self.dtype)
-            tgt_pot_result = 0
-            tgt_grad_result = 0
+                if tgt_pslice.stop - tgt_pslice.start == 0:
+                    continue
 
-            start, end = neighbor_sources_starts[itgt_box:itgt_box+2]
-            for src_ibox in neighbor_sources_lists[start:end]:
-                src_pslice = self._get_source_slice(src_ibox)
+                ntargets = tgt_pslice.stop - tgt_pslice.start
+                nparticles += ntargets
 
-                if src_pslice.stop - src_pslice.start == 0:
-                    continue
+                targets = self._get_targets(tgt_pslice)
 
-                kwargs = {}
-                kwargs.update(self.kernel_kwargs)
-                kwargs.update(self.get_source_kwargs(src_weights, src_pslice))
+                #tgt_result = np.zeros(
+                #        tgt_pslice.stop - tgt_pslice.start, self.dtype)
+                tgt_pot_result = 0
+                tgt_grad_result = 0
 
-                tmp_pot, tmp_grad = ev(
-                        sources=self._get_sources(src_pslice),
-                        targets=self._get_targets(tgt_pslice),
-                        **kwargs)
+                start, end = neighbor_sources_starts[itgt_box:itgt_box+2]
+                for src_ibox in neighbor_sources_lists[start:end]:
+                    src_pslice = self._get_source_slice(src_ibox)
+
+                    if src_pslice.stop - src_pslice.start == 0:
+                        continue
 
-                tgt_pot_result += tmp_pot
-                tgt_grad_result += tmp_grad
+                    nparticles += src_pslice.stop - src_pslice.start
+                    npairs += ntargets * (src_pslice.stop - src_pslice.start)
 
-            self.add_potgrad_onto_output(
-                    output, tgt_pslice, tgt_pot_result, tgt_grad_result)
+                    sources = self._get_sources(src_pslice)
 
-        return output
+                    potgrads = []
+                    for rhs_weights in rhs_weights_rows:
+                        kwargs = {}
+                        kwargs.update(self.kernel_kwargs)
+                        kwargs.update(
+                                self.get_source_kwargs(rhs_weights, src_pslice))
+
+                        potgrads.append(ev(
+                                sources=sources,
+                                targets=targets,
+                                **kwargs))
+
+                    tmp_pot, tmp_grad = self._stack_rhs_potgrads(
+                            potgrads, rhs_shape)
+
+                    tgt_pot_result += tmp_pot
+                    tgt_grad_result += tmp_grad
+
+                self.add_potgrad_onto_output(
+                        output, tgt_pslice, tgt_pot_result, tgt_grad_result)
+
+            self._add_counts(particles=nparticles, p2p_pairs=npairs)
+
+        self._run_in_chunks(eval_direct_chunk, len(target_boxes))
 
     @log_process(logger)
     def multipole_to_local(self,
@@ -558,7 +886,9 @@ class FMMLibExpansionWrangler(object):
             target_or_target_parent_boxes,
             starts, lists, mpole_exps):
         tree = self.tree
-        local_exps = self.local_expansion_zeros()
+
+        rhs_shape = self._get_rhs_shape(mpole_exps)
+        local_exps = self.local_expansion_zeros(rhs_shape)
 
         mploc = self.get_translation_routine("%ddmploc", vec_suffix="_imany")
 
@@ -567,125 +897,223 @@ class FMMLibExpansionWrangler(object):
             if lstart == lstop:
                 continue
 
-            starts_on_lvl = starts[lstart:lstop+1]
+            level_lists = self._get_level_interaction_lists(
+                    level_start_target_or_target_parent_box_nrs,
+                    target_or_target_parent_boxes, starts, lists, lev)
 
-            source_level_start_ibox, source_mpoles_view = \
+            _, source_mpoles_view = \
                     self.multipole_expansions_view(mpole_exps, lev)
-            target_level_start_ibox, target_local_exps_view = \
+            _, target_local_exps_view = \
                     self.local_expansions_view(local_exps, lev)
 
-            ntgt_boxes = lstop-lstart
-            itgt_box_vec = np.arange(ntgt_boxes)
-            tgt_ibox_vec = target_or_target_parent_boxes[lstart:lstop]
-
-            nsrc_boxes_per_tgt_box = (
-                    starts[lstart + itgt_box_vec+1] - starts[lstart + itgt_box_vec])
+            source_mpoles_rows = self._get_box_rhs_rows(
+                    source_mpoles_view, rhs_shape)
+            target_local_exps_rows = self._get_box_rhs_rows(
+                    target_local_exps_view, rhs_shape)
 
-            nsrc_boxes = np.sum(nsrc_boxes_per_tgt_box)
-
-            src_boxes_starts = np.empty(ntgt_boxes+1, dtype=np.int32)
-            src_boxes_starts[0] = 0
-            src_boxes_starts[1:] = np.cumsum(nsrc_boxes_per_tgt_box)
+            ntgt_boxes = lstop-lstart
+            nsrc_boxes = len(level_lists.lists)
 
             rscale = self.level_to_rscale(lev)
 
             rscale1 = np.ones(nsrc_boxes) * rscale
             rscale1_offsets = np.arange(nsrc_boxes)
 
-            kwargs = {}
-            if self.dim == 3 and self.eqn_letter == "h":
-                kwargs["radius"] = (
-                        tree.root_extent * 2**(-lev)
-                        * np.ones(ntgt_boxes))
-
             rscale2 = np.ones(ntgt_boxes, np.float64) * rscale
 
-            # These get max'd/added onto: pass initialized versions.
-            if self.dim == 3:
-                ier = np.zeros(ntgt_boxes, dtype=np.int32)
-                kwargs["ier"] = ier
+            for irhs in range(source_mpoles_rows.shape[1]):
+                kwargs = {}
+                if self.dim == 3 and self.eqn_letter == "h":
+                    kwargs["radius"] = (
+                            tree.root_extent * 2**(-lev)
+                            * np.ones(ntgt_boxes))
 
-            expn2 = np.zeros(
-                    (ntgt_boxes,) + self.expansion_shape(self.level_nterms[lev]),
-                    dtype=self.dtype)
+                # These get max'd/added onto: pass initialized versions.
+                if self.dim == 3:
+                    ier = np.zeros(ntgt_boxes, dtype=np.int32)
+                    kwargs["ier"] = ier
 
-            kwargs.update(self.kernel_kwargs)
+                expn2 = np.zeros(
+                        (ntgt_boxes,)
+                        + self.expansion_shape(self.level_nterms[lev]),
+                        dtype=self.dtype)
 
-            expn2 = mploc(
-                    rscale1=rscale1,
-                    rscale1_offsets=rscale1_offsets,
-                    rscale1_starts=src_boxes_starts,
+                kwargs.update(self.kernel_kwargs)
+
+                expn2 = mploc(
+                        rscale1=rscale1,
+                        rscale1_offsets=rscale1_offsets,
+                        rscale1_starts=level_lists.starts,
+
+                        center1=tree.box_centers,
+                        center1_offsets=level_lists.lists,
+                        center1_starts=level_lists.starts,
 
-                    center1=tree.box_centers,
-                    center1_offsets=lists,
-                    center1_starts=starts_on_lvl,
+                        expn1=source_mpoles_rows[:, irhs].T,
+                        expn1_offsets=level_lists.lists_level_indices,
+                        expn1_starts=level_lists.starts,
 
-                    expn1=source_mpoles_view.T,
-                    expn1_offsets=lists - source_level_start_ibox,
-                    expn1_starts=starts_on_lvl,
+                        rscale2=rscale2,
+                        center2=level_lists.box_centers,
+                        expn2=expn2.T,
 
-                    rscale2=rscale2,
-                    # FIXME: wrong layout, will copy
-                    center2=tree.box_centers[:, tgt_ibox_vec],
-                    expn2=expn2.T,
+                        nterms2=self.level_nterms[lev],
 
-                    nterms2=self.level_nterms[lev],
+                        **kwargs).T
 
-                    **kwargs).T
+                target_local_exps_rows[
+                        level_lists.boxes_level_indices, irhs] += expn2
 
-            target_local_exps_view[tgt_ibox_vec - target_level_start_ibox] += expn2
+            self._add_counts(translations=nsrc_boxes)
 
         return local_exps
 
-    @log_process(logger)
     def eval_multipoles(self,
             target_boxes_by_source_level, sep_smaller_nonsiblings_by_level,
             mpole_exps):
-        output = self.output_zeros()
+        output = self.output_zeros(self._get_rhs_shape(mpole_exps))
+        self.eval_multipoles_into(output,
+                target_boxes_by_source_level, sep_smaller_nonsiblings_by_level,
+                mpole_exps)
+        return output
 
+    @log_process(logger)
+    def eval_multipoles_into(self, output,
+            target_boxes_by_source_level, sep_smaller_nonsiblings_by_level,
+            mpole_exps):
         mpeval = self.get_expn_eval_routine("mp")
 
-        for isrc_level, ssn in enumerate(sep_smaller_nonsiblings_by_level):
-            source_level_start_ibox, source_mpoles_view = \
-                    self.multipole_expansions_view(mpole_exps, isrc_level)
-
-            rscale = self.level_to_rscale(isrc_level)
-
-            for itgt_box, tgt_ibox in \
-                    enumerate(target_boxes_by_source_level[isrc_level]):
+        rhs_shape = self._get_rhs_shape(mpole_exps)
+
+        level_mpoles_views = [
+                self.multipole_expansions_view(mpole_exps, isrc_level)
+                for isrc_level in range(len(sep_smaller_nonsiblings_by_level))]
+
+        # A target box may occur once for each source level. Its occurrences
+        # are grouped (in order of source level), so that each target box is
+        # processed by only one thread, and its potential is added onto the
+        # output once.
+        entry_boxes = np.concatenate(target_boxes_by_source_level)
+        if not len(entry_boxes):
+            return
+
+        entry_levels = np.concatenate([
+            np.full(len(target_boxes), isrc_level, dtype=np.intp)
+            for isrc_level, target_boxes
+            in enumerate(target_boxes_by_source_level)])
+        entry_indices = np.concatenate([
+            np.arange(len(target_boxes))
+            for target_boxes in target_boxes_by_source_level])
+
+        entry_order = np.argsort(entry_boxes, kind="mergesort")
+        sorted_entry_boxes = entry_boxes[entry_order]
+        group_starts = np.concatenate([
+            [0],
+            np.flatnonzero(np.diff(sorted_entry_boxes)) + 1,
+            [len(sorted_entry_boxes)]])
+
+        def eval_multipoles_chunk(chunk_start, chunk_stop):
+            nparticles = 0
+
+            for igroup in range(chunk_start, chunk_stop):
+                group_entries = entry_order[
+                        group_starts[igroup]:group_starts[igroup+1]]
+
+                tgt_ibox = entry_boxes[group_entries[0]]
                 tgt_pslice = self._get_target_slice(tgt_ibox)
 
                 if tgt_pslice.stop - tgt_pslice.start == 0:
                     continue
 
+                targets = self._get_targets(tgt_pslice)
+
                 tgt_pot = 0
                 tgt_grad = 0
-                start, end = ssn.starts[itgt_box:itgt_box+2]
-                for src_ibox in ssn.lists[start:end]:
-
-                    tmp_pot, tmp_grad = mpeval(
-                            rscale=rscale,
-                            center=self.tree.box_centers[:, src_ibox],
-                            expn=source_mpoles_view[
-                                src_ibox - source_level_start_ibox].T,
-                            ztarg=self._get_targets(tgt_pslice),
-                            **self.kernel_kwargs)
 
-                    tgt_pot = tgt_pot + tmp_pot
-                    tgt_grad = tgt_grad + tmp_grad
+                for ientry in group_entries:
+                    isrc_level = int(entry_levels[ientry])
+                    itgt_box = entry_indices[ientry]
+
+                    ssn = sep_smaller_nonsiblings_by_level[isrc_level]
+                    source_level_start_ibox, source_mpoles_view = \
+                            level_mpoles_views[isrc_level]
+                    rscale = self.level_to_rscale(isrc_level)
+
+                    start, end = ssn.starts[itgt_box:itgt_box+2]
+                    nparticles += (
+                            (tgt_pslice.stop - tgt_pslice.start) * (end - start))
+
+                    # Summed per source level first, to add up in the same
+                    # order as a per-level accumulation would.
+                    level_pot = 0
+                    level_grad = 0
+
+                    for src_ibox in ssn.lists[start:end]:
+                        center = self.tree.box_centers[:, src_ibox]
+                        src_mpoles = self._get_rhs_rows(
+                                source_mpoles_view[
+                                    src_ibox - source_level_start_ibox],
+                                rhs_shape)
+
+                        tmp_pot, tmp_grad = self._stack_rhs_potgrads([
+                            mpeval(
+                                rscale=rscale,
+                                center=center,
+                                expn=mpole.T,
+                                ztarg=targets,
+                                **self.kernel_kwargs)
+                            for mpole in src_mpoles], rhs_shape)
+
+                        level_pot = level_pot + tmp_pot
+                        level_grad = level_grad + tmp_grad
+
+                    tgt_pot = tgt_pot + level_pot
+                    tgt_grad = tgt_grad + level_grad
 
                 self.add_potgrad_onto_output(
                         output, tgt_pslice, tgt_pot, tgt_grad)
 
-        return output
+            self._add_counts(particles=nparticles)
+
+        self._run_in_chunks(eval_multipoles_chunk, len(group_starts) - 1)
 
-    @log_process(logger)
     def form_locals(self,
             level_start_target_or_target_parent_box_nrs,
             target_or_target_parent_boxes, starts, lists, src_weights):
-        local_exps = self.local_expansion_zeros()
+        local_exps = self.local_expansion_zeros(self._get_rhs_shape(src_weights))
+        self.form_locals_into(local_exps,
+                level_start_target_or_target_parent_box_nrs,
+                target_or_target_parent_boxes, starts, lists, src_weights)
+        return local_exps
 
-        formta = self.get_routine("%ddformta" + self.dp_suffix)
+    @log_process(logger)
+    def form_locals_into(self, local_exps,
+            level_start_target_or_target_parent_box_nrs,
+            target_or_target_parent_boxes, starts, lists, src_weights):
+        tree = self.tree
+
+        rhs_shape = self._get_rhs_shape(src_weights)
+        rhs_weights_rows = self._get_rhs_rows(src_weights, rhs_shape)
+        nrhs = len(rhs_weights_rows)
+
+        formta = self.get_routine("%ddformta" + self.dp_suffix, "_imany")
+
+        sources = self._get_single_sources_array()
+
+        # Concatenate the source arguments of all right-hand sides, so that
+        # those of right-hand side *irhs* start at *irhs*nsources*. Convert
+        # them up front rather than in every call.
+        rhs_source_kwargs = [
+                self.get_source_kwargs(rhs_weights, slice(None))
+                for rhs_weights in rhs_weights_rows]
+        source_kwargs = {}
+        for name in rhs_source_kwargs[0]:
+            value = np.concatenate(
+                    [kwargs[name] for kwargs in rhs_source_kwargs], axis=-1)
+            if value.ndim == 1:
+                # charges or dipole strengths
+                value = value.astype(self.dtype)
+            source_kwargs[name] = np.asfortranarray(value)
 
         for lev in range(self.tree.nlevels):
             lev_start, lev_stop = \
@@ -695,46 +1123,83 @@ class FMMLibExpansionWrangler(object):
 
             target_level_start_ibox, target_local_exps_view = \
                     self.local_expansions_view(local_exps, lev)
+            target_local_exps_rows = self._get_box_rhs_rows(
+                    target_local_exps_view, rhs_shape)
 
             rscale = self.level_to_rscale(lev)
 
-            for itgt_box, tgt_ibox in enumerate(
-                    target_or_target_parent_boxes[lev_start:lev_stop]):
-                start, end = starts[lev_start+itgt_box:lev_start+itgt_box+2]
+            def form_level_locals(chunk_start, chunk_stop):
+                tgt_boxes = target_or_target_parent_boxes[
+                        lev_start+chunk_start:lev_start+chunk_stop]
+                box_starts = starts[lev_start+chunk_start:lev_start+chunk_stop+1]
 
-                contrib = 0
+                src_boxes = lists[box_starts[0]:box_starts[-1]]
+                src_counts = tree.box_source_counts_nonchild[src_boxes]
 
-                for src_ibox in lists[start:end]:
-                    src_pslice = self._get_source_slice(src_ibox)
-                    tgt_center = self.tree.box_centers[:, tgt_ibox]
+                # Leave out source boxes without sources.
+                has_sources = src_counts > 0
+                nonempty_starts = np.zeros(len(src_boxes) + 1, dtype=np.intp)
+                np.cumsum(has_sources, out=nonempty_starts[1:])
+                box_entry_starts = nonempty_starts[box_starts - box_starts[0]]
 
-                    if src_pslice.stop - src_pslice.start == 0:
-                        continue
+                src_boxes = src_boxes[has_sources]
+                src_counts = src_counts[has_sources]
+                nentries = len(src_boxes)
 
-                    kwargs = {}
-                    kwargs.update(self.kernel_kwargs)
-                    kwargs.update(self.get_source_kwargs(src_weights, src_pslice))
+                if nentries == 0:
+                    return
 
-                    ier, mpole = formta(
-                            rscale=rscale,
-                            source=self._get_sources(src_pslice),
-                            center=tgt_center,
-                            nterms=self.level_nterms[lev],
-                            **kwargs)
-                    if ier:
-                        raise RuntimeError("formta failed")
+                entry_starts = self._get_imany_starts(box_entry_starts, nrhs)
+                src_particle_starts = tree.box_source_starts[src_boxes]
 
-                    contrib = contrib + mpole.T
+                kwargs = {}
+                kwargs.update(self.kernel_kwargs)
+                for name, value in source_kwargs.items():
+                    kwargs[name] = value
+                    kwargs[name + "_offsets"] = (
+                            np.arange(nrhs)[:, np.newaxis] * tree.nsources
+                            + src_particle_starts).ravel()
+                    kwargs[name + "_starts"] = entry_starts
+
+                ier, expn = formta(
+                        rscale=rscale,
 
-                target_local_exps_view[tgt_ibox-target_level_start_ibox] = contrib
+                        sources=sources,
+                        sources_offsets=np.tile(src_particle_starts, nrhs),
+                        sources_starts=entry_starts,
 
-        return local_exps
+                        nsources=src_counts,
+                        nsources_offsets=np.tile(np.arange(nentries), nrhs),
+                        nsources_starts=entry_starts,
+
+                        centers=tree.box_centers,
+                        centers_offsets=np.tile(tgt_boxes, nrhs),
+
+                        nterms=self.level_nterms[lev],
+                        **kwargs)
+
+                if (ier != 0).any():
+                    raise RuntimeError("formta failed")
+
+                expn = expn.T
+                target_local_exps_rows[
+                        tgt_boxes - target_level_start_ibox] += np.swapaxes(
+                                expn.reshape(
+                                    (nrhs, len(tgt_boxes)) + expn.shape[1:]),
+                                0, 1)
+
+                self._add_counts(particles=src_counts.sum())
+
+            self._run_in_chunks(form_level_locals, lev_stop - lev_start)
 
     @log_process(logger)
     def refine_locals(self, level_start_target_or_target_parent_box_nrs,
             target_or_target_parent_boxes, local_exps):
 
-        locloc = self.get_translation_routine("%ddlocloc")
+        locloc = self.get_translation_routine("%ddlocloc", vec_suffix="_imany")
+
+        rhs_shape = self._get_rhs_shape(local_exps)
+        nrhs = self._get_nrhs(rhs_shape)
 
         for target_lev in range(1, self.tree.nlevels):
             start, stop = level_start_target_or_target_parent_box_nrs[
@@ -742,43 +1207,49 @@ class FMMLibExpansionWrangler(object):
 
             source_lev = target_lev - 1
 
-            source_level_start_ibox, source_local_exps_view = \
+            _, source_local_exps_view = \
                     self.local_expansions_view(local_exps, source_lev)
             target_level_start_ibox, target_local_exps_view = \
                     self.local_expansions_view(local_exps, target_lev)
-            source_rscale = self.level_to_rscale(source_lev)
-            target_rscale = self.level_to_rscale(target_lev)
 
-            for tgt_ibox in target_or_target_parent_boxes[start:stop]:
-                tgt_center = self.tree.box_centers[:, tgt_ibox]
-                src_ibox = self.tree.box_parent_ids[tgt_ibox]
-                src_center = self.tree.box_centers[:, src_ibox]
+            source_local_exps = self._get_imany_expansions(
+                    source_local_exps_view, rhs_shape)
+            target_local_exps_rows = self._get_box_rhs_rows(
+                    target_local_exps_view, rhs_shape)
 
-                kwargs = {}
-                if self.dim == 3 and self.eqn_letter == "h":
-                    kwargs["radius"] = self.tree.root_extent * 2**(-target_lev)
+            level_target_boxes = target_or_target_parent_boxes[start:stop]
 
-                kwargs.update(self.kernel_kwargs)
-                tmp_loc_exp = locloc(
-                            rscale1=source_rscale,
-                            center1=src_center,
-                            expn1=source_local_exps_view[
-                                src_ibox - source_level_start_ibox].T,
+            # Levels are processed in order, since each level's local
+            # expansions are refined from those of the level above.
+            def refine_level_locals(chunk_start, chunk_stop):
+                tgt_boxes = level_target_boxes[chunk_start:chunk_stop]
 
-                            rscale2=target_rscale,
-                            center2=tgt_center,
-                            nterms2=self.level_nterms[target_lev],
+                tmp_loc_exps = self._translate_many(locloc,
+                        source_lev, source_local_exps,
+                        self.tree.box_parent_ids[tgt_boxes],
+                        np.arange(len(tgt_boxes) + 1),
+                        target_lev, tgt_boxes, nrhs)
 
-                            **kwargs)[..., 0]
+                target_local_exps_rows[
+                        tgt_boxes - target_level_start_ibox] += tmp_loc_exps
 
-                target_local_exps_view[
-                        tgt_ibox - target_level_start_ibox] += tmp_loc_exp.T
+                self._add_counts(translations=len(tgt_boxes))
+
+            self._run_in_chunks(refine_level_locals, len(level_target_boxes))
 
         return local_exps
 
-    @log_process(logger)
     def eval_locals(self, level_start_target_box_nrs, target_boxes, local_exps):
-        output = self.output_zeros()
+        output = self.output_zeros(self._get_rhs_shape(local_exps))
+        self.eval_locals_into(output,
+                level_start_target_box_nrs, target_boxes, local_exps)
+        return output
+
+    @log_process(logger)
+    def eval_locals_into(self, output,
+            level_start_target_box_nrs, target_boxes, local_exps):
+        rhs_shape = self._get_rhs_shape(local_exps)
+
         taeval = self.get_expn_eval_routine("ta")
 
         for lev in range(self.tree.nlevels):
@@ -790,26 +1261,42 @@ class FMMLibExpansionWrangler(object):
                     self.local_expansions_view(local_exps, lev)
 
             rscale = self.level_to_rscale(lev)
+            level_target_boxes = target_boxes[start:stop]
 
-            for tgt_ibox in target_boxes[start:stop]:
-                tgt_pslice = self._get_target_slice(tgt_ibox)
+            def eval_level_locals(chunk_start, chunk_stop):
+                nparticles = 0
 
-                if tgt_pslice.stop - tgt_pslice.start == 0:
-                    continue
+                for tgt_ibox in level_target_boxes[chunk_start:chunk_stop]:
+                    tgt_pslice = self._get_target_slice(tgt_ibox)
 
-                tmp_pot, tmp_grad = taeval(
-                        rscale=rscale,
-                        center=self.tree.box_centers[:, tgt_ibox],
-                        expn=source_local_exps_view[
-                            tgt_ibox - source_level_start_ibox].T,
-                        ztarg=self._get_targets(tgt_pslice),
+                    if tgt_pslice.stop - tgt_pslice.start == 0:
+                        continue
 
-                        **self.kernel_kwargs)
+                    nparticles += tgt_pslice.stop - tgt_pslice.start
 
-                self.add_potgrad_onto_output(
-                        output, tgt_pslice, tmp_pot, tmp_grad)
+                    center = self.tree.box_centers[:, tgt_ibox]
+                    targets = self._get_targets(tgt_pslice)
+                    box_local_exps = self._get_rhs_rows(
+                            source_local_exps_view[
+                                tgt_ibox - source_level_start_ibox],
+                            rhs_shape)
 
-        return output
+                    tmp_pot, tmp_grad = self._stack_rhs_potgrads([
+                        taeval(
+                            rscale=rscale,
+                            center=center,
+                            expn=local_exp.T,
+                            ztarg=targets,
+
+                            **self.kernel_kwargs)
+                        for local_exp in box_local_exps], rhs_shape)
+
+                    self.add_potgrad_onto_output(
+                            output, tgt_pslice, tmp_pot, tmp_grad)
+
+                self._add_counts(particles=nparticles)
+
+            self._run_in_chunks(eval_level_locals, len(level_target_boxes))
 
     @log_process(logger)
     def finalize_potentials(self, potential):
@@ -831,4 +1318,13 @@ class FMMLibExpansionWrangler(object):
         return potential * scale_factor
 
 
+_CHUNKS_PER_THREAD = 4
+
+
+@memoize
+def _get_legendre_nodes_and_weights(nquad):
+    from pyfmmlib import legewhts
+    return legewhts(nquad, ifwhts=1)
+
+
 # vim: foldmethod=marker
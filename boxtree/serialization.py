@@ -0,0 +1,395 @@
+from __future__ import division
+
+__copyright__ = "Copyright (C) 2018 Andreas Kloeckner"
+
+__license__ = """
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import six
+
+import json
+import struct
+
+import numpy as np
+import pyopencl as cl
+import pyopencl.array  # noqa
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+__doc__ = """
+Saving and loading trees and traversals
+---------------------------------------
+
+Building a tree and its traversal for a large number of particles takes a
+while. If the same geometry is used many times (e.g. in a parameter sweep),
+the result of the build may instead be saved to a file once and loaded from
+there::
+
+    trav, _ = tg(queue, tree)
+    save_record("geometry.boxtree", trav.get(queue=queue))
+
+    # later, possibly in another process
+    trav = load_record("geometry.boxtree")
+
+This works for any :class:`boxtree.tools.DeviceDataRecord`, such as
+:class:`boxtree.Tree`, :class:`boxtree.traversal.FMMTraversalInfo`,
+:class:`boxtree.area_query.AreaQueryResult` and
+:class:`boxtree.area_query.PeerListLookup`. Records contained in the saved
+record (such as :attr:`boxtree.traversal.FMMTraversalInfo.tree`) are saved
+along with it.
+
+By default, :func:`load_record` memory-maps the arrays from the file, so that
+host code (such as the :mod:`boxtree.pyfmmlib_integration` wranglers) can
+use them without reading the whole file or copying. Alternatively, the
+arrays may be uploaded to a device in one transfer.
+
+The file consists of a short binary preamble, a header in JSON format
+describing the structure of the record, and the raw array data, each array
+aligned to a multiple of 4096 bytes. The header carries a format version.
+
+.. autofunction:: save_record
+.. autofunction:: load_record
+"""
+
+
+_MAGIC = b"BOXTREE\0"
+_FORMAT_VERSION = 1
+
+# magic, format version, header length
+_PREAMBLE_FORMAT = "<8sIQ"
+
+# Page-aligned, which is also sufficient for device sub-buffers.
+_ALIGNMENT = 4096
+
+
+def _align(offset):
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+def _dtype_to_str(dtype):
+    dtype = np.dtype(dtype)
+    if dtype.fields is not None or dtype.subdtype is not None:
+        raise ValueError("cannot save arrays of structured dtype '%s'" % dtype)
+
+    return dtype.str
+
+
+# {{{ save
+
+class _Encoder(object):
+    def __init__(self, queue):
+        self.queue = queue
+        self.arrays = []
+        self.data_size = 0
+
+        # Arrays that occur more than once (e.g. target_boxes and source_boxes
+        # if sources and targets agree) are saved once. The original arrays
+        # are kept alive, so that their ids remain unique.
+        self.id_to_array_and_info = {}
+
+    def add_array(self, orig_ary):
+        try:
+            return self.id_to_array_and_info[id(orig_ary)][1]
+        except KeyError:
+            pass
+
+        if isinstance(orig_ary, cl.array.Array):
+            ary = orig_ary.get(queue=self.queue)
+        else:
+            ary = orig_ary
+
+        ary = np.ascontiguousarray(ary)
+
+        offset = _align(self.data_size)
+        self.data_size = offset + ary.nbytes
+        self.arrays.append((offset, ary))
+
+        info = {
+                "type": "array",
+                "dtype": _dtype_to_str(ary.dtype),
+                "shape": list(ary.shape),
+                "offset": offset,
+                }
+
+        self.id_to_array_and_info[id(orig_ary)] = (orig_ary, info)
+        return info
+
+    def __call__(self, val):
+        from boxtree.tools import DeviceDataRecord
+        from pyopencl.algorithm import BuiltList
+
+        if val is None or isinstance(val, (bool, six.string_types)):
+            return {"type": "value", "value": val}
+
+        elif isinstance(val, np.generic):
+            return {
+                    "type": "numpy_scalar",
+                    "dtype": _dtype_to_str(val.dtype),
+                    "value": val.item()}
+
+        elif isinstance(val, six.integer_types + (float,)):
+            return {"type": "value", "value": val}
+
+        elif isinstance(val, np.dtype):
+            return {"type": "dtype", "value": _dtype_to_str(val)}
+
+        elif isinstance(val, np.ndarray) and val.dtype.char == "O":
+            return {
+                    "type": "object_array",
+                    "shape": list(val.shape),
+                    "entries": [self(entry) for entry in val.flat]}
+
+        elif isinstance(val, (np.ndarray, cl.array.Array)):
+            return self.add_array(val)
+
+        elif isinstance(val, (list, tuple)):
+            return {
+                    "type": type(val).__name__,
+                    "entries": [self(entry) for entry in val]}
+
+        elif isinstance(val, dict):
+            return {
+                    "type": "dict",
+                    "entries": [[self(key), self(value)]
+                        for key, value in six.iteritems(val)]}
+
+        elif isinstance(val, BuiltList):
+            return {
+                    "type": "built_list",
+                    "fields": dict(
+                        (field, self(getattr(val, field)))
+                        for field in val.__dict__
+                        if not field.startswith("_"))}
+
+        elif isinstance(val, DeviceDataRecord):
+            cls = type(val)
+            return {
+                    "type": "record",
+                    "class": "%s:%s" % (cls.__module__, cls.__name__),
+                    "fields": dict(
+                        (field, self(getattr(val, field)))
+                        for field in sorted(cls.fields)
+                        if hasattr(val, field))}
+
+        else:
+            raise TypeError("cannot save value of type '%s'" % type(val).__name__)
+
+
+def save_record(filename, record, queue=None):
+    """Save *record* to the file *filename*.
+
+    :arg record: a :class:`boxtree.tools.DeviceDataRecord`. Its fields may
+        hold (object arrays, lists, tuples or dictionaries of)
+        :class:`numpy.ndarray` or :class:`pyopencl.array.Array` instances,
+        scalars, :class:`numpy.dtype` instances, and other records.
+    :arg queue: a :class:`pyopencl.CommandQueue` used to transfer device
+        arrays in *record* to the host, or *None*, in which case they must be
+        associated with a queue.
+    """
+    from boxtree.tools import DeviceDataRecord
+    if not isinstance(record, DeviceDataRecord):
+        raise TypeError("record must be a DeviceDataRecord")
+
+    encoder = _Encoder(queue)
+    root = encoder(record)
+
+    from boxtree.version import VERSION_TEXT
+    header = {
+            "format_version": _FORMAT_VERSION,
+            "boxtree_version": VERSION_TEXT,
+            "data_size": encoder.data_size,
+            "root": root,
+            }
+
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_offset = _align(struct.calcsize(_PREAMBLE_FORMAT) + len(header_bytes))
+
+    with open(filename, "wb") as outf:
+        outf.write(struct.pack(_PREAMBLE_FORMAT,
+            _MAGIC, _FORMAT_VERSION, len(header_bytes)))
+        outf.write(header_bytes)
+
+        for offset, ary in encoder.arrays:
+            outf.seek(data_offset + offset)
+            outf.write(ary.tobytes())
+
+        # Make sure the file extends to the end of the (possibly empty) last
+        # array.
+        outf.truncate(data_offset + encoder.data_size)
+
+    logger.info("saved %s to '%s' (%d bytes of array data)",
+            type(record).__name__, filename, encoder.data_size)
+
+# }}}
+
+
+# {{{ load
+
+class _Decoder(object):
+    def __init__(self, get_array):
+        self.get_array = get_array
+
+    def __call__(self, desc):
+        tp = desc["type"]
+
+        if tp == "value":
+            return desc["value"]
+
+        elif tp == "numpy_scalar":
+            return np.dtype(desc["dtype"]).type(desc["value"])
+
+        elif tp == "dtype":
+            return np.dtype(desc["value"])
+
+        elif tp == "array":
+            return self.get_array(
+                    np.dtype(desc["dtype"]), tuple(desc["shape"]), desc["offset"])
+
+        elif tp == "object_array":
+            result = np.empty(tuple(desc["shape"]), dtype=object)
+            for i, entry in enumerate(desc["entries"]):
+                result.flat[i] = self(entry)
+            return result
+
+        elif tp == "list":
+            return [self(entry) for entry in desc["entries"]]
+
+        elif tp == "tuple":
+            return tuple(self(entry) for entry in desc["entries"])
+
+        elif tp == "dict":
+            return dict(
+                    (self(key), self(value)) for key, value in desc["entries"])
+
+        elif tp == "built_list":
+            from pyopencl.algorithm import BuiltList
+            return BuiltList(**dict(
+                (field, self(value))
+                for field, value in six.iteritems(desc["fields"])))
+
+        elif tp == "record":
+            return self.make_record(desc["class"], dict(
+                (field, self(value))
+                for field, value in six.iteritems(desc["fields"])))
+
+        else:
+            raise ValueError("unknown entry type '%s' in file" % tp)
+
+    @staticmethod
+    def make_record(class_name, fields):
+        module_name, _, cls_name = class_name.partition(":")
+
+        # Only instantiate classes from boxtree.
+        if module_name.split(".")[0] != "boxtree":
+            raise ValueError("refusing to load record of class '%s'" % class_name)
+
+        import importlib
+        cls = getattr(importlib.import_module(module_name), cls_name)
+
+        from boxtree.tools import DeviceDataRecord
+        if not (isinstance(cls, type) and issubclass(cls, DeviceDataRecord)):
+            raise ValueError("'%s' is not a record class" % class_name)
+
+        return cls(**fields)
+
+
+def load_record(filename, queue=None, mmap_mode="r"):
+    """Load a record saved by :func:`save_record` from the file *filename*.
+
+    :arg queue: if not *None*, a :class:`pyopencl.CommandQueue`. All arrays
+        are then uploaded to the device in one transfer, and the arrays of the
+        result are :class:`pyopencl.array.Array` instances associated with
+        *queue*.
+    :arg mmap_mode: as for :func:`numpy.load`. If not *None* (the default is
+        ``"r"``), the array data is memory-mapped from the file, and the
+        arrays of the result (if *queue* is *None*) are views of the mapping.
+        With mode ``"r"``, these arrays are read-only. If *None*, the array
+        data is read into memory.
+    :returns: the record, of the same class as the one that was saved.
+    """
+    with open(filename, "rb") as inf:
+        preamble = inf.read(struct.calcsize(_PREAMBLE_FORMAT))
+
+        try:
+            magic, format_version, header_size = struct.unpack(
+                    _PREAMBLE_FORMAT, preamble)
+        except struct.error:
+            magic = None
+
+        if magic != _MAGIC:
+            raise ValueError("'%s' is not a saved boxtree record" % filename)
+
+        if format_version > _FORMAT_VERSION:
+            raise ValueError(
+                    "'%s' has format version %d, which is newer than "
+                    "the supported version %d"
+                    % (filename, format_version, _FORMAT_VERSION))
+
+        header = json.loads(inf.read(header_size).decode("utf-8"))
+
+        data_offset = _align(len(preamble) + header_size)
+        data_size = header["data_size"]
+
+        if mmap_mode is not None and data_size:
+            data = np.memmap(inf, dtype=np.uint8, mode=mmap_mode,
+                    offset=data_offset, shape=(data_size,))
+        else:
+            inf.seek(data_offset)
+            data = np.frombuffer(inf.read(data_size), dtype=np.uint8)
+            if mmap_mode is None:
+                # np.frombuffer returns a read-only array.
+                data = data.copy()
+
+    def get_nbytes(dtype, shape):
+        return dtype.itemsize * int(np.prod(shape, dtype=np.int64))
+
+    if queue is None:
+        def get_array(dtype, shape, offset):
+            nbytes = get_nbytes(dtype, shape)
+            return data[offset:offset+nbytes].view(dtype).reshape(shape)
+
+    else:
+        if data_size:
+            dev_data = cl.array.to_device(queue, data)
+
+        # Sub-buffers must be aligned to the device's base address alignment.
+        arrays_are_views = not (
+                _ALIGNMENT % (queue.device.mem_base_addr_align // 8))
+
+        def get_array(dtype, shape, offset):
+            nbytes = get_nbytes(dtype, shape)
+
+            if nbytes and arrays_are_views:
+                return cl.array.Array(queue, shape, dtype,
+                        data=dev_data.base_data, offset=offset)
+
+            result = cl.array.empty(queue, shape, dtype)
+            if nbytes:
+                cl.enqueue_copy(queue, result.data, dev_data.data,
+                        byte_count=nbytes, src_offset=offset)
+            return result
+
+    return _Decoder(get_array)(header["root"])
+
+# }}}
+
+# vim: foldmethod=marker
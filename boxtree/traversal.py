@@ -327,6 +327,40 @@ LEVEL_START_BOX_NR_EXTRACTOR_TEMPLATE = ElementwiseTemplate(
 
 # }}}
 
+# {{{ box flags for a target subset
+
+MASKED_TARGET_BOX_FLAGS_TEMPLATE = ElementwiseTemplate(
+    arguments="""//CL//
+    box_flags_t *box_flags,
+    particle_id_t *box_target_starts,
+    particle_id_t *box_target_counts_nonchild,
+    particle_id_t *box_target_counts_cumul,
+    particle_id_t *active_target_prefix_sums,
+    box_flags_t *masked_box_flags,
+    """,
+
+    operation=r"""//CL:mako//
+        particle_id_t start = box_target_starts[i];
+        particle_id_t own_stop = start + box_target_counts_nonchild[i];
+        particle_id_t stop = start + box_target_counts_cumul[i];
+
+        box_flags_t flags = box_flags[i]
+            & ~(${HAS_OWN_TARGETS} | ${HAS_CHILD_TARGETS});
+
+        // Own targets precede those of the children in tree order.
+        if (active_target_prefix_sums[own_stop]
+                != active_target_prefix_sums[start])
+            flags |= ${HAS_OWN_TARGETS};
+        if (active_target_prefix_sums[stop]
+                != active_target_prefix_sums[own_stop])
+            flags |= ${HAS_CHILD_TARGETS};
+
+        masked_box_flags[i] = flags;
+    """,
+    name="find_masked_target_box_flags")
+
+# }}}
+
 # {{{ box extents
 
 BOX_EXTENTS_FINDER_TEMPLATE = ElementwiseTemplate(
@@ -455,7 +489,7 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t box_id)
             bool a_or_o = is_adjacent_or_overlapping_with_neighborhood(
                     root_extent,
                     center, level,
-                    ${well_sep_is_n_away},
+                    level_well_sep_is_n_away[level],
                     walk_center, box_levels[walk_box_id]);
 
             if (a_or_o)
@@ -614,7 +648,7 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t itarget_or_target_parent_box)
             bool sep = !is_adjacent_or_overlapping_with_neighborhood(
                 root_extent,
                 center, level,
-                ${well_sep_is_n_away},
+                level_well_sep_is_n_away[level],
                 sib_center, box_levels[sib_box_id]);
 
             if (sep)
@@ -843,17 +877,18 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t target_box_number)
                     // non-empty intersection.
 
                     // If the number of particles in this box is below the
-                    // source count threshold, it can be moved to a "close" list.
+                    // source count threshold for its level, it can be moved to
+                    // a "close" list, because direct evaluation is cheaper than
+                    // evaluating its multipole expansion.
                     // This is a performance optimization.
 
                     bool close_lists_exist = ${"true" \
-                        if sources_have_extent or targets_have_extent \
-                        else "false"};
+                        if with_close_lists else "false"};
 
                     bool force_close_list_for_low_interaction_count =
                         close_lists_exist &&
                         (box_source_counts_cumul[walk_box_id]
-                            < from_sep_smaller_min_nsources_cumul);
+                            < from_sep_smaller_min_nsources_cumul[walk_level]);
 
                     if (meets_sep_crit &&
                         !force_close_list_for_low_interaction_count)
@@ -863,7 +898,7 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t target_box_number)
                     }
                     else
                     {
-                    %if sources_have_extent or targets_have_extent:
+                    %if with_close_lists:
                         // from_sep_smaller_source_level == -1 means "only build
                         // list 3 close", with sources on any level.
                         // This kernel will be run once per source level to
@@ -942,6 +977,11 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t target_box_number)
 # propagation at this box (noting that this can only happen in the with-extents
 # case), the interaction is added to the (non-downward-propagating) 'list 4
 # close' (from_sep_close_bigger).
+#
+# Interactions may also be moved to 'list 4 close' if direct evaluation is
+# predicted to be cheaper than forming a local expansion from the sources, based
+# on the number of targets in and below the target box. This 'cost criterion'
+# is handled exactly like the with-extents separation requirement.
 
 
 FROM_SEP_BIGGER_TEMPLATE = r"""//CL//
@@ -986,6 +1026,32 @@ inline bool meets_sep_bigger_criterion(
     return l_inf_dist >= max_allowed_center_l_inf_dist * (1 - 8 * COORD_T_MACH_EPS);
 }
 
+%if with_close_lists:
+
+// Whether an interaction of a source box on source_level with the target box
+// is cheaper through the local expansion of the target box (i.e. List 4)
+// than through direct evaluation. To keep this monotone (see above), it also
+// holds if it holds for an ancestor of the target box that is no smaller
+// than the source box.
+inline bool meets_sep_bigger_cost_criterion(
+    box_id_t target_box_id, int target_level, int source_level,
+    __global box_id_t *box_parent_ids,
+    __global particle_id_t *box_target_counts_cumul,
+    __global particle_id_t *from_sep_bigger_min_ntargets_cumul)
+{
+    for (int level = target_level; level >= source_level; --level)
+    {
+        if (box_target_counts_cumul[target_box_id]
+                >= from_sep_bigger_min_ntargets_cumul[level])
+            return true;
+
+        target_box_id = box_parent_ids[target_box_id];
+    }
+
+    return false;
+}
+
+%endif
 
 void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t itarget_or_target_parent_box)
 {
@@ -1003,20 +1069,27 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t itarget_or_target_parent_box)
 
     box_flags_t tgt_box_flags = box_flags[tgt_ibox];
 
-    %if well_sep_is_n_away == 1:
-        // In a 1-away FMM, tgt_ibox's colleagues are by default uninteresting
-        // (i.e. not in list 4) because they're adjacent. So in this case, we
-        // may directly jump to the parent level.
+    int walk_level;
+    box_id_t current_tgt_parent_box_id;
 
-        int walk_level = tgt_box_level - 1;
-        box_id_t current_tgt_parent_box_id = tgt_parent_box_id;
-    %else:
-        // In a 2+-away FMM, tgt_ibox's same-level non-well-separated boxes *may*
-        // be sufficiently separated from tgt_ibox to be in its list 4.
+    if (level_well_sep_is_n_away[tgt_box_level] == 1)
+    {
+        // If tgt_ibox's level is 1-away, tgt_ibox's colleagues are by default
+        // uninteresting (i.e. not in list 4) because they're adjacent. So in
+        // this case, we may directly jump to the parent level.
 
-        int walk_level = tgt_box_level;
-        box_id_t current_tgt_parent_box_id = tgt_ibox;
-    %endif
+        walk_level = tgt_box_level - 1;
+        current_tgt_parent_box_id = tgt_parent_box_id;
+    }
+    else
+    {
+        // If tgt_ibox's level is 2+-away, tgt_ibox's same-level
+        // non-well-separated boxes *may* be sufficiently separated from
+        // tgt_ibox to be in its list 4.
+
+        walk_level = tgt_box_level;
+        current_tgt_parent_box_id = tgt_ibox;
+    }
 
     /*
     Look for same-level non-well-separated boxes of parents that are
@@ -1054,25 +1127,34 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t itarget_or_target_parent_box)
 
                 if (!in_list_1)
                 {
-                    %if sources_have_extent or targets_have_extent:
+                    %if with_close_lists:
                         /*
-                        With-extent list 4 separation criterion.
-                        Needs to be monotone.  (see main comment narrative
-                        above for what that means) If you change this, also
-                        change the equivalent check for the parent, below.
+                        With-extent list 4 separation criterion, and
+                        interaction cost criterion.
+                        Need to be monotone.  (see main comment narrative
+                        above for what that means) If you change these, also
+                        change the equivalent checks for the parent, below.
                         */
                         const bool tgt_meets_with_ext_sep_criterion =
-                            meets_sep_bigger_criterion(root_extent,
-                                tgt_box_center, tgt_box_level,
-                                slnws_center, walk_level,
-                                stick_out_factor);
+                            %if sources_have_extent or targets_have_extent:
+                                meets_sep_bigger_criterion(root_extent,
+                                    tgt_box_center, tgt_box_level,
+                                    slnws_center, walk_level,
+                                    stick_out_factor)
+                            %else:
+                                true
+                            %endif
+                            && meets_sep_bigger_cost_criterion(
+                                tgt_ibox, tgt_box_level, walk_level,
+                                box_parent_ids, box_target_counts_cumul,
+                                from_sep_bigger_min_ntargets_cumul);
 
                     if (!tgt_meets_with_ext_sep_criterion)
                     {
                         /*
                         slnws_box_id failed the separation criterion (i.e.  is
-                        too close to the target box) for list 4 proper. Stick
-                        it in list 4 close.
+                        too close to the target box) or the cost criterion
+                        for list 4 proper. Stick it in list 4 close.
                         */
 
                         if (tgt_box_flags & BOX_HAS_OWN_TARGETS)
@@ -1090,25 +1172,22 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t itarget_or_target_parent_box)
 
                         bool would_be_in_parent_list_4_not_considering_stickout = (
                                 !in_parent_list_1
-                                %if well_sep_is_n_away > 1:
-                                    /*
-                                    From-sep-bigger boxes can only be in the
-                                    parent's from-sep-bigger list if they're
-                                    actually bigger (or equal) to the parent
-                                    box size.
-
-                                    For 1-away, that's guaranteed at this
-                                    point, because we only start ascending the
-                                    tree at the parent's level, so any box we
-                                    find here is naturally big enough. For
-                                    2-away, we start looking at the target
-                                    box's level, so slnws_box_id may actually
-                                    be too small (at too deep a level) to be in
-                                    the parent's from-sep-bigger list.
-                                    */
-
-                                    && walk_level < tgt_box_level
-                                %endif
+                                /*
+                                From-sep-bigger boxes can only be in the
+                                parent's from-sep-bigger list if they're
+                                actually bigger (or equal) to the parent
+                                box size.
+
+                                For 1-away, that's guaranteed at this
+                                point, because we only start ascending the
+                                tree at the parent's level, so any box we
+                                find here is naturally big enough. For
+                                2-away, we start looking at the target
+                                box's level, so slnws_box_id may actually
+                                be too small (at too deep a level) to be in
+                                the parent's from-sep-bigger list.
+                                */
+                                && walk_level < tgt_box_level
                                 );
 
                         if (would_be_in_parent_list_4_not_considering_stickout)
@@ -1130,12 +1209,21 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t itarget_or_target_parent_box)
                             change the equivalent check for the target box, above.
                             */
 
-                            %if sources_have_extent or targets_have_extent:
+                            %if with_close_lists:
                                 const bool parent_meets_with_ext_sep_criterion =
-                                    meets_sep_bigger_criterion(root_extent,
-                                        parent_center, tgt_parent_level,
-                                        slnws_center, walk_level,
-                                        stick_out_factor);
+                                    %if sources_have_extent or targets_have_extent:
+                                        meets_sep_bigger_criterion(root_extent,
+                                            parent_center, tgt_parent_level,
+                                            slnws_center, walk_level,
+                                            stick_out_factor)
+                                    %else:
+                                        true
+                                    %endif
+                                    && meets_sep_bigger_cost_criterion(
+                                        tgt_parent_box_id, tgt_parent_level,
+                                        walk_level,
+                                        box_parent_ids, box_target_counts_cumul,
+                                        from_sep_bigger_min_ntargets_cumul);
 
                                 if (!parent_meets_with_ext_sep_criterion)
                                 {
@@ -1162,6 +1250,246 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t itarget_or_target_parent_box)
 
 # }}}
 
+# {{{ neighbor source boxes merged with close lists ("unified list 1")
+
+# The kernel code for lists 1, 3 close, and 4 close is combined into one
+# generator, with the 'generate' functions of the individual templates renamed.
+# The non-close parts of lists 3 and 4 are discarded.
+
+MERGED_NEIGHBOR_SOURCE_BOXES_TEMPLATE = (
+        r"""//CL//
+
+#define APPEND_from_sep_smaller(value) { /* nothing */ }
+#define APPEND_from_sep_bigger(value) { /* nothing */ }
+#define APPEND_from_sep_close_smaller(value) \
+    APPEND_neighbor_source_boxes(value)
+#define APPEND_from_sep_close_bigger(value) \
+    APPEND_neighbor_source_boxes(value)
+
+"""
+        + NEIGBHOR_SOURCE_BOXES_TEMPLATE.replace(
+            "void generate(", "void generate_neighbor_source_boxes(", 1)
+        + FROM_SEP_SMALLER_TEMPLATE.replace(
+            "void generate(", "void generate_from_sep_close_smaller(", 1)
+        + FROM_SEP_BIGGER_TEMPLATE.replace(
+            "void generate(", "void generate_from_sep_close_bigger(", 1)
+        + r"""//CL//
+
+void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t target_box_number)
+{
+    // The order of the entries agrees with that of
+    // FMMTraversalInfo.merge_close_lists.
+
+    generate_neighbor_source_boxes(LIST_ARGS USER_ARGS target_box_number);
+
+    // from_sep_smaller_source_level is -1, so that only list 3 close is
+    // generated.
+    generate_from_sep_close_smaller(LIST_ARGS USER_ARGS target_box_number);
+
+    // target_or_target_parent_boxes holds the target boxes for this kernel.
+    generate_from_sep_close_bigger(LIST_ARGS USER_ARGS target_box_number);
+}
+""")
+
+# }}}
+
+
+# {{{ uniform grid lookups (all leaves on one level)
+
+# For trees in which all leaves are on the finest level, each level is a
+# (possibly sparse) grid of boxes. The following replace the tree walks above
+# by lookups in a per-level dense table of box ids, indexed by integer box
+# coordinates. Empty cells of the table hold 0, which (other than for the
+# root) is never a valid box id.
+
+UNIFORM_GRID_BOX_IDS_TEMPLATE = ElementwiseTemplate(
+    arguments="""//CL:mako//
+    coord_t *box_centers,
+    coord_t root_extent,
+    box_id_t aligned_nboxes,
+    box_level_t *box_levels,
+    long *level_grid_starts,
+    box_id_t *level_grid_box_ids,
+    """,
+
+    operation=r"""//CL:mako//
+        int level = box_levels[i];
+        coord_t box_size = root_extent / (coord_t) (1 << level);
+
+        long grid_index = 0;
+        %for iaxis in range(dimensions-1, -1, -1):
+        {
+            coord_t rel_center = (
+                box_centers[aligned_nboxes * ${iaxis} + i]
+                - box_centers[aligned_nboxes * ${iaxis}]
+                + 0.5 * root_extent);
+            grid_index = grid_index * (1 << level)
+                + (long) floor(rel_center / box_size);
+        }
+        %endfor
+
+        level_grid_box_ids[level_grid_starts[level] + grid_index] = i;
+    """,
+    name="find_uniform_grid_box_ids")
+
+
+UNIFORM_GRID_HELPER_TEMPLATE = r"""//CL:mako//
+
+<%def name="load_grid_coords(name, box_id, level)">
+    int ${name}[${dimensions}];
+    {
+        coord_t gc_box_size = root_extent / (coord_t) (1 << ${level});
+        %for i in range(dimensions):
+            ${name}[${i}] = (int) floor(
+                (box_centers[aligned_nboxes * ${i} + ${box_id}]
+                    - box_centers[aligned_nboxes * ${i}]
+                    + 0.5 * root_extent)
+                / gc_box_size);
+        %endfor
+    }
+</%def>
+
+<%def name="for_each_grid_offset(name, lower, upper)">
+    %for i in range(dimensions):
+        for (int ${name}${i} = ${lower}; ${name}${i} <= ${upper}; ++${name}${i})
+    %endfor
+</%def>
+
+inline box_id_t get_grid_box_id(
+    __global const long *level_grid_starts,
+    __global const box_id_t *level_grid_box_ids,
+    int level, int *coords)
+{
+    // Returns 0 if there is no box at *coords*.
+
+    int level_size = 1 << level;
+    long grid_index = 0;
+
+    for (int i = ${dimensions}-1; i >= 0; --i)
+    {
+        if (coords[i] < 0 || coords[i] >= level_size)
+            return 0;
+
+        grid_index = grid_index * level_size + coords[i];
+    }
+
+    return level_grid_box_ids[level_grid_starts[level] + grid_index];
+}
+
+"""
+
+
+UNIFORM_SAME_LEVEL_NON_WELL_SEP_BOXES_TEMPLATE = r"""//CL//
+
+void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t box_id)
+{
+    if (box_id == 0)
+    {
+        // The root has no boxes on the same level, nws or not.
+        return;
+    }
+
+    int level = box_levels[box_id];
+    ${load_grid_coords("coords", "box_id", "level")}
+
+    int nws = level_well_sep_is_n_away[level];
+
+    ${for_each_grid_offset("offset", "-nws", "nws")}
+    {
+        int nb_coords[${dimensions}];
+        bool is_self = true;
+        %for i in range(dimensions):
+            nb_coords[${i}] = coords[${i}] + offset${i};
+            is_self = is_self && offset${i} == 0;
+        %endfor
+
+        if (is_self)
+            continue;
+
+        box_id_t nb_box_id = get_grid_box_id(
+            level_grid_starts, level_grid_box_ids, level, nb_coords);
+
+        if (nb_box_id)
+            APPEND_same_level_non_well_sep_boxes(nb_box_id);
+    }
+}
+
+"""
+
+
+UNIFORM_NEIGHBOR_SOURCE_BOXES_TEMPLATE = r"""//CL//
+
+void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t target_box_number)
+{
+    // /!\ target_box_number is *not* a box_id, despite the type.
+
+    box_id_t box_id = target_boxes[target_box_number];
+
+    int level = box_levels[box_id];
+    ${load_grid_coords("coords", "box_id", "level")}
+
+    // All source boxes are on the same level as the target box, so only
+    // adjacent boxes on that level (including the box itself) qualify.
+    ${for_each_grid_offset("offset", -1, 1)}
+    {
+        int nb_coords[${dimensions}];
+        %for i in range(dimensions):
+            nb_coords[${i}] = coords[${i}] + offset${i};
+        %endfor
+
+        box_id_t nb_box_id = get_grid_box_id(
+            level_grid_starts, level_grid_box_ids, level, nb_coords);
+
+        if (nb_box_id && (box_flags[nb_box_id] & BOX_HAS_OWN_SOURCES))
+            APPEND_neighbor_source_boxes(nb_box_id);
+    }
+}
+
+"""
+
+
+UNIFORM_FROM_SEP_SIBLINGS_TEMPLATE = r"""//CL//
+
+void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t itarget_or_target_parent_box)
+{
+    box_id_t box_id = target_or_target_parent_boxes[itarget_or_target_parent_box];
+
+    if (box_id == 0)
+        return;
+
+    int level = box_levels[box_id];
+    ${load_grid_coords("coords", "box_id", "level")}
+
+    int nws = level_well_sep_is_n_away[level];
+    int parent_nws = level_well_sep_is_n_away[level-1];
+
+    // Visit the children of the boxes in the parent's neighborhood, i.e. the
+    // boxes within a (2*parent_nws+1)-box neighborhood of the parent,
+    // and keep those not within the neighborhood of this box.
+    ${for_each_grid_offset("offset", "-2*parent_nws", "2*parent_nws+1")}
+    {
+        int sib_coords[${dimensions}];
+        bool sep = false;
+        %for i in range(dimensions):
+            sib_coords[${i}] = 2*(coords[${i}] >> 1) + offset${i};
+            sep = sep || abs(sib_coords[${i}] - coords[${i}]) > nws;
+        %endfor
+
+        if (!sep)
+            continue;
+
+        box_id_t sib_box_id = get_grid_box_id(
+            level_grid_starts, level_grid_box_ids, level, sib_coords);
+
+        if (sib_box_id)
+            APPEND_from_sep_siblings(sib_box_id);
+    }
+}
+
+"""
+
+# }}}
+
 
 # {{{ traversal info (output)
 
@@ -1187,7 +1515,15 @@ class FMMTraversalInfo(DeviceDataRecord):
 
         The distance (measured in target box diameters in the :math:`l^\infty`
         norm) from the edge of the target box at which the 'well-separated'
-        (i.e. M2L-handled) 'far-field' starts.
+        (i.e. M2L-handled) 'far-field' starts. *None* if this distance
+        differs between levels, see :attr:`level_well_sep_is_n_away`.
+
+    .. attribute:: level_well_sep_is_n_away
+
+        ``int32 [nlevels]``
+
+        The value of :attr:`well_sep_is_n_away` for target boxes on each level.
+        (a :class:`numpy.ndarray`)
 
     .. ------------------------------------------------------------------------
     .. rubric:: Basic box lists for iteration
@@ -1295,8 +1631,8 @@ class FMMTraversalInfo(DeviceDataRecord):
     .. ------------------------------------------------------------------------
 
     Boxes considered to be within the 'non-well-separated area' according to
-    :attr:`well_sep_is_n_away` that are on the same level as their reference
-    box. See :ref:`csr`.
+    :attr:`level_well_sep_is_n_away` that are on the same level as their
+    reference box. See :ref:`csr`.
 
     This is a generalization of the "colleagues" concept from the Carrier paper
     to the case in which :attr:`well_sep_is_n_away` is not 1.
@@ -1351,7 +1687,9 @@ class FMMTraversalInfo(DeviceDataRecord):
     :attr:`from_sep_close_smaller_starts` will be non-*None*. It records
     interactions between boxes that would ordinarily be handled
     through "List 3", but must be evaluated specially/directly
-    because of :ref:`extent`.
+    because of :ref:`extent`, or are cheaper to evaluate directly
+    (see the *cost_model* argument of :meth:`FMMTraversalBuilder.__call__`,
+    which also makes this list present without extent).
 
     .. attribute:: target_boxes_sep_smaller_by_source_level
 
@@ -1401,7 +1739,10 @@ class FMMTraversalInfo(DeviceDataRecord):
     :attr:`boxtree.Tree.targets_have_extent`, then
     :attr:`from_sep_close_bigger_starts` will be non-*None*. It records
     interactions between boxes that would ordinarily be handled through "List
-    4", but must be evaluated specially/directly because of :ref:`extent`.
+    4", but must be evaluated specially/directly because of :ref:`extent`, or
+    are cheaper to evaluate directly (see the *cost_model* argument of
+    :meth:`FMMTraversalBuilder.__call__`, which also makes this list present
+    without extent).
 
     Indexed like :attr:`target_or_target_parent_boxes`. See :ref:`csr`.
 
@@ -1606,6 +1947,9 @@ class FMMTraversalBuilder:
             (Only 1 and 2 are tested.)
             The spacing between boxes that is considered "well-separated" for
             :attr:`from_sep_siblings` (List 2).
+            May also be a function that takes a level number and returns
+            the spacing to use for boxes on that level. The spacing on a
+            level may be at most twice that on the level above it.
         :arg from_sep_smaller_crit: The criterion used to determine separation
             box dimensions and separation for :attr:`from_sep_smaller_by_level`
             (List 3). May be one of ``"static_linf"`` (use the box square,
@@ -1618,6 +1962,27 @@ class FMMTraversalBuilder:
         self.well_sep_is_n_away = well_sep_is_n_away
         self.from_sep_smaller_crit = from_sep_smaller_crit
 
+    def get_level_well_sep_is_n_away(self, nlevels):
+        """
+        :returns: a :class:`numpy.ndarray` of :class:`numpy.int32` with the
+            value of *well_sep_is_n_away* for each of the *nlevels* levels.
+        """
+        if callable(self.well_sep_is_n_away):
+            result = np.array(
+                    [self.well_sep_is_n_away(ilevel) for ilevel in range(nlevels)],
+                    dtype=np.int32)
+        else:
+            result = np.empty(nlevels, dtype=np.int32)
+            result.fill(self.well_sep_is_n_away)
+
+        if (result < 1).any():
+            raise ValueError("well_sep_is_n_away must be at least 1")
+        if (result[1:] > 2*result[:-1]).any():
+            raise ValueError("well_sep_is_n_away may at most double "
+                    "from one level to the next")
+
+        return result
+
     # {{{ kernel builder
 
     @memoize_method
@@ -1625,7 +1990,7 @@ class FMMTraversalBuilder:
     def get_kernel_info(self, dimensions, particle_id_dtype, box_id_dtype,
             coord_dtype, box_level_dtype, max_levels,
             sources_are_targets, sources_have_extent, targets_have_extent,
-            extent_norm):
+            extent_norm, with_close_lists):
 
         # {{{ process from_sep_smaller_crit
 
@@ -1686,8 +2051,8 @@ class FMMTraversalBuilder:
                 sources_are_targets=sources_are_targets,
                 sources_have_extent=sources_have_extent,
                 targets_have_extent=targets_have_extent,
-                well_sep_is_n_away=self.well_sep_is_n_away,
                 from_sep_smaller_crit=from_sep_smaller_crit,
+                with_close_lists=with_close_lists,
                 )
         from pyopencl.algorithm import ListOfListsBuilder
         from pyopencl.tools import VectorArg, ScalarArg
@@ -1735,6 +2100,33 @@ class FMMTraversalBuilder:
                         ),
                     )
 
+        result["masked_target_box_flags_finder"] = \
+                MASKED_TARGET_BOX_FLAGS_TEMPLATE.build(self.context,
+                    type_aliases=(
+                        ("box_flags_t", box_flags_enum.dtype),
+                        ("particle_id_t", particle_id_dtype),
+                        ),
+                    var_values=(
+                        ("HAS_OWN_TARGETS", box_flags_enum.HAS_OWN_TARGETS),
+                        ("HAS_CHILD_TARGETS", box_flags_enum.HAS_CHILD_TARGETS),
+                        ),
+                    )
+
+        from pyopencl.scan import GenericScanKernel
+        result["active_target_prefix_sum_scan"] = GenericScanKernel(
+                self.context, particle_id_dtype,
+                arguments=(
+                    "char *tree_order_target_mask, "
+                    "%s *active_target_prefix_sums"
+                    % dtype_to_ctype(particle_id_dtype)),
+                input_expr="(tree_order_target_mask[i] != 0)",
+                scan_expr="a+b", neutral="0",
+                output_statement="""
+                    if (i == 0)
+                        active_target_prefix_sums[0] = 0;
+                    active_target_prefix_sums[i+1] = item;
+                    """)
+
         result["level_start_box_nrs_extractor"] = \
                 LEVEL_START_BOX_NR_EXTRACTOR_TEMPLATE.build(self.context,
                     type_aliases=(
@@ -1758,7 +2150,10 @@ class FMMTraversalBuilder:
 
         for list_name, template, extra_args, extra_lists, eliminate_empty_list in [
                 ("same_level_non_well_sep_boxes",
-                    SAME_LEVEL_NON_WELL_SEP_BOXES_TEMPLATE, [], [], []),
+                    SAME_LEVEL_NON_WELL_SEP_BOXES_TEMPLATE,
+                        [
+                            VectorArg(np.int32, "level_well_sep_is_n_away"),
+                            ], [], []),
                 ("neighbor_source_boxes", NEIGBHOR_SOURCE_BOXES_TEMPLATE,
                         [
                             VectorArg(box_id_dtype, "target_boxes"),
@@ -1771,6 +2166,7 @@ class FMMTraversalBuilder:
                                 "same_level_non_well_sep_boxes_starts"),
                             VectorArg(box_id_dtype,
                                 "same_level_non_well_sep_boxes_lists"),
+                            VectorArg(np.int32, "level_well_sep_is_n_away"),
                             ], [], []),
                 ("from_sep_smaller", FROM_SEP_SMALLER_TEMPLATE,
                         [
@@ -1783,12 +2179,12 @@ class FMMTraversalBuilder:
                             VectorArg(coord_dtype, "box_target_bounding_box_min"),
                             VectorArg(coord_dtype, "box_target_bounding_box_max"),
                             VectorArg(particle_id_dtype, "box_source_counts_cumul"),
-                            ScalarArg(particle_id_dtype,
+                            VectorArg(particle_id_dtype,
                                 "from_sep_smaller_min_nsources_cumul"),
                             ScalarArg(box_id_dtype, "from_sep_smaller_source_level"),
                             ],
                             ["from_sep_close_smaller"]
-                            if sources_have_extent or targets_have_extent
+                            if with_close_lists
                             else [], ["from_sep_smaller"]),
                 ("from_sep_bigger", FROM_SEP_BIGGER_TEMPLATE,
                         [
@@ -1799,9 +2195,13 @@ class FMMTraversalBuilder:
                                 "same_level_non_well_sep_boxes_starts"),
                             VectorArg(box_id_dtype,
                                 "same_level_non_well_sep_boxes_lists"),
+                            VectorArg(np.int32, "level_well_sep_is_n_away"),
+                            VectorArg(particle_id_dtype, "box_target_counts_cumul"),
+                            VectorArg(particle_id_dtype,
+                                "from_sep_bigger_min_ntargets_cumul"),
                             ],
                             ["from_sep_close_bigger"]
-                            if sources_have_extent or targets_have_extent
+                            if with_close_lists
                             else [], []),
                 ]:
             src = Template(
@@ -1822,6 +2222,151 @@ class FMMTraversalBuilder:
 
         # }}}
 
+        # {{{ build unified list 1 builder
+
+        if with_close_lists:
+            src = Template(
+                    TRAVERSAL_PREAMBLE_TEMPLATE
+                    + HELPER_FUNCTION_TEMPLATE
+                    + MERGED_NEIGHBOR_SOURCE_BOXES_TEMPLATE,
+                    strict_undefined=True).render(**render_vars)
+
+            result["merged_neighbor_source_boxes_builder"] = ListOfListsBuilder(
+                    self.context,
+                    [("neighbor_source_boxes", box_id_dtype)],
+                    str(src),
+                    arg_decls=base_args + [
+                        VectorArg(box_id_dtype, "target_boxes"),
+                        ScalarArg(coord_dtype, "stick_out_factor"),
+                        VectorArg(box_id_dtype,
+                            "same_level_non_well_sep_boxes_starts"),
+                        VectorArg(box_id_dtype,
+                            "same_level_non_well_sep_boxes_lists"),
+                        VectorArg(coord_dtype, "box_target_bounding_box_min"),
+                        VectorArg(coord_dtype, "box_target_bounding_box_max"),
+                        VectorArg(particle_id_dtype, "box_source_counts_cumul"),
+                        VectorArg(particle_id_dtype,
+                            "from_sep_smaller_min_nsources_cumul"),
+                        ScalarArg(box_id_dtype, "from_sep_smaller_source_level"),
+                        VectorArg(box_id_dtype, "target_or_target_parent_boxes"),
+                        VectorArg(box_id_dtype, "box_parent_ids"),
+                        VectorArg(np.int32, "level_well_sep_is_n_away"),
+                        VectorArg(particle_id_dtype, "box_target_counts_cumul"),
+                        VectorArg(particle_id_dtype,
+                            "from_sep_bigger_min_ntargets_cumul"),
+                        ],
+                    debug=debug, name_prefix="merged_neighbor_source_boxes",
+                    complex_kernel=True)
+
+            # List 4 close is part of the unified list 1, so discard it here.
+            # (ListOfListsBuilder does not permit omitting a list that the
+            # kernel appends to.)
+            src = Template(
+                    TRAVERSAL_PREAMBLE_TEMPLATE
+                    + HELPER_FUNCTION_TEMPLATE
+                    + "#define APPEND_from_sep_close_bigger(value) "
+                    "{ /* nothing */ }\n"
+                    + FROM_SEP_BIGGER_TEMPLATE,
+                    strict_undefined=True).render(**render_vars)
+
+            result["from_sep_bigger_without_close_builder"] = \
+                    ListOfListsBuilder(self.context,
+                        [("from_sep_bigger", box_id_dtype)],
+                        str(src),
+                        arg_decls=base_args + [
+                            ScalarArg(coord_dtype, "stick_out_factor"),
+                            VectorArg(box_id_dtype,
+                                "target_or_target_parent_boxes"),
+                            VectorArg(box_id_dtype, "box_parent_ids"),
+                            VectorArg(box_id_dtype,
+                                "same_level_non_well_sep_boxes_starts"),
+                            VectorArg(box_id_dtype,
+                                "same_level_non_well_sep_boxes_lists"),
+                            VectorArg(np.int32, "level_well_sep_is_n_away"),
+                            VectorArg(particle_id_dtype,
+                                "box_target_counts_cumul"),
+                            VectorArg(particle_id_dtype,
+                                "from_sep_bigger_min_ntargets_cumul"),
+                            ],
+                        debug=debug, name_prefix="from_sep_bigger_without_close",
+                        complex_kernel=True)
+
+        # }}}
+
+        return _KernelInfo(**result)
+
+    @memoize_method
+    @log_process(logger)
+    def get_uniform_grid_kernel_info(self, dimensions, box_id_dtype,
+            coord_dtype, box_level_dtype):
+        from pyopencl.tools import dtype_to_ctype
+        from boxtree.tree import box_flags_enum
+        render_vars = dict(
+                np=np,
+                dimensions=dimensions,
+                dtype_to_ctype=dtype_to_ctype,
+                particle_id_dtype=None,
+                box_id_dtype=box_id_dtype,
+                box_flags_enum=box_flags_enum,
+                coord_dtype=coord_dtype,
+                vec_types=cl.cltypes.vec_types,
+                # not used by the grid lookups
+                max_levels=0,
+                debug=False,
+                )
+        from pyopencl.algorithm import ListOfListsBuilder
+        from pyopencl.tools import VectorArg, ScalarArg
+
+        result = {}
+
+        result["grid_box_ids_finder"] = \
+                UNIFORM_GRID_BOX_IDS_TEMPLATE.build(self.context,
+                    type_aliases=(
+                        ("box_id_t", box_id_dtype),
+                        ("box_level_t", box_level_dtype),
+                        ("coord_t", coord_dtype),
+                        ),
+                    var_values=(
+                        ("dimensions", dimensions),
+                        ),
+                    )
+
+        base_args = [
+                VectorArg(coord_dtype, "box_centers"),
+                ScalarArg(coord_dtype, "root_extent"),
+                VectorArg(np.uint8, "box_levels"),
+                ScalarArg(box_id_dtype, "aligned_nboxes"),
+                VectorArg(box_flags_enum.dtype, "box_flags"),
+                VectorArg(np.int64, "level_grid_starts"),
+                VectorArg(box_id_dtype, "level_grid_box_ids"),
+                ]
+
+        for list_name, template, extra_args in [
+                ("same_level_non_well_sep_boxes",
+                    UNIFORM_SAME_LEVEL_NON_WELL_SEP_BOXES_TEMPLATE,
+                    [VectorArg(np.int32, "level_well_sep_is_n_away")]),
+                ("neighbor_source_boxes",
+                    UNIFORM_NEIGHBOR_SOURCE_BOXES_TEMPLATE,
+                    [VectorArg(box_id_dtype, "target_boxes")]),
+                ("from_sep_siblings", UNIFORM_FROM_SEP_SIBLINGS_TEMPLATE,
+                    [
+                        VectorArg(box_id_dtype, "target_or_target_parent_boxes"),
+                        VectorArg(np.int32, "level_well_sep_is_n_away"),
+                        ]),
+                ]:
+            src = Template(
+                    TRAVERSAL_PREAMBLE_TEMPLATE
+                    + UNIFORM_GRID_HELPER_TEMPLATE
+                    + template,
+                    strict_undefined=True).render(**render_vars)
+
+            result[list_name+"_builder"] = ListOfListsBuilder(self.context,
+                    [(list_name, box_id_dtype)],
+                    str(src),
+                    arg_decls=base_args + extra_args,
+                    name_prefix="uniform_"+list_name,
+                    complex_kernel=True)
+
         return _KernelInfo(**result)
 
     # }}}
@@ -1829,22 +2374,53 @@ class FMMTraversalBuilder:
     # {{{ driver
 
     def __call__(self, queue, tree, wait_for=None, debug=False,
-            _from_sep_smaller_min_nsources_cumul=None):
+            concurrent_lists=False, target_mask=None, merge_close_lists=False,
+            cost_model=None, _from_sep_smaller_min_nsources_cumul=None,
+            _allow_uniform_grid=True):
         """
         :arg queue: A :class:`pyopencl.CommandQueue` instance.
         :arg tree: A :class:`boxtree.Tree` instance.
         :arg wait_for: may either be *None* or a list of :class:`pyopencl.Event`
             instances for whose completion this command waits before starting
             exeuction.
+        :arg concurrent_lists: If *True*, Lists 1, 2, 3 and 4 are built
+            concurrently, each from its own host thread and on its own
+            :class:`pyopencl.CommandQueue` (created on the context and device
+            of *queue*), with dependencies expressed through events. Since
+            building each list involves reading back list sizes to the host,
+            this allows the list builds to overlap on devices that can run
+            several kernels at a time, such as CPUs.
+        :arg target_mask: If not *None*, an array of length
+            :attr:`boxtree.Tree.ntargets` of :class:`numpy.int8` flags (as for
+            :meth:`boxtree.tree.ParticleListFilter.filter_target_lists_in_tree_order`),
+            which indicate by being nonzero that the corresponding target
+            (in user target order) is active. :attr:`FMMTraversalInfo.target_boxes`
+            and :attr:`FMMTraversalInfo.target_or_target_parent_boxes` (and
+            hence all interaction lists) are then restricted to boxes
+            containing active targets, and their ancestors, respectively.
+            An FMM driven by the resulting traversal computes correct
+            potentials for the active targets. The potentials of inactive
+            targets are only meaningful if they share a leaf box with an
+            active one.
+        :arg merge_close_lists: If *True*, the result is the same as that of
+            :meth:`FMMTraversalInfo.merge_close_lists`, but Lists 3 close
+            and 4 close are generated as part of List 1, rather than built
+            separately and merged afterwards.
+        :arg cost_model: If not *None*, a :class:`boxtree.cost.FMMCostModel`
+            (with expansion orders given by its *level_to_order*) used to
+            decide, for each List 3 and List 4 interaction, whether it is
+            cheaper to carry out through an expansion or by direct evaluation,
+            based on the expansion order and the source or target count. (See
+            :meth:`boxtree.cost.FMMCostModel.get_close_list_thresholds`.)
+            Interactions found to be cheaper by direct evaluation are moved
+            to :attr:`FMMTraversalInfo.from_sep_close_smaller_starts` and
+            :attr:`FMMTraversalInfo.from_sep_close_bigger_starts`, which are
+            then present even if neither sources nor targets have extent.
         :return: A tuple *(trav, event)*, where *trav* is a new instance of
             :class:`FMMTraversalInfo` and *event* is a :class:`pyopencl.Event`
             for dependency management.
         """
 
-        if _from_sep_smaller_min_nsources_cumul is None:
-            # default to old no-threshold behavior
-            _from_sep_smaller_min_nsources_cumul = 0
-
         if not tree._is_pruned:
             raise ValueError("tree must be pruned for traversal generation")
 
@@ -1859,12 +2435,60 @@ class FMMTraversalBuilder:
         from pytools import div_ceil
         max_levels = div_ceil(tree.nlevels, 5) * 5
 
+        # With a target mask, the target boxes differ from the source boxes
+        # even if the particles agree.
+        sources_are_target_boxes = (
+                tree.sources_are_targets and target_mask is None)
+
+        with_extent = tree.sources_have_extent or tree.targets_have_extent
+
+        # {{{ direct evaluation thresholds for lists 3 and 4
+
+        if cost_model is not None:
+            from_sep_smaller_min_nsources_cumul, \
+                    from_sep_bigger_min_ntargets_cumul = \
+                    cost_model.get_close_list_thresholds(tree)
+        else:
+            if _from_sep_smaller_min_nsources_cumul is None:
+                # default to old no-threshold behavior
+                _from_sep_smaller_min_nsources_cumul = 0
+
+            from_sep_smaller_min_nsources_cumul = np.empty(
+                    tree.nlevels, tree.particle_id_dtype)
+            from_sep_smaller_min_nsources_cumul.fill(
+                    _from_sep_smaller_min_nsources_cumul)
+            from_sep_bigger_min_ntargets_cumul = np.zeros(
+                    tree.nlevels, tree.particle_id_dtype)
+
+        # Without extent, the close lists only exist if interactions are
+        # moved there based on cost.
+        with_close_lists = with_extent or cost_model is not None
+
+        from_sep_smaller_min_nsources_cumul = cl.array.to_device(queue,
+                from_sep_smaller_min_nsources_cumul.astype(
+                    tree.particle_id_dtype))
+        from_sep_bigger_min_ntargets_cumul = cl.array.to_device(queue,
+                from_sep_bigger_min_ntargets_cumul.astype(
+                    tree.particle_id_dtype))
+
+        # }}}
+
         knl_info = self.get_kernel_info(
                 tree.dimensions, tree.particle_id_dtype, tree.box_id_dtype,
                 tree.coord_dtype, tree.box_level_dtype, max_levels,
-                tree.sources_are_targets,
+                sources_are_target_boxes,
                 tree.sources_have_extent, tree.targets_have_extent,
-                tree.extent_norm)
+                tree.extent_norm, with_close_lists)
+
+        level_well_sep_is_n_away_host = self.get_level_well_sep_is_n_away(
+                tree.nlevels)
+        level_well_sep_is_n_away = cl.array.to_device(
+                queue, level_well_sep_is_n_away_host)
+
+        if len(set(level_well_sep_is_n_away_host)) == 1:
+            well_sep_is_n_away = int(level_well_sep_is_n_away_host[0])
+        else:
+            well_sep_is_n_away = None
 
         def fin_debug(s):
             if debug:
@@ -1874,19 +2498,54 @@ class FMMTraversalBuilder:
 
         traversal_plog = ProcessLogger(logger, "build traversal")
 
+        # {{{ apply target mask
+
+        if target_mask is not None:
+            fin_debug("finding boxes with active targets")
+
+            tree_order_target_mask = cl.array.empty(
+                    queue, tree.ntargets, np.int8)
+            tree_order_target_mask[tree.sorted_target_ids] = target_mask
+
+            active_target_prefix_sums = cl.array.empty(
+                    queue, tree.ntargets+1, tree.particle_id_dtype)
+            knl_info.active_target_prefix_sum_scan(
+                    tree_order_target_mask, active_target_prefix_sums,
+                    queue=queue)
+
+            box_flags = cl.array.empty_like(tree.box_flags)
+            evt = knl_info.masked_target_box_flags_finder(
+                    tree.box_flags,
+                    tree.box_target_starts,
+                    tree.box_target_counts_nonchild,
+                    tree.box_target_counts_cumul,
+                    active_target_prefix_sums,
+                    box_flags,
+                    range=slice(tree.nboxes),
+                    queue=queue, wait_for=wait_for)
+            wait_for = [evt]
+
+            del tree_order_target_mask
+            del active_target_prefix_sums
+
+        else:
+            box_flags = tree.box_flags
+
+        # }}}
+
         # {{{ source boxes, their parents, and target boxes
 
         fin_debug("building list of source boxes, their parents, and target boxes")
 
         result, evt = knl_info.sources_parents_and_targets_builder(
-                queue, tree.nboxes, tree.box_flags.data, wait_for=wait_for)
+                queue, tree.nboxes, box_flags.data, wait_for=wait_for)
         wait_for = [evt]
 
         source_parent_boxes = result["source_parent_boxes"].lists
         source_boxes = result["source_boxes"].lists
         target_or_target_parent_boxes = result["target_or_target_parent_boxes"].lists
 
-        if not tree.sources_are_targets:
+        if not sources_are_target_boxes:
             target_boxes = result["target_boxes"].lists
         else:
             target_boxes = source_boxes
@@ -1895,6 +2554,9 @@ class FMMTraversalBuilder:
 
         # {{{ figure out level starts in *_parent_boxes
 
+        # The level starts are only read back to the host once all lists
+        # have been built, to avoid stalling the queue.
+
         def extract_level_start_box_nrs(box_list, wait_for):
             result = cl.array.empty(queue,
                     tree.nlevels+1, tree.box_id_dtype) \
@@ -1907,7 +2569,10 @@ class FMMTraversalBuilder:
                     range=slice(0, len(box_list)),
                     queue=queue, wait_for=wait_for)
 
-            result = result.get()
+            return result, evt
+
+        def finish_level_start_box_nrs(result, box_list):
+            result = result.get(queue=queue)
 
             # Postprocess result for unoccupied levels
             prev_start = len(box_list)
@@ -1915,7 +2580,7 @@ class FMMTraversalBuilder:
                 result[ilev] = prev_start = \
                         min(result[ilev], prev_start)
 
-            return result, evt
+            return result
 
         fin_debug("finding level starts in source boxes array")
         level_start_source_box_nrs, evt_s = \
@@ -2025,6 +2690,61 @@ class FMMTraversalBuilder:
 
         # }}}
 
+        # If there are no close lists, there is nothing to merge.
+        merge_close_lists = merge_close_lists and with_close_lists
+
+        # {{{ uniform grid
+
+        # If all leaves are on the finest level (as is the case, e.g., for
+        # non-adaptive trees), every level is a grid, and Lists 1 and 2 and the
+        # same-level non-well-separated boxes can be found by looking up boxes
+        # by their integer coordinates instead of walking the tree.
+
+        level_grid_starts = np.zeros(tree.nlevels+1, np.int64)
+        level_grid_starts[1:] = np.cumsum(
+                2**(tree.dimensions*np.arange(tree.nlevels, dtype=np.int64)))
+
+        use_uniform_grid = (
+                _allow_uniform_grid
+                and not with_extent
+                and tree.nlevels > 1
+                # Only use the grid if it is not much larger than the tree.
+                and level_grid_starts[-1] <= 2**tree.dimensions * tree.nboxes)
+
+        if use_uniform_grid:
+            nonleaf_stop = tree.level_start_box_nrs[tree.nlevels-1]
+            use_uniform_grid = (
+                    cl.array.max(tree.box_source_counts_nonchild[:nonleaf_stop],
+                        queue=queue).get() == 0
+                    and cl.array.max(
+                        tree.box_target_counts_nonchild[:nonleaf_stop],
+                        queue=queue).get() == 0)
+
+        if use_uniform_grid:
+            fin_debug("finding box ids on uniform grid")
+
+            grid_knl_info = self.get_uniform_grid_kernel_info(
+                    tree.dimensions, tree.box_id_dtype, tree.coord_dtype,
+                    tree.box_level_dtype)
+
+            level_grid_box_ids = cl.array.zeros(
+                    queue, int(level_grid_starts[-1]), tree.box_id_dtype)
+            level_grid_starts = cl.array.to_device(queue, level_grid_starts)
+
+            evt = grid_knl_info.grid_box_ids_finder(
+                    tree.box_centers, tree.root_extent, tree.aligned_nboxes,
+                    tree.box_levels, level_grid_starts, level_grid_box_ids,
+                    range=slice(tree.nboxes),
+                    queue=queue, wait_for=wait_for)
+            wait_for = [evt]
+
+            grid_args = (
+                    tree.box_centers.data, tree.root_extent,
+                    tree.box_levels.data, tree.aligned_nboxes, box_flags.data,
+                    level_grid_starts.data, level_grid_box_ids.data)
+
+        # }}}
+
         # {{{ same-level non-well-separated boxes
 
         # If well_sep_is_n_away is 1, this agrees with the definition of
@@ -2032,139 +2752,274 @@ class FMMTraversalBuilder:
 
         fin_debug("finding same-level near-field boxes")
 
-        result, evt = knl_info.same_level_non_well_sep_boxes_builder(
-                queue, tree.nboxes,
-                tree.box_centers.data, tree.root_extent, tree.box_levels.data,
-                tree.aligned_nboxes, tree.box_child_ids.data, tree.box_flags.data,
-                wait_for=wait_for)
+        if use_uniform_grid:
+            result, evt = grid_knl_info.same_level_non_well_sep_boxes_builder(
+                    queue, tree.nboxes,
+                    *(grid_args + (level_well_sep_is_n_away.data,)),
+                    wait_for=wait_for)
+        else:
+            result, evt = knl_info.same_level_non_well_sep_boxes_builder(
+                    queue, tree.nboxes,
+                    tree.box_centers.data, tree.root_extent,
+                    tree.box_levels.data, tree.aligned_nboxes,
+                    tree.box_child_ids.data, box_flags.data,
+                    level_well_sep_is_n_away.data,
+                    wait_for=wait_for)
         wait_for = [evt]
         same_level_non_well_sep_boxes = result["same_level_non_well_sep_boxes"]
 
         # }}}
 
-        # {{{ neighbor source boxes ("list 1")
-
-        fin_debug("finding neighbor source boxes ('list 1')")
+        # Each of the following builds one list on *list_queue* and returns a
+        # tuple *(result, event)*. They only share inputs that are complete
+        # once the events in *wait_for* have completed, and each uses its own
+        # list builder, so that they may run concurrently.
 
-        result, evt = knl_info.neighbor_source_boxes_builder(
-                queue, len(target_boxes),
-                tree.box_centers.data, tree.root_extent, tree.box_levels.data,
-                tree.aligned_nboxes, tree.box_child_ids.data, tree.box_flags.data,
-                target_boxes.data, wait_for=wait_for)
+        # {{{ neighbor source boxes ("list 1")
 
-        wait_for = [evt]
-        neighbor_source_boxes = result["neighbor_source_boxes"]
+        def build_neighbor_source_boxes(list_queue, wait_for):
+            if merge_close_lists:
+                fin_debug("finding neighbor source boxes merged with "
+                        "close lists ('unified list 1')")
+
+                result, evt = knl_info.merged_neighbor_source_boxes_builder(
+                        list_queue, len(target_boxes),
+                        tree.box_centers.data, tree.root_extent,
+                        tree.box_levels.data, tree.aligned_nboxes,
+                        tree.box_child_ids.data, box_flags.data,
+                        target_boxes.data,
+                        tree.stick_out_factor,
+                        same_level_non_well_sep_boxes.starts.data,
+                        same_level_non_well_sep_boxes.lists.data,
+                        box_target_bounding_box_min.data,
+                        box_target_bounding_box_max.data,
+                        tree.box_source_counts_cumul.data,
+                        from_sep_smaller_min_nsources_cumul.data,
+                        -1,
+                        target_boxes.data,
+                        tree.box_parent_ids.data,
+                        level_well_sep_is_n_away.data,
+                        tree.box_target_counts_cumul.data,
+                        from_sep_bigger_min_ntargets_cumul.data,
+                        wait_for=wait_for)
+
+                return result["neighbor_source_boxes"], evt
+
+            fin_debug("finding neighbor source boxes ('list 1')")
+
+            if use_uniform_grid:
+                result, evt = grid_knl_info.neighbor_source_boxes_builder(
+                        list_queue, len(target_boxes),
+                        *(grid_args + (target_boxes.data,)),
+                        wait_for=wait_for)
+
+                return result["neighbor_source_boxes"], evt
+
+            result, evt = knl_info.neighbor_source_boxes_builder(
+                    list_queue, len(target_boxes),
+                    tree.box_centers.data, tree.root_extent,
+                    tree.box_levels.data, tree.aligned_nboxes,
+                    tree.box_child_ids.data, box_flags.data,
+                    target_boxes.data, wait_for=wait_for)
+
+            return result["neighbor_source_boxes"], evt
 
         # }}}
 
         # {{{ well-separated siblings ("list 2")
 
-        fin_debug("finding well-separated siblings ('list 2')")
+        def build_from_sep_siblings(list_queue, wait_for):
+            fin_debug("finding well-separated siblings ('list 2')")
+
+            if use_uniform_grid:
+                result, evt = grid_knl_info.from_sep_siblings_builder(
+                        list_queue, len(target_or_target_parent_boxes),
+                        *(grid_args + (
+                            target_or_target_parent_boxes.data,
+                            level_well_sep_is_n_away.data)),
+                        wait_for=wait_for)
+
+                return result["from_sep_siblings"], evt
+
+            result, evt = knl_info.from_sep_siblings_builder(
+                    list_queue, len(target_or_target_parent_boxes),
+                    tree.box_centers.data, tree.root_extent,
+                    tree.box_levels.data, tree.aligned_nboxes,
+                    tree.box_child_ids.data, box_flags.data,
+                    target_or_target_parent_boxes.data, tree.box_parent_ids.data,
+                    same_level_non_well_sep_boxes.starts.data,
+                    same_level_non_well_sep_boxes.lists.data,
+                    level_well_sep_is_n_away.data,
+                    wait_for=wait_for)
 
-        result, evt = knl_info.from_sep_siblings_builder(
-                queue, len(target_or_target_parent_boxes),
-                tree.box_centers.data, tree.root_extent, tree.box_levels.data,
-                tree.aligned_nboxes, tree.box_child_ids.data, tree.box_flags.data,
-                target_or_target_parent_boxes.data, tree.box_parent_ids.data,
-                same_level_non_well_sep_boxes.starts.data,
-                same_level_non_well_sep_boxes.lists.data,
-                wait_for=wait_for)
-        wait_for = [evt]
-        from_sep_siblings = result["from_sep_siblings"]
+            return result["from_sep_siblings"], evt
 
         # }}}
 
-        with_extent = tree.sources_have_extent or tree.targets_have_extent
-
         # {{{ separated smaller ("list 3")
 
-        fin_debug("finding separated smaller ('list 3')")
-
-        from_sep_smaller_base_args = (
-                queue, len(target_boxes),
-                tree.box_centers.data, tree.root_extent, tree.box_levels.data,
-                tree.aligned_nboxes, tree.box_child_ids.data, tree.box_flags.data,
-                tree.stick_out_factor, target_boxes.data,
-                same_level_non_well_sep_boxes.starts.data,
-                same_level_non_well_sep_boxes.lists.data,
-                box_target_bounding_box_min.data,
-                box_target_bounding_box_max.data,
-                tree.box_source_counts_cumul.data,
-                _from_sep_smaller_min_nsources_cumul,
-                )
-
-        from_sep_smaller_wait_for = []
-        from_sep_smaller_by_level = []
-        target_boxes_sep_smaller_by_source_level = []
-
-        for ilevel in range(tree.nlevels):
-            fin_debug("finding separated smaller ('list 3 level %d')" % ilevel)
+        def build_from_sep_smaller(list_queue, wait_for):
+            fin_debug("finding separated smaller ('list 3')")
+
+            from_sep_smaller_base_args = (
+                    list_queue, len(target_boxes),
+                    tree.box_centers.data, tree.root_extent,
+                    tree.box_levels.data, tree.aligned_nboxes,
+                    tree.box_child_ids.data, box_flags.data,
+                    tree.stick_out_factor, target_boxes.data,
+                    same_level_non_well_sep_boxes.starts.data,
+                    same_level_non_well_sep_boxes.lists.data,
+                    box_target_bounding_box_min.data,
+                    box_target_bounding_box_max.data,
+                    tree.box_source_counts_cumul.data,
+                    from_sep_smaller_min_nsources_cumul.data,
+                    )
 
-            result, evt = knl_info.from_sep_smaller_builder(
-                    *(from_sep_smaller_base_args + (ilevel,)),
-                    omit_lists=("from_sep_close_smaller",) if with_extent else (),
-                    wait_for=wait_for)
+            from_sep_smaller_wait_for = []
+            from_sep_smaller_by_level = []
+            target_boxes_sep_smaller_by_source_level = []
+
+            for ilevel in range(tree.nlevels):
+                fin_debug("finding separated smaller ('list 3 level %d')"
+                        % ilevel)
+
+                result, evt = knl_info.from_sep_smaller_builder(
+                        *(from_sep_smaller_base_args + (ilevel,)),
+                        omit_lists=(
+                            ("from_sep_close_smaller",)
+                            if with_close_lists else ()),
+                        wait_for=wait_for)
+
+                target_boxes_sep_smaller = target_boxes.with_queue(list_queue)[
+                    result["from_sep_smaller"].nonempty_indices]
+
+                from_sep_smaller_by_level.append(result["from_sep_smaller"])
+                target_boxes_sep_smaller_by_source_level.append(
+                        target_boxes_sep_smaller)
+                from_sep_smaller_wait_for.append(evt)
+
+            if with_close_lists and not merge_close_lists:
+                fin_debug("finding separated smaller close ('list 3 close')")
+                result, evt = knl_info.from_sep_smaller_builder(
+                        *(from_sep_smaller_base_args + (-1,)),
+                        omit_lists=("from_sep_smaller",),
+                        wait_for=wait_for)
+                from_sep_close_smaller = result["from_sep_close_smaller"]
+
+                from_sep_smaller_wait_for.append(evt)
+            else:
+                from_sep_close_smaller = None
+
+            return (
+                    (from_sep_smaller_by_level,
+                        target_boxes_sep_smaller_by_source_level,
+                        from_sep_close_smaller),
+                    cl.enqueue_marker(
+                        list_queue, wait_for=from_sep_smaller_wait_for))
 
-            target_boxes_sep_smaller = target_boxes[
-                result["from_sep_smaller"].nonempty_indices]
+        # }}}
 
-            from_sep_smaller_by_level.append(result["from_sep_smaller"])
-            target_boxes_sep_smaller_by_source_level.append(target_boxes_sep_smaller)
-            from_sep_smaller_wait_for.append(evt)
+        # {{{ separated bigger ("list 4")
 
-        if with_extent:
-            fin_debug("finding separated smaller close ('list 3 close')")
-            result, evt = knl_info.from_sep_smaller_builder(
-                    *(from_sep_smaller_base_args + (-1,)),
-                    omit_lists=("from_sep_smaller",),
+        def build_from_sep_bigger(list_queue, wait_for):
+            fin_debug("finding separated bigger ('list 4')")
+
+            if merge_close_lists:
+                from_sep_bigger_builder = \
+                        knl_info.from_sep_bigger_without_close_builder
+            else:
+                from_sep_bigger_builder = knl_info.from_sep_bigger_builder
+
+            result, evt = from_sep_bigger_builder(
+                    list_queue, len(target_or_target_parent_boxes),
+                    tree.box_centers.data, tree.root_extent,
+                    tree.box_levels.data, tree.aligned_nboxes,
+                    tree.box_child_ids.data, box_flags.data,
+                    tree.stick_out_factor, target_or_target_parent_boxes.data,
+                    tree.box_parent_ids.data,
+                    same_level_non_well_sep_boxes.starts.data,
+                    same_level_non_well_sep_boxes.lists.data,
+                    level_well_sep_is_n_away.data,
+                    tree.box_target_counts_cumul.data,
+                    from_sep_bigger_min_ntargets_cumul.data,
                     wait_for=wait_for)
-            from_sep_close_smaller_starts = result["from_sep_close_smaller"].starts
-            from_sep_close_smaller_lists = result["from_sep_close_smaller"].lists
 
-            from_sep_smaller_wait_for.append(evt)
-        else:
-            from_sep_close_smaller_starts = None
-            from_sep_close_smaller_lists = None
+            return result, evt
 
         # }}}
 
-        wait_for = from_sep_smaller_wait_for
-        del from_sep_smaller_wait_for
+        list_builders = [
+                build_neighbor_source_boxes,
+                build_from_sep_siblings,
+                build_from_sep_smaller,
+                build_from_sep_bigger,
+                ]
 
-        # {{{ separated bigger ("list 4")
+        if concurrent_lists:
+            def run_on_own_queue(build_list):
+                list_queue = cl.CommandQueue(queue.context, queue.device)
+                result, evt = build_list(list_queue, wait_for)
+                list_queue.flush()
+                return result, evt
 
-        fin_debug("finding separated bigger ('list 4')")
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(len(list_builders)) as executor:
+                list_results = list(executor.map(run_on_own_queue, list_builders))
 
-        result, evt = knl_info.from_sep_bigger_builder(
-                queue, len(target_or_target_parent_boxes),
-                tree.box_centers.data, tree.root_extent, tree.box_levels.data,
-                tree.aligned_nboxes, tree.box_child_ids.data, tree.box_flags.data,
-                tree.stick_out_factor, target_or_target_parent_boxes.data,
-                tree.box_parent_ids.data,
-                same_level_non_well_sep_boxes.starts.data,
-                same_level_non_well_sep_boxes.lists.data,
-                wait_for=wait_for)
+            wait_for = [evt for _, evt in list_results]
+
+        else:
+            list_results = []
+            for build_list in list_builders:
+                result, evt = build_list(queue, wait_for)
+                list_results.append((result, evt))
+                wait_for = [evt]
+
+        (
+                (neighbor_source_boxes, _),
+                (from_sep_siblings, _),
+                ((from_sep_smaller_by_level,
+                    target_boxes_sep_smaller_by_source_level,
+                    from_sep_close_smaller), _),
+                (result, _)) = list_results
+
+        if with_close_lists and not merge_close_lists:
+            from_sep_close_smaller_starts = from_sep_close_smaller.starts
+            from_sep_close_smaller_lists = from_sep_close_smaller.lists
+        else:
+            from_sep_close_smaller_starts = None
+            from_sep_close_smaller_lists = None
 
-        wait_for = [evt]
         from_sep_bigger = result["from_sep_bigger"]
 
-        if with_extent:
+        if with_close_lists and not merge_close_lists:
             from_sep_close_bigger_starts = result["from_sep_close_bigger"].starts
             from_sep_close_bigger_lists = result["from_sep_close_bigger"].lists
         else:
             from_sep_close_bigger_starts = None
             from_sep_close_bigger_lists = None
 
-        # }}}
-
-        if self.well_sep_is_n_away == 1:
+        if well_sep_is_n_away == 1:
             colleagues_starts = same_level_non_well_sep_boxes.starts
             colleagues_lists = same_level_non_well_sep_boxes.lists
         else:
             colleagues_starts = None
             colleagues_lists = None
 
-        evt, = wait_for
+        if len(wait_for) == 1:
+            evt, = wait_for
+        else:
+            evt = cl.enqueue_marker(queue, wait_for=wait_for)
+
+        level_start_source_box_nrs = finish_level_start_box_nrs(
+                level_start_source_box_nrs, source_boxes)
+        level_start_source_parent_box_nrs = finish_level_start_box_nrs(
+                level_start_source_parent_box_nrs, source_parent_boxes)
+        level_start_target_box_nrs = finish_level_start_box_nrs(
+                level_start_target_box_nrs, target_boxes)
+        level_start_target_or_target_parent_box_nrs = finish_level_start_box_nrs(
+                level_start_target_or_target_parent_box_nrs,
+                target_or_target_parent_boxes)
 
         traversal_plog.done(
                 "from_sep_smaller_crit: %s",
@@ -2172,7 +3027,8 @@ class FMMTraversalBuilder:
 
         return FMMTraversalInfo(
                 tree=tree,
-                well_sep_is_n_away=self.well_sep_is_n_away,
+                well_sep_is_n_away=well_sep_is_n_away,
+                level_well_sep_is_n_away=level_well_sep_is_n_away_host,
 
                 source_boxes=source_boxes,
                 target_boxes=target_boxes,
@@ -0,0 +1,396 @@
+from __future__ import division
+
+__copyright__ = "Copyright (C) 2018 Andreas Kloeckner"
+
+__license__ = """
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import numpy as np
+import pyopencl as cl
+import pyopencl.array  # noqa
+from pyopencl.elementwise import ElementwiseTemplate
+from pytools import memoize_method, Record
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+__doc__ = """
+Traversal statistics
+--------------------
+
+:class:`TraversalStatisticsBuilder` summarizes the lengths of the interaction
+lists of a :class:`boxtree.traversal.FMMTraversalInfo` per list and per
+level of the boxes owning the lists. The summaries are computed on the
+device, so that only a few numbers per list and level are transferred to the
+host::
+
+    stats = TraversalStatisticsBuilder(ctx)(queue, trav)
+    print(stats.to_table())
+
+    with open("stats.json", "w") as outf:
+        outf.write(stats.to_json())
+
+.. autoclass:: ListStatistics()
+
+.. autoclass:: TraversalStatistics()
+
+    .. automethod:: to_table
+
+    .. automethod:: to_json
+
+.. autoclass:: TraversalStatisticsBuilder
+
+    .. automethod:: __call__
+"""
+
+
+# {{{ kernel template
+
+LIST_LENGTHS_TEMPLATE = ElementwiseTemplate(
+    arguments=r"""//CL:mako//
+        box_id_t *starts,
+        box_id_t *lists,
+        %if have_row_indices:
+            box_id_t *row_indices,
+        %endif
+        box_id_t *owner_boxes,
+        particle_id_t *box_target_counts_nonchild,
+        particle_id_t *box_source_counts_nonchild,
+        count_t *lengths,
+        count_t *nparticle_interactions
+    """,
+    operation=r"""//CL:mako//
+        box_id_t start = starts[i];
+        box_id_t stop = starts[i+1];
+
+        %if have_row_indices:
+            box_id_t iowner = row_indices[i];
+        %else:
+            box_id_t iowner = i;
+        %endif
+
+        %if weight_by_sources:
+            count_t nsources = 0;
+            for (box_id_t j = start; j < stop; ++j)
+                nsources += box_source_counts_nonchild[lists[j]];
+        %else:
+            count_t nsources = stop - start;
+        %endif
+
+        // Rows are visited once per invocation, so accumulation is race-free.
+        lengths[iowner] += stop - start;
+        %if weight_by_targets:
+            nparticle_interactions[iowner] +=
+                box_target_counts_nonchild[owner_boxes[iowner]] * nsources;
+        %else:
+            nparticle_interactions[iowner] += nsources;
+        %endif
+    """,
+    name="find_list_lengths")
+
+# }}}
+
+
+# {{{ data structures
+
+class ListStatistics(Record):
+    """Statistics of one interaction list for the boxes on one level.
+
+    .. attribute:: list_name
+
+        The name of the list, as in the names of the attributes of
+        :class:`boxtree.traversal.FMMTraversalInfo`, e.g.
+        ``"neighbor_source_boxes"``. The per-level lists of
+        :attr:`boxtree.traversal.FMMTraversalInfo.from_sep_smaller_by_level`
+        are combined into one list named ``"from_sep_smaller"``.
+
+    .. attribute:: level
+
+        The level of the boxes owning the lists, or *None* for statistics
+        over all levels.
+
+    .. attribute:: nboxes
+
+        The number of boxes owning a (possibly empty) list.
+
+    .. attribute:: nempty
+
+        The number of boxes with an empty list.
+
+    .. attribute:: nentries
+
+    .. attribute:: min_length
+
+    .. attribute:: max_length
+
+    .. attribute:: mean_length
+
+    .. attribute:: nparticle_interactions
+
+        The number of interactions weighted by the particles taking part in
+        them. Particles are counted on a side of an interaction if the
+        translation operator acts on them directly. For example, for
+        ``"neighbor_source_boxes"`` (List 1), this is the number of
+        source-target pairs, and for ``"from_sep_smaller"`` (List 3), it is
+        the number of multipole evaluations at targets. For
+        ``"from_sep_siblings"`` (List 2), it agrees with :attr:`nentries`.
+    """
+
+    def to_dict(self):
+        return dict(
+                (name, getattr(self, name))
+                for name in _STATISTICS_FIELDS)
+
+
+_STATISTICS_FIELDS = [
+        "list_name", "level", "nboxes", "nempty", "nentries",
+        "min_length", "max_length", "mean_length",
+        "nparticle_interactions",
+        ]
+
+
+class TraversalStatistics(object):
+    """
+    .. attribute:: lists
+
+        A :class:`list` of :class:`ListStatistics`. For each list, contains
+        one entry for each level with boxes owning the list, followed by one
+        for all levels.
+    """
+
+    def __init__(self, lists):
+        self.lists = lists
+
+    def to_table(self):
+        """
+        :returns: a :class:`str` with a table of :attr:`lists`.
+        """
+        from pytools import Table
+        tbl = Table()
+        tbl.add_row(tuple(_STATISTICS_FIELDS))
+
+        for stats in self.lists:
+            row = []
+            for name in _STATISTICS_FIELDS:
+                val = getattr(stats, name)
+                if name == "level" and val is None:
+                    val = "all"
+                elif name == "mean_length":
+                    val = "%.2f" % val
+                row.append(val)
+
+            tbl.add_row(tuple(row))
+
+        return str(tbl)
+
+    def to_json(self, **kwargs):
+        """
+        :arg kwargs: passed on to :func:`json.dumps`.
+        :returns: a JSON :class:`str` containing a list of objects, one
+            for each entry of :attr:`lists`.
+        """
+        import json
+        return json.dumps(
+                [stats.to_dict() for stats in self.lists], **kwargs)
+
+# }}}
+
+
+# {{{ builder
+
+class TraversalStatisticsBuilder(object):
+    """Computes :class:`TraversalStatistics` for traversals on the device.
+    """
+
+    def __init__(self, context):
+        self.context = context
+
+    @memoize_method
+    def get_list_lengths_kernel(self, box_id_dtype, particle_id_dtype,
+            have_row_indices, weight_by_targets, weight_by_sources):
+        return LIST_LENGTHS_TEMPLATE.build(
+                self.context,
+                type_aliases=(
+                    ("box_id_t", box_id_dtype),
+                    ("particle_id_t", particle_id_dtype),
+                    ("count_t", np.int64),
+                    ),
+                var_values=(
+                    ("have_row_indices", have_row_indices),
+                    ("weight_by_targets", weight_by_targets),
+                    ("weight_by_sources", weight_by_sources),
+                    ))
+
+    def _get_level_statistics(self, queue, list_name, lengths,
+            nparticle_interactions, level_starts):
+        # Start all reductions before reading any of them back.
+        pending = []
+        for level in range(len(level_starts) - 1):
+            start, stop = level_starts[level:level+2]
+            if start == stop:
+                continue
+
+            level_lengths = lengths[start:stop]
+            pending.append((level, int(stop - start), [
+                cl.array.sum(level_lengths == 0, dtype=np.dtype(np.int64),
+                    queue=queue),
+                cl.array.sum(level_lengths, queue=queue),
+                cl.array.min(level_lengths, queue=queue),
+                cl.array.max(level_lengths, queue=queue),
+                cl.array.sum(nparticle_interactions[start:stop],
+                    queue=queue),
+                ]))
+
+        result = []
+        for level, nboxes, results in pending:
+            nempty, nentries, min_length, max_length, nparticle_interactions = (
+                    int(ary.get(queue=queue)) for ary in results)
+
+            result.append(ListStatistics(
+                    list_name=list_name,
+                    level=level,
+                    nboxes=nboxes,
+                    nempty=nempty,
+                    nentries=nentries,
+                    min_length=min_length,
+                    max_length=max_length,
+                    mean_length=nentries / nboxes,
+                    nparticle_interactions=nparticle_interactions))
+
+        if result:
+            nboxes = sum(stats.nboxes for stats in result)
+            nentries = sum(stats.nentries for stats in result)
+            result.append(ListStatistics(
+                    list_name=list_name,
+                    level=None,
+                    nboxes=nboxes,
+                    nempty=sum(stats.nempty for stats in result),
+                    nentries=nentries,
+                    min_length=min(stats.min_length for stats in result),
+                    max_length=max(stats.max_length for stats in result),
+                    mean_length=nentries / nboxes,
+                    nparticle_interactions=sum(
+                        stats.nparticle_interactions for stats in result)))
+
+        return result
+
+    def __call__(self, queue, trav):
+        """
+        :arg trav: a :class:`boxtree.traversal.FMMTraversalInfo` whose arrays
+            reside on the device.
+        :returns: a :class:`TraversalStatistics`.
+        """
+        tree = trav.tree
+
+        # (list name, owner boxes, level starts of owner boxes,
+        #  built lists or (starts, lists), weight_by_targets, weight_by_sources)
+        all_boxes = cl.array.arange(queue, tree.nboxes, dtype=tree.box_id_dtype)
+        list_infos = [
+                ("same_level_non_well_sep_boxes",
+                    all_boxes, tree.level_start_box_nrs,
+                    (trav.same_level_non_well_sep_boxes_starts,
+                        trav.same_level_non_well_sep_boxes_lists),
+                    False, False),
+                ("neighbor_source_boxes",
+                    trav.target_boxes, trav.level_start_target_box_nrs,
+                    (trav.neighbor_source_boxes_starts,
+                        trav.neighbor_source_boxes_lists),
+                    True, True),
+                ("from_sep_siblings",
+                    trav.target_or_target_parent_boxes,
+                    trav.level_start_target_or_target_parent_box_nrs,
+                    (trav.from_sep_siblings_starts,
+                        trav.from_sep_siblings_lists),
+                    False, False),
+                ("from_sep_smaller",
+                    trav.target_boxes, trav.level_start_target_box_nrs,
+                    trav.from_sep_smaller_by_level,
+                    True, False),
+                ("from_sep_bigger",
+                    trav.target_or_target_parent_boxes,
+                    trav.level_start_target_or_target_parent_box_nrs,
+                    (trav.from_sep_bigger_starts,
+                        trav.from_sep_bigger_lists),
+                    False, True),
+                ]
+
+        if trav.from_sep_close_smaller_starts is not None:
+            list_infos.append(
+                ("from_sep_close_smaller",
+                    trav.target_boxes, trav.level_start_target_box_nrs,
+                    (trav.from_sep_close_smaller_starts,
+                        trav.from_sep_close_smaller_lists),
+                    True, True))
+
+        if trav.from_sep_close_bigger_starts is not None:
+            list_infos.append(
+                ("from_sep_close_bigger",
+                    trav.target_or_target_parent_boxes,
+                    trav.level_start_target_or_target_parent_box_nrs,
+                    (trav.from_sep_close_bigger_starts,
+                        trav.from_sep_close_bigger_lists),
+                    True, True))
+
+        result = []
+
+        for (list_name, owner_boxes, level_starts, built_lists,
+                weight_by_targets, weight_by_sources) in list_infos:
+            lengths = cl.array.zeros(queue, len(owner_boxes), np.int64)
+            nparticle_interactions = cl.array.zeros(
+                    queue, len(owner_boxes), np.int64)
+
+            if isinstance(built_lists, tuple):
+                starts, lists = built_lists
+                knl = self.get_list_lengths_kernel(
+                        tree.box_id_dtype, tree.particle_id_dtype, False,
+                        weight_by_targets, weight_by_sources)
+                knl(starts, lists, owner_boxes,
+                        tree.box_target_counts_nonchild,
+                        tree.box_source_counts_nonchild,
+                        lengths, nparticle_interactions,
+                        range=slice(len(owner_boxes)), queue=queue)
+
+            else:
+                # Lists with empty rows eliminated, one per source level
+                knl = self.get_list_lengths_kernel(
+                        tree.box_id_dtype, tree.particle_id_dtype, True,
+                        weight_by_targets, weight_by_sources)
+                for built_list in built_lists:
+                    if not built_list.num_nonempty_lists:
+                        continue
+
+                    knl(built_list.starts, built_list.lists,
+                            built_list.nonempty_indices, owner_boxes,
+                            tree.box_target_counts_nonchild,
+                            tree.box_source_counts_nonchild,
+                            lengths, nparticle_interactions,
+                            range=slice(built_list.num_nonempty_lists),
+                            queue=queue)
+
+            result.extend(self._get_level_statistics(
+                queue, list_name, lengths, nparticle_interactions,
+                level_starts))
+
+        return TraversalStatistics(result)
+
+# }}}
+
+# vim: filetype=pyopencl:fdm=marker
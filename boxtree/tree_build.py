@@ -83,7 +83,7 @@ class TreeBuilder(object):
             targets=None, source_radii=None, target_radii=None,
             stick_out_factor=None, refine_weights=None,
             max_leaf_refine_weight=None, wait_for=None,
-            extent_norm=None,
+            extent_norm=None, bbox=None,
             **kwargs):
         """
         :arg queue: a :class:`pyopencl.CommandQueue` instance
@@ -123,6 +123,12 @@ class TreeBuilder(object):
             execution.
         :arg extent_norm: ``"l2"`` or ``"linf"``. Indicates the norm with respect
             to which particle stick-out is measured. See :attr:`Tree.extent_norm`.
+        :arg bbox: If not *None*, a tuple ``(bbox_min, bbox_max)`` of coordinate
+            arrays (cf. :attr:`Tree.bounding_box`) that must contain all
+            particles. The root box is then derived from *bbox* instead of
+            from the particles, so that trees built with the same *bbox* share
+            their root box (and hence all their box geometry).
+            See :func:`boxtree.dual_tree.build_dual_tree_traversal`.
         :arg kwargs: Used internally for debugging.
 
         :returns: a tuple ``(tree, event)``, where *tree* is an instance of
@@ -342,8 +348,22 @@ class TreeBuilder(object):
 
         # {{{ find and process bounding box
 
-        bbox, _ = self.bbox_finder(srcntgts, srcntgt_radii, wait_for=wait_for)
-        bbox = bbox.get()
+        particle_bbox, _ = self.bbox_finder(
+                srcntgts, srcntgt_radii, wait_for=wait_for)
+        particle_bbox = particle_bbox.get()
+
+        if bbox is None:
+            bbox = particle_bbox
+        else:
+            given_bbox_min, given_bbox_max = bbox
+            bbox = particle_bbox.copy()
+            for i, ax in enumerate(axis_names):
+                if not (given_bbox_min[i] <= particle_bbox["min_"+ax]
+                        and particle_bbox["max_"+ax] <= given_bbox_max[i]):
+                    raise ValueError("bbox does not contain all particles")
+
+                bbox["min_"+ax] = given_bbox_min[i]
+                bbox["max_"+ax] = given_bbox_max[i]
 
         root_extent = max(
                 bbox["max_"+ax] - bbox["min_"+ax]
@@ -0,0 +1,88 @@
+from __future__ import division, print_function
+
+# Measures how the run time of an FMM using
+# boxtree.pyfmmlib_integration.FMMLibExpansionWrangler scales with the number
+# of threads passed as its nthreads argument.
+#
+# Usage: python pyfmmlib_thread_scaling.py [dims [nparticles [max_nthreads]]]
+
+import sys
+import os
+from time import time
+
+import numpy as np
+import pyopencl as cl
+
+from boxtree import TreeBuilder
+from boxtree.traversal import FMMTraversalBuilder
+from boxtree.fmm import drive_fmm, PreparedTraversal
+from boxtree.pyfmmlib_integration import FMMLibExpansionWrangler
+
+
+def main(dims=3, nparticles=10**5, max_nthreads=None, nrepeats=3):
+    if max_nthreads is None:
+        max_nthreads = os.cpu_count() or 1
+
+    ctx = cl.create_some_context()
+    queue = cl.CommandQueue(ctx)
+
+    from pyopencl.clrandom import PhiloxGenerator
+    rng = PhiloxGenerator(ctx, seed=15)
+
+    from pytools.obj_array import make_obj_array
+
+    def make_particles():
+        return make_obj_array([
+            rng.normal(queue, nparticles, dtype=np.float64)
+            for i in range(dims)])
+
+    # Use separate targets to avoid the singular self-interaction.
+    sources = make_particles()
+    targets = make_particles()
+
+    tree, _ = TreeBuilder(ctx)(queue, sources, targets=targets,
+            max_particles_in_box=30)
+    trav, _ = FMMTraversalBuilder(ctx)(queue, tree)
+    trav = PreparedTraversal(trav.get(queue=queue))
+
+    weights = np.random.RandomState(20).rand(nparticles)
+
+    nthreads_values = [None]
+    nthreads = 1
+    while nthreads <= max_nthreads:
+        nthreads_values.append(nthreads)
+        nthreads *= 2
+
+    print("%d sources and targets in %dD, %d boxes, %d levels" % (
+        nparticles, dims, trav.tree.nboxes, trav.tree.nlevels))
+    print("%10s %12s %10s" % ("nthreads", "time [s]", "speedup"))
+
+    serial_time = None
+    ref_pot = None
+
+    for nthreads in nthreads_values:
+        wrangler = FMMLibExpansionWrangler(trav.tree, 0,
+                fmm_level_to_nterms=lambda tree, lev: 10,
+                prepared_traversal=trav, nthreads=nthreads)
+
+        times = []
+        for irepeat in range(nrepeats):
+            start_time = time()
+            pot = drive_fmm(trav, wrangler, weights)
+            times.append(time() - start_time)
+
+        elapsed = min(times)
+
+        if serial_time is None:
+            serial_time = elapsed
+            ref_pot = pot
+        else:
+            assert np.allclose(pot, ref_pot, rtol=1e-12, atol=0)
+
+        print("%10s %12.3f %10.2f" % (
+            "serial" if nthreads is None else nthreads,
+            elapsed, serial_time / elapsed))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -658,23 +658,733 @@ def test_pyfmmlib_fmm(ctx_getter, dims, use_dipoles, helmholtz_k):
 # }}}
 
 
+# {{{ test prepared traversal
+
+@pytest.mark.parametrize("dims", [2, 3])
+def test_prepared_traversal(ctx_getter, dims):
+    logging.basicConfig(level=logging.INFO)
+
+    from pytest import importorskip
+    importorskip("pyfmmlib")
+
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    nsources = 3000
+    ntargets = 1000
+    dtype = np.float64
+
+    sources = p_normal(queue, nsources, dims, dtype, seed=15)
+    targets = p_normal(queue, ntargets, dims, dtype, seed=18)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    tree, _ = tb(queue, sources, targets=targets,
+            max_particles_in_box=30, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tbuild = FMMTraversalBuilder(ctx)
+    trav, _ = tbuild(queue, tree, debug=True)
+
+    trav = trav.get(queue=queue)
+
+    from boxtree.fmm import drive_fmm, PreparedTraversal
+    prepared_trav = PreparedTraversal(trav)
+
+    from boxtree.pyfmmlib_integration import FMMLibExpansionWrangler
+
+    rng = np.random.RandomState(20)
+
+    # One prepared traversal, several kernels and weight vectors
+    for helmholtz_k in [0, 2]:
+        for _ in range(2):
+            weights = rng.rand(nsources)
+
+            def make_wrangler(prepared_traversal):
+                return FMMLibExpansionWrangler(
+                        trav.tree, helmholtz_k,
+                        fmm_level_to_nterms=lambda tree, lev: 10,
+                        prepared_traversal=prepared_traversal)
+
+            ref_pot = drive_fmm(trav, make_wrangler(None), weights)
+            pot = drive_fmm(prepared_trav, make_wrangler(prepared_trav), weights)
+
+            assert np.allclose(pot, ref_pot, rtol=1e-14, atol=0)
+
+# }}}
+
+
+# {{{ test threaded fmmlib wrangler
+
+@pytest.mark.parametrize(("dims", "helmholtz_k"), [
+    (2, 0),
+    (3, 2),
+    ])
+def test_pyfmmlib_threaded(ctx_getter, dims, helmholtz_k):
+    logging.basicConfig(level=logging.INFO)
+
+    from pytest import importorskip
+    importorskip("pyfmmlib")
+
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    nsources = 3000
+    ntargets = 1000
+    dtype = np.float64
+
+    sources = p_normal(queue, nsources, dims, dtype, seed=15)
+    targets = p_normal(queue, ntargets, dims, dtype, seed=18)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    tree, _ = tb(queue, sources, targets=targets,
+            max_particles_in_box=30, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tbuild = FMMTraversalBuilder(ctx)
+    trav, _ = tbuild(queue, tree, debug=True)
+
+    trav = trav.get(queue=queue)
+
+    weights = np.random.RandomState(20).rand(nsources)
+
+    from boxtree.pyfmmlib_integration import FMMLibExpansionWrangler
+
+    def make_wrangler(nthreads):
+        return FMMLibExpansionWrangler(trav.tree, helmholtz_k,
+                fmm_level_to_nterms=lambda tree, lev: 10, nthreads=nthreads)
+
+    from boxtree.fmm import drive_fmm
+    ref_pot = drive_fmm(trav, make_wrangler(None), weights)
+    pot = drive_fmm(trav, make_wrangler(3), weights)
+
+    assert (pot == ref_pot).all()
+
+# }}}
+
+
+# {{{ test fmmlib with multiple right-hand sides
+
+@pytest.mark.parametrize(("dims", "helmholtz_k", "use_dipoles"), [
+    (2, 0, False),
+    (2, 2, True),
+    (3, 0, True),
+    (3, 2, False),
+    ])
+def test_pyfmmlib_multiple_rhs(ctx_getter, dims, helmholtz_k, use_dipoles):
+    logging.basicConfig(level=logging.INFO)
+
+    from pytest import importorskip
+    importorskip("pyfmmlib")
+
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    nsources = 3000
+    ntargets = 1000
+    nrhs = 3
+    dtype = np.float64
+
+    sources = p_normal(queue, nsources, dims, dtype, seed=15)
+    targets = p_normal(queue, ntargets, dims, dtype, seed=18)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    tree, _ = tb(queue, sources, targets=targets,
+            max_particles_in_box=30, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tbuild = FMMTraversalBuilder(ctx)
+    trav, _ = tbuild(queue, tree, debug=True)
+
+    trav = trav.get(queue=queue)
+
+    rng = np.random.RandomState(20)
+    weights = rng.rand(nrhs, nsources)
+
+    if use_dipoles:
+        dipole_vec = rng.randn(dims, nsources)
+    else:
+        dipole_vec = None
+
+    from boxtree.pyfmmlib_integration import FMMLibExpansionWrangler
+    wrangler = FMMLibExpansionWrangler(trav.tree, helmholtz_k,
+            fmm_level_to_nterms=lambda tree, lev: 10, dipole_vec=dipole_vec)
+
+    from boxtree.fmm import drive_fmm
+    pot = drive_fmm(trav, wrangler, weights)
+
+    assert pot.shape == (nrhs, ntargets)
+
+    for irhs in range(nrhs):
+        ref_pot = drive_fmm(trav, wrangler, weights[irhs])
+        assert np.allclose(pot[irhs], ref_pot, rtol=1e-14, atol=0)
+
+# }}}
+
+
+# {{{ test opencl laplace wrangler
+
+@pytest.mark.parametrize(("dims", "order", "with_extent"), [
+    (2, 10, False),
+    (2, 10, True),
+    (3, 4, False),
+    (3, 4, True),
+    ])
+def test_cl_laplace_wrangler(ctx_getter, dims, order, with_extent):
+    logging.basicConfig(level=logging.INFO)
+
+    from pytest import importorskip
+    importorskip("pyfmmlib")
+
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    nsources = 3000
+    ntargets = 1000
+    dtype = np.float64
+
+    sources = p_normal(queue, nsources, dims, dtype, seed=15)
+    targets = p_normal(queue, ntargets, dims, dtype, seed=18)
+
+    if with_extent:
+        from pyopencl.clrandom import PhiloxGenerator
+        rng = PhiloxGenerator(queue.context, seed=12)
+        target_radii = 2**rng.uniform(
+                queue, ntargets, dtype=dtype, a=-10, b=0)
+    else:
+        target_radii = None
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    tree, _ = tb(queue, sources, targets=targets, target_radii=target_radii,
+            max_particles_in_box=30, stick_out_factor=0.25, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tbuild = FMMTraversalBuilder(ctx)
+    trav, _ = tbuild(queue, tree, debug=True)
+
+    weights = np.random.RandomState(20).rand(nsources)
+
+    from boxtree.fmm import drive_fmm
+    from boxtree.cl_laplace import CLLaplaceExpansionWrangler
+    pot = drive_fmm(trav, CLLaplaceExpansionWrangler(queue, tree, order),
+            weights).get()
+
+    # Truncated Taylor expansions of harmonic functions span the same spaces
+    # as the expansions of the same order used by pyfmmlib, so both
+    # wranglers compute the same approximation.
+    from boxtree.pyfmmlib_integration import FMMLibExpansionWrangler
+    host_trav = trav.get(queue=queue)
+    ref_pot = drive_fmm(host_trav,
+            FMMLibExpansionWrangler(host_trav.tree, 0,
+                fmm_level_to_nterms=lambda tree, lev: order),
+            weights)
+
+    rel_err = la.norm(pot - ref_pot) / la.norm(ref_pot)
+    logger.info("relative l2 difference vs fmmlib: %g" % rel_err)
+    assert rel_err < 1e-10, rel_err
+
+# }}}
+
+
+# {{{ test numpy wranglers
+
+@pytest.mark.parametrize(("dims", "with_extent"), [
+    (2, False),
+    (2, True),
+    (3, False),
+    (3, True),
+    ])
+def test_numpy_wranglers(ctx_getter, dims, with_extent):
+    logging.basicConfig(level=logging.INFO)
+
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    nsources = 3000
+    ntargets = 1000
+    dtype = np.float64
+
+    sources = p_normal(queue, nsources, dims, dtype, seed=15)
+    targets = p_normal(queue, ntargets, dims, dtype, seed=18)
+
+    if with_extent:
+        from pyopencl.clrandom import PhiloxGenerator
+        rng = PhiloxGenerator(queue.context, seed=12)
+        target_radii = 2**rng.uniform(
+                queue, ntargets, dtype=dtype, a=-10, b=0)
+    else:
+        target_radii = None
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    tree, _ = tb(queue, sources, targets=targets, target_radii=target_radii,
+            max_particles_in_box=30, stick_out_factor=0.25, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tbuild = FMMTraversalBuilder(ctx)
+    trav, _ = tbuild(queue, tree, debug=True)
+    trav = trav.get(queue=queue)
+
+    from boxtree.fmm import drive_fmm
+    from boxtree import numpy_wranglers
+
+    # {{{ constant kernel
+
+    weights = np.ones(nsources)
+
+    pot = drive_fmm(trav,
+            numpy_wranglers.ConstantOneExpansionWrangler(trav.tree), weights)
+    ref_pot = drive_fmm(trav, ConstantOneExpansionWrangler(trav.tree), weights)
+
+    assert (pot == nsources).all()
+    assert (pot == ref_pot).all()
+
+    # }}}
+
+    if dims != 2:
+        return
+
+    # {{{ 2D Laplace
+
+    from pytest import importorskip
+    importorskip("pyfmmlib")
+    from boxtree.pyfmmlib_integration import FMMLibExpansionWrangler
+
+    weights = np.random.RandomState(20).rand(nsources)
+
+    for order in [0, 3, 10]:
+        pot = drive_fmm(trav,
+                numpy_wranglers.Laplace2DExpansionWrangler(trav.tree, order),
+                weights)
+        ref_pot = drive_fmm(trav,
+                FMMLibExpansionWrangler(trav.tree, 0,
+                    fmm_level_to_nterms=lambda tree, lev: order),
+                weights)
+
+        rel_err = la.norm(pot - ref_pot) / la.norm(ref_pot)
+        logger.info("order %d: relative l2 difference vs fmmlib: %g"
+                % (order, rel_err))
+        assert rel_err < 1e-12, rel_err
+
+    # }}}
+
+# }}}
+
+
+# {{{ test in-place accumulation
+
+def test_drive_fmm_accumulates_in_place(ctx_getter):
+    logging.basicConfig(level=logging.INFO)
+
+    from pytest import importorskip
+    importorskip("pyfmmlib")
+
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dims = 2
+    nsources = 3000
+    ntargets = 1000
+    dtype = np.float64
+
+    sources = p_normal(queue, nsources, dims, dtype, seed=15)
+    targets = p_normal(queue, ntargets, dims, dtype, seed=18)
+
+    # Use target extents to get close lists, and thus several calls to
+    # eval_direct.
+    from pyopencl.clrandom import PhiloxGenerator
+    rng = PhiloxGenerator(queue.context, seed=12)
+    target_radii = 2**rng.uniform(queue, ntargets, dtype=dtype, a=-10, b=0)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    tree, _ = tb(queue, sources, targets=targets, target_radii=target_radii,
+            max_particles_in_box=30, stick_out_factor=0.25, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tbuild = FMMTraversalBuilder(ctx)
+    trav, _ = tbuild(queue, tree, debug=True)
+
+    trav = trav.get(queue=queue)
+    assert trav.from_sep_close_smaller_starts is not None
+
+    weights = np.random.RandomState(20).rand(nsources)
+
+    from boxtree.pyfmmlib_integration import FMMLibExpansionWrangler
+
+    class AllocationCountingWrangler(FMMLibExpansionWrangler):
+        def __init__(self, *args, **kwargs):
+            super(AllocationCountingWrangler, self).__init__(*args, **kwargs)
+            self.noutput_zeros = 0
+            self.nlocal_expansion_zeros = 0
+
+        def output_zeros(self, *args, **kwargs):
+            self.noutput_zeros += 1
+            return super(AllocationCountingWrangler, self).output_zeros(
+                    *args, **kwargs)
+
+        def local_expansion_zeros(self, *args, **kwargs):
+            self.nlocal_expansion_zeros += 1
+            return super(AllocationCountingWrangler, self).local_expansion_zeros(
+                    *args, **kwargs)
+
+    class WranglerWithoutInPlaceStages(object):
+        def __init__(self, wrangler):
+            self.wrangler = wrangler
+
+        def __getattr__(self, name):
+            if name.endswith("_into"):
+                raise AttributeError(name)
+            return getattr(self.wrangler, name)
+
+    wrangler = AllocationCountingWrangler(trav.tree, 0,
+            fmm_level_to_nterms=lambda tree, lev: 10)
+
+    from boxtree.fmm import drive_fmm
+    pot = drive_fmm(trav, wrangler, weights)
+
+    assert wrangler.noutput_zeros == 1
+    assert wrangler.nlocal_expansion_zeros == 1
+
+    ref_pot = drive_fmm(trav, WranglerWithoutInPlaceStages(wrangler), weights)
+
+    assert (pot == ref_pot).all()
+
+# }}}
+
+
+# {{{ test timing records
+
+@pytest.mark.parametrize("nthreads", [None, 2])
+def test_drive_fmm_timing(ctx_getter, nthreads):
+    logging.basicConfig(level=logging.INFO)
+
+    from pytest import importorskip
+    importorskip("pyfmmlib")
+
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dims = 2
+    nsources = 3000
+    ntargets = 1000
+    dtype = np.float64
+
+    sources = p_normal(queue, nsources, dims, dtype, seed=15)
+    targets = p_normal(queue, ntargets, dims, dtype, seed=18)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    tree, _ = tb(queue, sources, targets=targets,
+            max_particles_in_box=30, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tbuild = FMMTraversalBuilder(ctx)
+    trav, _ = tbuild(queue, tree, debug=True)
+
+    trav = trav.get(queue=queue)
+
+    weights = np.random.RandomState(20).rand(nsources)
+
+    from boxtree.pyfmmlib_integration import FMMLibExpansionWrangler
+    wrangler = FMMLibExpansionWrangler(trav.tree, 0,
+            fmm_level_to_nterms=lambda tree, lev: 10, nthreads=nthreads)
+
+    from boxtree.fmm import drive_fmm, FMMTimingRecord
+    ref_pot = drive_fmm(trav, wrangler, weights)
+    pot, record = drive_fmm(trav, wrangler, weights, return_timing=True)
+
+    assert (pot == ref_pot).all()
+
+    from boxtree.cost import count_fmm_work, FMM_STAGES
+    assert set(FMM_STAGES) <= set(record.stages)
+    assert record.nruns == 1
+
+    for timing in record.stages.values():
+        assert timing.ncalls == 1
+        assert timing.wall_elapsed >= 0
+        assert timing.process_elapsed >= 0
+
+    assert record.wall_elapsed >= sum(
+            timing.wall_elapsed for timing in record.stages.values())
+
+    # {{{ check counters against the work counted by the cost model
+
+    totals = count_fmm_work(trav).get_total_counts()
+
+    def get_counter(stage, name):
+        return record.stages[stage].counters.get(name, 0)
+
+    assert get_counter("eval_direct", "p2p_pairs") == totals["eval_direct"]
+    assert (get_counter("multipole_to_local", "translations")
+            == totals["multipole_to_local"])
+    assert (get_counter("refine_locals", "translations")
+            == totals["refine_locals"])
+    assert (get_counter("form_multipoles", "particles")
+            == totals["form_multipoles"])
+    assert (get_counter("eval_locals", "particles")
+            == totals["eval_locals"])
+
+    # }}}
+
+    # {{{ aggregation
+
+    _, record2 = drive_fmm(trav, wrangler, weights, return_timing=True)
+    aggregate = FMMTimingRecord.aggregate([record, record2])
+
+    assert aggregate.nruns == 2
+    assert aggregate.stages["eval_direct"].ncalls == 2
+    assert aggregate.get_counter_totals() == dict(
+            (name, 2*count)
+            for name, count in record.get_counter_totals().items())
+
+    import json
+    json.dumps(aggregate.to_dict())
+
+    # }}}
+
+    # Wranglers without counters report none.
+    _, record = drive_fmm(trav, ConstantOneExpansionWrangler(trav.tree),
+            np.ones(nsources), return_timing=True)
+    assert record.get_counter_totals() == {}
+
+# }}}
+
+
+# {{{ test concurrent driver
+
+@pytest.mark.parametrize(("dims", "enable_extents", "use_fmmlib"), [
+    (2, False, True),
+    (3, False, True),
+    (2, True, False),
+    ])
+def test_drive_fmm_concurrently(ctx_getter, dims, enable_extents, use_fmmlib):
+    logging.basicConfig(level=logging.INFO)
+
+    if use_fmmlib:
+        from pytest import importorskip
+        importorskip("pyfmmlib")
+
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    nsources = 3000
+    ntargets = 1000
+    dtype = np.float64
+
+    sources = p_normal(queue, nsources, dims, dtype, seed=15)
+    targets = p_normal(queue, ntargets, dims, dtype, seed=18)
+
+    if enable_extents:
+        from pyopencl.clrandom import PhiloxGenerator
+        rng = PhiloxGenerator(queue.context, seed=12)
+        target_radii = 2**rng.uniform(queue, ntargets, dtype=dtype, a=-10, b=0)
+    else:
+        target_radii = None
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    tree, _ = tb(queue, sources, targets=targets, target_radii=target_radii,
+            max_particles_in_box=30, stick_out_factor=0.25, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tbuild = FMMTraversalBuilder(ctx)
+    trav, _ = tbuild(queue, tree, debug=True)
+
+    trav = trav.get(queue=queue)
+
+    if use_fmmlib:
+        from boxtree.pyfmmlib_integration import FMMLibExpansionWrangler
+        wrangler = FMMLibExpansionWrangler(trav.tree, 0,
+                fmm_level_to_nterms=lambda tree, lev: 10)
+        weights = np.random.RandomState(20).rand(nsources)
+    else:
+        wrangler = ConstantOneExpansionWrangler(trav.tree)
+        weights = np.ones(nsources)
+
+    from boxtree.fmm import drive_fmm, drive_fmm_concurrently
+    ref_pot = drive_fmm(trav, wrangler, weights)
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        pot = drive_fmm_concurrently(trav, wrangler, weights, executor=executor)
+
+    assert (pot == ref_pot).all()
+
+    if not use_fmmlib:
+        assert (pot == np.sum(weights)).all()
+
+# }}}
+
+
 # {{{ test particle count thresholding in traversal generation
 
 @pytest.mark.parametrize("enable_extents", [True, False])
-def test_interaction_list_particle_count_thresholding(ctx_getter, enable_extents):
+def test_interaction_list_particle_count_thresholding(ctx_getter, enable_extents):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    logging.basicConfig(level=logging.INFO)
+
+    dims = 2
+    nsources = 1000
+    ntargets = 1000
+    dtype = np.float
+
+    max_particles_in_box = 30
+    # Ensure that we have underfilled boxes.
+    from_sep_smaller_min_nsources_cumul = 1 + max_particles_in_box
+
+    from boxtree.fmm import drive_fmm
+    sources = p_normal(queue, nsources, dims, dtype, seed=15)
+    targets = p_normal(queue, ntargets, dims, dtype, seed=15)
+
+    from pyopencl.clrandom import PhiloxGenerator
+    rng = PhiloxGenerator(queue.context, seed=12)
+
+    if enable_extents:
+        target_radii = 2**rng.uniform(queue, ntargets, dtype=dtype, a=-10, b=0)
+    else:
+        target_radii = None
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    tree, _ = tb(queue, sources, targets=targets,
+            max_particles_in_box=max_particles_in_box,
+            target_radii=target_radii,
+            debug=True, stick_out_factor=0.25)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tbuild = FMMTraversalBuilder(ctx)
+    trav, _ = tbuild(queue, tree, debug=True,
+            _from_sep_smaller_min_nsources_cumul=from_sep_smaller_min_nsources_cumul)
+
+    weights = np.ones(nsources)
+    weights_sum = np.sum(weights)
+
+    host_trav = trav.get(queue=queue)
+    host_tree = host_trav.tree
+
+    wrangler = ConstantOneExpansionWrangler(host_tree)
+
+    pot = drive_fmm(host_trav, wrangler, weights)
+
+    assert (pot == weights_sum).all()
+
+# }}}
+
+
+# {{{ test cost-based routing of list 3/4 interactions to close lists
+
+@pytest.mark.parametrize("enable_extents", [True, False])
+@pytest.mark.parametrize("merge_close_lists", [True, False])
+def test_cost_based_close_list_routing(ctx_getter, enable_extents,
+        merge_close_lists):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dims = 2
+    nsources = 3000
+    ntargets = 3000
+    dtype = np.float64
+
+    sources = p_normal(queue, nsources, dims, dtype, seed=15)
+    targets = p_normal(queue, ntargets, dims, dtype, seed=16)
+
+    from pyopencl.clrandom import PhiloxGenerator
+    rng = PhiloxGenerator(queue.context, seed=12)
+
+    if enable_extents:
+        target_radii = 2**rng.uniform(queue, ntargets, dtype=dtype, a=-10, b=0)
+    else:
+        target_radii = None
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    tree, _ = tb(queue, sources, targets=targets,
+            max_particles_in_box=30,
+            target_radii=target_radii,
+            debug=True, stick_out_factor=0.25)
+
+    # With these orders, direct evaluation is cheaper for fewer than 21
+    # (List 3) sources or 42 (List 4) targets.
+    from boxtree.cost import FMMCostModel
+    cost_model = FMMCostModel(
+            calibration_params={"form_locals": 2},
+            level_to_order=lambda tree, level: 10)
+
+    min_nsources_cumul, min_ntargets_cumul = \
+            cost_model.get_close_list_thresholds(tree)
+    assert (min_nsources_cumul == 21).all()
+    assert (min_ntargets_cumul == 42).all()
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tbuild = FMMTraversalBuilder(ctx)
+    trav, _ = tbuild(queue, tree, debug=True, cost_model=cost_model,
+            merge_close_lists=merge_close_lists)
+    trav = trav.get(queue=queue)
+
+    ref_trav, _ = tbuild(queue, tree, debug=True)
+    ref_trav = ref_trav.get(queue=queue)
+
+    # {{{ check that interactions were moved to the close lists
+
+    nlist3 = sum(len(lev_list.lists) for lev_list in trav.from_sep_smaller_by_level)
+    ref_nlist3 = sum(
+            len(lev_list.lists) for lev_list in ref_trav.from_sep_smaller_by_level)
+
+    assert nlist3 < ref_nlist3
+    assert len(trav.from_sep_bigger_lists) < len(ref_trav.from_sep_bigger_lists)
+
+    if merge_close_lists:
+        assert trav.from_sep_close_smaller_starts is None
+        assert (len(trav.neighbor_source_boxes_lists)
+                > len(ref_trav.neighbor_source_boxes_lists))
+    else:
+        assert len(trav.from_sep_close_smaller_lists)
+        assert len(trav.from_sep_close_bigger_lists)
+
+    # }}}
+
+    from boxtree.fmm import drive_fmm
+    weights = np.ones(nsources)
+    pot = drive_fmm(trav, ConstantOneExpansionWrangler(trav.tree), weights)
+
+    assert (pot == np.sum(weights)).all()
+
+# }}}
+
+
+# {{{ test fmm with float32 dtype
+
+@pytest.mark.parametrize("enable_extents", [True, False])
+def test_fmm_float32(ctx_getter, enable_extents):
     ctx = ctx_getter()
     queue = cl.CommandQueue(ctx)
 
+    from pyopencl.characterize import has_struct_arg_count_bug
+    if has_struct_arg_count_bug(queue.device):
+        pytest.xfail("won't work on devices with the struct arg count issue")
+
     logging.basicConfig(level=logging.INFO)
 
     dims = 2
     nsources = 1000
     ntargets = 1000
-    dtype = np.float
-
-    max_particles_in_box = 30
-    # Ensure that we have underfilled boxes.
-    from_sep_smaller_min_nsources_cumul = 1 + max_particles_in_box
+    dtype = np.float32
 
     from boxtree.fmm import drive_fmm
     sources = p_normal(queue, nsources, dims, dtype, seed=15)
@@ -692,14 +1402,13 @@ def test_interaction_list_particle_count_thresholding(ctx_getter, enable_extents
     tb = TreeBuilder(ctx)
 
     tree, _ = tb(queue, sources, targets=targets,
-            max_particles_in_box=max_particles_in_box,
+            max_particles_in_box=30,
             target_radii=target_radii,
             debug=True, stick_out_factor=0.25)
 
     from boxtree.traversal import FMMTraversalBuilder
     tbuild = FMMTraversalBuilder(ctx)
-    trav, _ = tbuild(queue, tree, debug=True,
-            _from_sep_smaller_min_nsources_cumul=from_sep_smaller_min_nsources_cumul)
+    trav, _ = tbuild(queue, tree, debug=True)
 
     weights = np.ones(nsources)
     weights_sum = np.sum(weights)
@@ -716,59 +1425,507 @@ def test_interaction_list_particle_count_thresholding(ctx_getter, enable_extents
 # }}}
 
 
-# {{{ test fmm with float32 dtype
+# {{{ test cost model
+
+class DirectPairCountingWrangler(ConstantOneExpansionWrangler):
+    def __init__(self, tree):
+        ConstantOneExpansionWrangler.__init__(self, tree)
+        self.ndirect_pairs = 0
+
+    def eval_direct(self, target_boxes, neighbor_sources_starts,
+            neighbor_sources_lists, src_weights):
+        pot = ConstantOneExpansionWrangler.eval_direct(self, target_boxes,
+                neighbor_sources_starts, neighbor_sources_lists, src_weights)
+        self.ndirect_pairs += int(np.sum(pot))
+        return pot
+
 
 @pytest.mark.parametrize("enable_extents", [True, False])
-def test_fmm_float32(ctx_getter, enable_extents):
+def test_cost_model(ctx_getter, enable_extents):
     ctx = ctx_getter()
     queue = cl.CommandQueue(ctx)
 
-    from pyopencl.characterize import has_struct_arg_count_bug
-    if has_struct_arg_count_bug(queue.device):
-        pytest.xfail("won't work on devices with the struct arg count issue")
-
     logging.basicConfig(level=logging.INFO)
 
     dims = 2
-    nsources = 1000
-    ntargets = 1000
-    dtype = np.float32
+    dtype = np.float64
+
+    from pyopencl.clrandom import PhiloxGenerator
+    rng = PhiloxGenerator(queue.context, seed=12)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tbuild = FMMTraversalBuilder(ctx)
+
+    from boxtree.cost import (
+            count_fmm_work, FMMCostModel, calibrate_cost_model,
+            time_fmm_stages, FMM_STAGES)
+
+    works = []
+    for nparticles in [1000, 3000]:
+        sources = p_normal(queue, nparticles, dims, dtype, seed=15)
+        targets = p_normal(queue, nparticles, dims, dtype, seed=18)
+
+        if enable_extents:
+            target_radii = 2**rng.uniform(queue, nparticles, dtype=dtype,
+                    a=-10, b=0)
+        else:
+            target_radii = None
+
+        tree, _ = tb(queue, sources, targets=targets,
+                max_particles_in_box=30,
+                target_radii=target_radii,
+                debug=True, stick_out_factor=0.25)
+
+        trav, _ = tbuild(queue, tree, debug=True)
+        host_trav = trav.get(queue=queue)
+        host_tree = host_trav.tree
+
+        work = count_fmm_work(host_trav)
+        works.append(work)
+
+        # {{{ check counts against what a wrangler actually does
+
+        wrangler = DirectPairCountingWrangler(host_tree)
+        weights = np.ones(nparticles)
+        pot, timings = time_fmm_stages(host_trav, wrangler, weights)
+
+        assert (pot == nparticles).all()
+        assert set(timings) == set(FMM_STAGES)
+
+        totals = work.get_total_counts()
+        assert totals["eval_direct"] == wrangler.ndirect_pairs
+        assert totals["form_multipoles"] == host_tree.nsources
+        assert totals["eval_locals"] == host_tree.ntargets
+        assert (work.get_level_counts("eval_direct").sum()
+                == totals["eval_direct"])
+
+        # }}}
+
+    # {{{ calibration recovers known constants
+
+    def level_to_order(tree, level):
+        return 5 + level
+
+    model = FMMCostModel(level_to_order=level_to_order)
+
+    true_params = dict(
+            (stage, 10**-(istage+3))
+            for istage, stage in enumerate(FMM_STAGES))
+    true_model = model.with_calibration_params(true_params)
+
+    timings = [
+            dict(
+                (stage, np.sum(box_costs))
+                for stage, box_costs in true_model.get_stage_costs(work).items())
+            for work in works]
+
+    calibrated_model = calibrate_cost_model(model, works, timings)
+
+    for stage in FMM_STAGES:
+        if any(np.sum(work.box_counts[stage]) for work in works):
+            assert np.isclose(
+                    calibrated_model.calibration_params[stage],
+                    true_params[stage])
+
+    for work in works:
+        assert np.isclose(
+                calibrated_model.predict_time(work),
+                true_model.predict_time(work))
+
+        level_costs = calibrated_model.get_level_costs(work)
+        assert np.isclose(
+                sum(np.sum(lc) for lc in level_costs.values()),
+                calibrated_model.predict_time(work))
+
+        assert np.isclose(
+                np.sum(calibrated_model.get_box_costs(work)),
+                calibrated_model.predict_time(work))
+
+    # }}}
+
+# }}}
+
+
+# {{{ test local essential trees
+
+def _run_local_fmm(args):
+    """Stands in for one node of a distributed FMM."""
+    let, weights = args
 
     from boxtree.fmm import drive_fmm
+    local_weights = weights[let.source_to_global_user_source]
+
+    const_pot = drive_fmm(
+            let.traversal, ConstantOneExpansionWrangler(let.tree),
+            np.ones(let.tree.nsources))
+
+    from boxtree.pyfmmlib_integration import FMMLibExpansionWrangler
+    wrangler = FMMLibExpansionWrangler(let.tree, 0, nterms=10)
+    pot = drive_fmm(let.traversal, wrangler, local_weights)
+
+    return let.target_to_global_user_target, const_pot, pot
+
+
+@pytest.mark.parametrize(("dims", "sources_are_targets"), [
+    (2, True),
+    (3, False),
+    ])
+def test_local_essential_tree(ctx_getter, dims, sources_are_targets):
+    logging.basicConfig(level=logging.INFO)
+
+    from pytest import importorskip
+    importorskip("pyfmmlib")
+
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    nsources = 3000
+    ntargets = 2000
+    dtype = np.float64
+    nparts = 3
+
     sources = p_normal(queue, nsources, dims, dtype, seed=15)
-    targets = p_normal(queue, ntargets, dims, dtype, seed=15)
+    if sources_are_targets:
+        targets = None
+        ntargets = nsources
+    else:
+        targets = p_normal(queue, ntargets, dims, dtype, seed=18)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+    tree, _ = tb(queue, sources, targets=targets,
+            max_particles_in_box=30, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tbuild = FMMTraversalBuilder(ctx)
+    trav, _ = tbuild(queue, tree, debug=True)
+    trav = trav.get(queue=queue)
 
     from pyopencl.clrandom import PhiloxGenerator
-    rng = PhiloxGenerator(queue.context, seed=12)
+    rng = PhiloxGenerator(queue.context, seed=20)
+    weights = rng.uniform(queue, nsources, dtype=np.float64).get()
 
-    if enable_extents:
-        target_radii = 2**rng.uniform(queue, ntargets, dtype=dtype, a=-10, b=0)
-    else:
-        target_radii = None
+    from boxtree.fmm import drive_fmm
+    from boxtree.pyfmmlib_integration import FMMLibExpansionWrangler
+    ref_pot = drive_fmm(
+            trav, FMMLibExpansionWrangler(trav.tree, 0, nterms=10), weights)
+
+    from boxtree.distributed import (
+            partition_target_boxes, get_local_essential_tree)
+    partitioning = partition_target_boxes(trav, nparts)
+
+    lets = [
+            get_local_essential_tree(trav, part.target_boxes)
+            for part in partitioning.parts]
+
+    for let in lets:
+        assert let.tree.nboxes <= trav.tree.nboxes
+        assert (np.diff(let.box_to_global_box) > 0).all()
+
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    try:
+        # The workers only use the host.
+        mp_context = multiprocessing.get_context("fork")
+    except ValueError:
+        pytest.skip("need 'fork' to start worker processes")
+
+    try:
+        executor = ProcessPoolExecutor(nparts, mp_context=mp_context)
+    except TypeError:
+        pytest.skip("ProcessPoolExecutor does not support mp_context")
+
+    with executor:
+        results = list(executor.map(
+            _run_local_fmm, [(let, weights) for let in lets]))
+
+    const_pot = np.empty(ntargets)
+    const_pot.fill(np.nan)
+    pot = np.empty(ntargets, dtype=ref_pot.dtype)
+    pot.fill(np.nan)
+
+    for global_target_ids, part_const_pot, part_pot in results:
+        assert np.isnan(const_pot[global_target_ids]).all()
+        const_pot[global_target_ids] = part_const_pot
+        pot[global_target_ids] = part_pot
+
+    assert (const_pot == nsources).all()
+
+    if sources_are_targets:
+        # FMMLib's direct evaluation does not skip self-interactions, so
+        # both potentials are non-finite here.
+        return
+
+    rel_err = la.norm(pot - ref_pot, np.inf) / la.norm(ref_pot, np.inf)
+    logger.info("relative l_inf difference to global FMM: %g", rel_err)
+    assert rel_err < 1e-12
+
+# }}}
+
+
+# {{{ test dual-tree traversal
+
+@pytest.mark.parametrize("dims", [2, 3])
+def test_dual_tree_traversal(ctx_getter, dims):
+    logging.basicConfig(level=logging.INFO)
+
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    nsources = 300
+    ntargets = 3000
+    dtype = np.float64
+
+    # few, clustered sources and many spread-out targets
+    sources = p_normal(queue, nsources, dims, dtype, seed=15)
+    for axis in sources:
+        axis *= 0.2
+    targets = p_normal(queue, ntargets, dims, dtype, seed=18)
+
+    sources_host = particle_array_to_host(sources)
+    targets_host = particle_array_to_host(targets)
+
+    all_coords = np.hstack([sources_host.T, targets_host.T])
+    bbox = (np.min(all_coords, axis=1), np.max(all_coords, axis=1))
 
     from boxtree import TreeBuilder
     tb = TreeBuilder(ctx)
+    source_tree, _ = tb(queue, sources, bbox=bbox,
+            max_particles_in_box=30, debug=True)
+    target_tree, _ = tb(queue, targets, bbox=bbox,
+            max_particles_in_box=30, debug=True)
+
+    source_tree = source_tree.get(queue=queue)
+    target_tree = target_tree.get(queue=queue)
+
+    assert source_tree.root_extent == target_tree.root_extent
+
+    from boxtree.dual_tree import build_dual_tree_traversal
+    dual_trav = build_dual_tree_traversal(source_tree, target_tree)
+
+    tree = dual_trav.tree
+    trav = dual_trav.traversal
+
+    assert tree.nboxes == source_tree.nboxes + target_tree.nboxes
+    assert (trav.tree.box_source_counts_cumul[trav.target_boxes] == 0).all()
+    assert (trav.tree.box_target_counts_cumul[trav.source_boxes] == 0).all()
+
+    from boxtree.fmm import drive_fmm
+    weights = np.random.RandomState(12).randn(nsources)
+
+    pot = drive_fmm(trav, ConstantOneExpansionWrangler(tree), weights)
+    assert np.allclose(pot, np.sum(weights))
+
+    from pytest import importorskip
+    importorskip("pyfmmlib")
+
+    from boxtree.pyfmmlib_integration import FMMLibExpansionWrangler
+
+    def fmm_level_to_nterms(tree, level):
+        return 15
+
+    pot = drive_fmm(
+            trav,
+            FMMLibExpansionWrangler(tree, 0,
+                fmm_level_to_nterms=fmm_level_to_nterms),
+            weights)
+
+    # compare with a single tree built for the union
+    union_tree, _ = tb(queue, sources, targets=targets,
+            max_particles_in_box=30, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tbuild = FMMTraversalBuilder(ctx)
+    union_trav, _ = tbuild(queue, union_tree, debug=True)
+    union_trav = union_trav.get(queue=queue)
+
+    ref_pot = drive_fmm(
+            union_trav,
+            FMMLibExpansionWrangler(union_trav.tree, 0,
+                fmm_level_to_nterms=fmm_level_to_nterms),
+            weights)
+
+    rel_err = la.norm(pot - ref_pot, np.inf) / la.norm(ref_pot, np.inf)
+    logger.info("relative l_inf difference to single-tree FMM: %g", rel_err)
+    assert rel_err < 1e-6
+
+# }}}
+
+
+# {{{ test target-subset traversal
+
+@pytest.mark.parametrize(("dims", "sources_are_targets", "with_extent"), [
+    (2, True, False),
+    (3, False, False),
+    (3, False, True),
+    ])
+def test_target_mask_traversal(ctx_getter, dims, sources_are_targets,
+        with_extent):
+    logging.basicConfig(level=logging.INFO)
+
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    nsources = 10**4
+    ntargets = 2 * 10**4
+    dtype = np.float64
+
+    sources = p_normal(queue, nsources, dims, dtype, seed=15)
+    if sources_are_targets:
+        targets = None
+        ntargets = nsources
+    else:
+        targets = p_normal(queue, ntargets, dims, dtype, seed=16)
 
+    tb_kwargs = {}
+    if with_extent:
+        from pyopencl.clrandom import PhiloxGenerator
+        rng = PhiloxGenerator(queue.context, seed=13)
+        tb_kwargs["target_radii"] = 2**rng.uniform(queue, ntargets, dtype=dtype,
+                a=-10, b=-3)
+        tb_kwargs["stick_out_factor"] = 0.25
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
     tree, _ = tb(queue, sources, targets=targets,
-            max_particles_in_box=30,
-            target_radii=target_radii,
-            debug=True, stick_out_factor=0.25)
+            max_particles_in_box=30, debug=True, **tb_kwargs)
+
+    # activate the targets in a small region
+    host_tree = tree.get(queue=queue)
+    user_targets_host = np.empty((ntargets, dims))
+    user_targets_host[host_tree.sorted_target_ids] = np.array(
+            list(host_tree.targets)).T
+    target_mask = (
+            la.norm(user_targets_host - 0.5, axis=1) < 0.3).astype(np.int8)
+    assert 0 < np.sum(target_mask) < ntargets // 5
 
     from boxtree.traversal import FMMTraversalBuilder
     tbuild = FMMTraversalBuilder(ctx)
     trav, _ = tbuild(queue, tree, debug=True)
+    masked_trav, _ = tbuild(queue, tree, debug=True,
+            target_mask=cl.array.to_device(queue, target_mask))
 
-    weights = np.ones(nsources)
-    weights_sum = np.sum(weights)
+    if with_extent:
+        trav = trav.merge_close_lists(queue)
+        masked_trav = masked_trav.merge_close_lists(queue)
 
-    host_trav = trav.get(queue=queue)
-    host_tree = host_trav.tree
+    trav = trav.get(queue=queue)
+    masked_trav = masked_trav.get(queue=queue)
 
-    wrangler = ConstantOneExpansionWrangler(host_tree)
+    assert len(masked_trav.target_boxes) < len(trav.target_boxes) // 2
+    assert (len(masked_trav.target_or_target_parent_boxes)
+            < len(trav.target_or_target_parent_boxes))
+    assert set(masked_trav.target_boxes) <= set(trav.target_boxes)
+    assert np.array_equal(masked_trav.source_boxes, trav.source_boxes)
 
-    pot = drive_fmm(host_trav, wrangler, weights)
+    from boxtree.fmm import drive_fmm
+    weights = np.random.RandomState(12).rand(nsources)
+    active = target_mask.astype(bool)
 
-    assert (pot == weights_sum).all()
+    pot = drive_fmm(masked_trav, ConstantOneExpansionWrangler(host_tree), weights)
+    assert np.allclose(pot[active], np.sum(weights))
+
+    from pytest import importorskip
+    importorskip("pyfmmlib")
+
+    from boxtree.pyfmmlib_integration import FMMLibExpansionWrangler
+
+    def fmm_level_to_nterms(tree, level):
+        return 10
+
+    wrangler = FMMLibExpansionWrangler(
+            host_tree, 0, fmm_level_to_nterms=fmm_level_to_nterms)
+    ref_pot = drive_fmm(trav, wrangler, weights)
+    pot = drive_fmm(masked_trav, wrangler, weights)
+
+    if not sources_are_targets:
+        # FMMLib's direct evaluation does not skip self-interactions.
+        assert np.allclose(pot[active], ref_pot[active], rtol=1e-13)
+
+# }}}
+
+
+# {{{ test level-dependent well_sep_is_n_away
+
+def _two_away_on_coarse_levels(level):
+    return 2 if level < 3 else 1
+
+
+def _two_away_on_fine_levels(level):
+    return 1 if level < 3 else 2
+
+
+@pytest.mark.parametrize(("dims", "sources_are_targets", "with_extent", "kind",
+        "level_to_well_sep_is_n_away"), [
+    (2, True, False, "adaptive", _two_away_on_coarse_levels),
+    (2, False, True, "adaptive", _two_away_on_fine_levels),
+    (3, False, False, "adaptive", _two_away_on_coarse_levels),
+    (3, True, False, "adaptive", _two_away_on_fine_levels),
+    (2, True, False, "non-adaptive", _two_away_on_coarse_levels),
+    (3, False, False, "non-adaptive", _two_away_on_fine_levels),
+    ])
+def test_level_dependent_well_sep_is_n_away(ctx_getter, dims,
+        sources_are_targets, with_extent, kind, level_to_well_sep_is_n_away):
+    logging.basicConfig(level=logging.INFO)
+
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    nsources = 2 * 10**4
+    ntargets = 10**4
+    dtype = np.float64
+
+    from pyopencl.clrandom import PhiloxGenerator
+    rng = PhiloxGenerator(queue.context, seed=13)
+
+    if kind == "non-adaptive":
+        def gen(nparticles):
+            return [rng.uniform(queue, nparticles, dtype) for i in range(dims)]
+    else:
+        def gen(nparticles):
+            return p_normal(queue, nparticles, dims, dtype, seed=15)
+
+    sources = gen(nsources)
+    if sources_are_targets:
+        targets = None
+        ntargets = nsources
+    else:
+        targets = gen(ntargets)
+
+    tb_kwargs = {}
+    if with_extent:
+        tb_kwargs["target_radii"] = 2**rng.uniform(queue, ntargets, dtype=dtype,
+                a=-10, b=-3)
+        tb_kwargs["stick_out_factor"] = 0.25
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+    tree, _ = tb(queue, sources, targets=targets,
+            max_particles_in_box=30, kind=kind, debug=True, **tb_kwargs)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tbuild = FMMTraversalBuilder(ctx,
+            well_sep_is_n_away=level_to_well_sep_is_n_away)
+    trav, _ = tbuild(queue, tree, debug=True)
+
+    if with_extent:
+        trav = trav.merge_close_lists(queue)
+
+    trav = trav.get(queue=queue)
+
+    assert trav.well_sep_is_n_away is None
+    assert (trav.level_well_sep_is_n_away == [
+        level_to_well_sep_is_n_away(ilevel)
+        for ilevel in range(tree.nlevels)]).all()
+
+    from boxtree.fmm import drive_fmm
+    weights = np.random.RandomState(12).rand(nsources)
+
+    pot = drive_fmm(trav, ConstantOneExpansionWrangler(trav.tree), weights)
+    assert np.allclose(pot, np.sum(weights))
 
 # }}}
 
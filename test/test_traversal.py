@@ -290,6 +290,647 @@ def test_tree_connectivity(ctx_getter, dims, sources_are_targets):
 # }}}
 
 
+# {{{ compressed traversal round trip
+
+def _assert_traversals_equal(trav_a, trav_b):
+    from pyopencl.algorithm import BuiltList
+
+    for name in trav_a.__class__.fields:
+        if name == "tree":
+            continue
+
+        val_a = getattr(trav_a, name)
+        val_b = getattr(trav_b, name)
+
+        if isinstance(val_a, list):
+            assert len(val_a) == len(val_b), name
+            for item_a, item_b in zip(val_a, val_b):
+                if isinstance(item_a, BuiltList):
+                    assert item_a.count == item_b.count, name
+                    assert (item_a.num_nonempty_lists
+                            == item_b.num_nonempty_lists), name
+                    for attr in ["starts", "lists", "nonempty_indices"]:
+                        ary_a = getattr(item_a, attr)
+                        ary_b = getattr(item_b, attr)
+                        assert ary_a.dtype == ary_b.dtype, (name, attr)
+                        assert (ary_a == ary_b).all(), (name, attr)
+                else:
+                    assert item_a.dtype == item_b.dtype, name
+                    assert (item_a == item_b).all(), name
+
+        elif isinstance(val_a, np.ndarray):
+            if name.endswith(("_bounding_box_min", "_bounding_box_max")):
+                # padding past nboxes is uninitialized
+                val_a = val_a[:, :trav_a.tree.nboxes]
+                val_b = val_b[:, :trav_b.tree.nboxes]
+
+            assert val_a.dtype == val_b.dtype, name
+            assert (val_a == val_b).all(), name
+
+        else:
+            assert val_a == val_b, name
+
+
+@pytest.mark.opencl
+@pytest.mark.parametrize(
+        ("dims", "sources_are_targets", "with_extent", "well_sep_is_n_away"), [
+            (2, True, False, 1),
+            (3, False, False, 1),
+            (3, False, True, 2),
+            ])
+def test_compressed_traversal(ctx_getter, dims, sources_are_targets,
+        with_extent, well_sep_is_n_away):
+    logging.basicConfig(level=logging.INFO)
+
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+    nsources = 3 * 10**4
+    ntargets = 4 * 10**4
+
+    sources = make_normal_particle_array(queue, nsources, dims, dtype, seed=12)
+    if sources_are_targets:
+        targets = None
+    else:
+        targets = make_normal_particle_array(queue, ntargets, dims, dtype,
+                seed=19)
+
+    tb_kwargs = {}
+    if with_extent:
+        from pyopencl.clrandom import PhiloxGenerator
+        rng = PhiloxGenerator(queue.context, seed=13)
+        tb_kwargs["target_radii"] = 2**rng.uniform(queue, ntargets, dtype=dtype,
+                a=-10, b=-3)
+        tb_kwargs["stick_out_factor"] = 0.25
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+    tree, _ = tb(queue, sources, max_particles_in_box=30, targets=targets,
+            debug=True, **tb_kwargs)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tg = FMMTraversalBuilder(ctx, well_sep_is_n_away=well_sep_is_n_away)
+    trav, _ = tg(queue, tree, debug=True)
+
+    from boxtree.compressed_traversal import TraversalCompressor
+    compressor = TraversalCompressor(ctx)
+
+    ctrav = compressor.compress(queue, trav)
+    host_trav = trav.get(queue=queue)
+
+    assert (ctrav.target_boxes is None) == sources_are_targets
+
+    # with_queue reaches the arrays in the nested compressed lists
+    ctrav_with_queue = ctrav.with_queue(queue)
+    assert ctrav_with_queue.neighbor_source_boxes.lists.queue is queue
+    assert all(
+            cbl.starts.queue is queue
+            for cbl in ctrav_with_queue.from_sep_smaller_by_level)
+    assert ctrav_with_queue.with_queue(None).neighbor_source_boxes.lists.queue \
+            is None
+    host_ctrav = ctrav.get(queue=queue)
+
+    # {{{ compression saves space
+
+    def nbytes(val):
+        if isinstance(val, np.ndarray):
+            return val.nbytes
+        elif isinstance(val, list):
+            return sum(nbytes(v) for v in val)
+        elif hasattr(val, "lists"):
+            return sum(nbytes(v) for v in val.__dict__.values())
+        else:
+            return 0
+
+    trav_nbytes = sum(
+            nbytes(getattr(host_trav, name))
+            for name in host_trav.__class__.fields
+            if name not in ["tree", "colleagues_starts", "colleagues_lists"])
+    ctrav_nbytes = sum(
+            nbytes(getattr(host_ctrav, name))
+            for name in host_ctrav.__class__.fields
+            if name != "tree")
+
+    logger.info("traversal: %d bytes, compressed: %d bytes",
+            trav_nbytes, ctrav_nbytes)
+    assert ctrav_nbytes < trav_nbytes
+
+    # }}}
+
+    # {{{ device and host decompression reproduce the traversal
+
+    _assert_traversals_equal(
+            host_trav,
+            compressor.decompress(queue, ctrav).get(queue=queue))
+    _assert_traversals_equal(
+            host_trav,
+            compressor.decompress(None, host_ctrav))
+
+    # host-side compression agrees
+    _assert_traversals_equal(
+            host_trav,
+            compressor.decompress(None, compressor.compress(None, host_trav)))
+
+    # }}}
+
+# }}}
+
+
+# {{{ concurrent list construction
+
+@pytest.mark.opencl
+@pytest.mark.parametrize(("dims", "sources_are_targets", "with_extent"), [
+    (2, True, False),
+    (3, False, True),
+    ])
+def test_concurrent_list_construction(ctx_getter, dims, sources_are_targets,
+        with_extent):
+    logging.basicConfig(level=logging.INFO)
+
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+    nsources = 10**4
+    ntargets = 2 * 10**4
+
+    sources = make_normal_particle_array(queue, nsources, dims, dtype, seed=12)
+    if sources_are_targets:
+        targets = None
+    else:
+        targets = make_normal_particle_array(queue, ntargets, dims, dtype,
+                seed=19)
+
+    tb_kwargs = {}
+    if with_extent:
+        from pyopencl.clrandom import PhiloxGenerator
+        rng = PhiloxGenerator(queue.context, seed=13)
+        tb_kwargs["target_radii"] = 2**rng.uniform(queue, ntargets, dtype=dtype,
+                a=-10, b=-3)
+        tb_kwargs["stick_out_factor"] = 0.25
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+    tree, _ = tb(queue, sources, max_particles_in_box=30, targets=targets,
+            debug=True, **tb_kwargs)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tg = FMMTraversalBuilder(ctx)
+    trav, _ = tg(queue, tree)
+    concurrent_trav, evt = tg(queue, tree, concurrent_lists=True)
+    evt.wait()
+
+    _assert_traversals_equal(
+            trav.get(queue=queue),
+            concurrent_trav.get(queue=queue))
+
+# }}}
+
+
+# {{{ merged close lists
+
+@pytest.mark.opencl
+@pytest.mark.parametrize(("dims", "min_nsources_cumul"), [
+    (2, None),
+    (3, 10),
+    ])
+def test_merge_close_lists_in_builder(ctx_getter, dims, min_nsources_cumul):
+    logging.basicConfig(level=logging.INFO)
+
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+    nsources = 10**4
+    ntargets = 2 * 10**4
+
+    sources = make_normal_particle_array(queue, nsources, dims, dtype, seed=12)
+    targets = make_normal_particle_array(queue, ntargets, dims, dtype, seed=19)
+
+    from pyopencl.clrandom import PhiloxGenerator
+    rng = PhiloxGenerator(queue.context, seed=13)
+    target_radii = 2**rng.uniform(queue, ntargets, dtype=dtype, a=-10, b=-3)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+    tree, _ = tb(queue, sources, max_particles_in_box=30, targets=targets,
+            target_radii=target_radii, stick_out_factor=0.25, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tg = FMMTraversalBuilder(ctx)
+    trav, _ = tg(queue, tree,
+            _from_sep_smaller_min_nsources_cumul=min_nsources_cumul)
+    merged_trav, _ = tg(queue, tree, merge_close_lists=True,
+            _from_sep_smaller_min_nsources_cumul=min_nsources_cumul)
+
+    assert merged_trav.from_sep_close_smaller_starts is None
+    assert merged_trav.from_sep_close_bigger_starts is None
+
+    _assert_traversals_equal(
+            trav.merge_close_lists(queue).get(queue=queue),
+            merged_trav.get(queue=queue))
+
+# }}}
+
+
+# {{{ uniform grid lists
+
+@pytest.mark.opencl
+@pytest.mark.parametrize(("dims", "sources_are_targets", "well_sep_is_n_away"), [
+    (2, True, 1),
+    (3, False, 2),
+    ])
+def test_uniform_grid_lists(ctx_getter, dims, sources_are_targets,
+        well_sep_is_n_away):
+    logging.basicConfig(level=logging.INFO)
+
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+    nsources = 2 * 10**4
+    ntargets = 5000
+
+    from pyopencl.clrandom import PhiloxGenerator
+    rng = PhiloxGenerator(ctx, seed=15)
+    sources = [rng.uniform(queue, nsources, dtype) for i in range(dims)]
+    if sources_are_targets:
+        targets = None
+    else:
+        targets = [rng.uniform(queue, ntargets, dtype) for i in range(dims)]
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+    tree, _ = tb(queue, sources, max_particles_in_box=30, targets=targets,
+            kind="non-adaptive", debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tg = FMMTraversalBuilder(ctx, well_sep_is_n_away=well_sep_is_n_away)
+    trav, _ = tg(queue, tree)
+    trav = trav.get(queue=queue)
+    ref_trav, _ = tg(queue, tree, _allow_uniform_grid=False)
+    ref_trav = ref_trav.get(queue=queue)
+
+    # The grid lookups visit boxes in a different order than the tree walk.
+    for list_name in [
+            "same_level_non_well_sep_boxes",
+            "neighbor_source_boxes",
+            "from_sep_siblings",
+            ]:
+        starts = getattr(trav, list_name + "_starts")
+        lists = getattr(trav, list_name + "_lists")
+        ref_starts = getattr(ref_trav, list_name + "_starts")
+        ref_lists = getattr(ref_trav, list_name + "_lists")
+
+        assert (starts == ref_starts).all(), list_name
+        for i in range(len(starts) - 1):
+            assert (
+                    sorted(lists[starts[i]:starts[i+1]])
+                    == sorted(ref_lists[starts[i]:starts[i+1]])), list_name
+
+# }}}
+
+
+# {{{ traversal statistics
+
+@pytest.mark.opencl
+@pytest.mark.parametrize(("dims", "sources_are_targets", "with_extent"), [
+    (2, True, False),
+    (3, False, True),
+    ])
+def test_traversal_statistics(ctx_getter, dims, sources_are_targets,
+        with_extent):
+    logging.basicConfig(level=logging.INFO)
+
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+    nsources = 10**4
+    ntargets = 2 * 10**4
+
+    sources = make_normal_particle_array(queue, nsources, dims, dtype, seed=12)
+    if sources_are_targets:
+        targets = None
+    else:
+        targets = make_normal_particle_array(queue, ntargets, dims, dtype,
+                seed=19)
+
+    tb_kwargs = {}
+    if with_extent:
+        from pyopencl.clrandom import PhiloxGenerator
+        rng = PhiloxGenerator(queue.context, seed=13)
+        tb_kwargs["target_radii"] = 2**rng.uniform(queue, ntargets, dtype=dtype,
+                a=-10, b=-3)
+        tb_kwargs["stick_out_factor"] = 0.25
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+    tree, _ = tb(queue, sources, max_particles_in_box=30, targets=targets,
+            debug=True, **tb_kwargs)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tg = FMMTraversalBuilder(ctx)
+    trav, _ = tg(queue, tree)
+
+    from boxtree.traversal_statistics import TraversalStatisticsBuilder
+    stats = TraversalStatisticsBuilder(ctx)(queue, trav)
+
+    trav = trav.get(queue=queue)
+    tree = trav.tree
+
+    by_key = dict(
+            ((list_stats.list_name, list_stats.level), list_stats)
+            for list_stats in stats.lists)
+
+    # {{{ compare list 1 against a host-side count
+
+    lengths = np.diff(trav.neighbor_source_boxes_starts)
+    nparticle_interactions = np.array([
+        tree.box_target_counts_nonchild[tgt_box]
+        * np.sum(tree.box_source_counts_nonchild[
+            trav.neighbor_source_boxes_lists[
+                trav.neighbor_source_boxes_starts[itgt_box]:
+                trav.neighbor_source_boxes_starts[itgt_box+1]]])
+        for itgt_box, tgt_box in enumerate(trav.target_boxes)])
+
+    for level in range(tree.nlevels):
+        start, stop = trav.level_start_target_box_nrs[level:level+2]
+        if start == stop:
+            assert ("neighbor_source_boxes", level) not in by_key
+            continue
+
+        list_stats = by_key["neighbor_source_boxes", level]
+        assert list_stats.nboxes == stop - start
+        assert list_stats.nentries == np.sum(lengths[start:stop])
+        assert list_stats.nempty == np.sum(lengths[start:stop] == 0)
+        assert list_stats.min_length == np.min(lengths[start:stop])
+        assert list_stats.max_length == np.max(lengths[start:stop])
+        assert (list_stats.nparticle_interactions
+                == np.sum(nparticle_interactions[start:stop]))
+
+    list_stats = by_key["neighbor_source_boxes", None]
+    assert list_stats.nentries == len(trav.neighbor_source_boxes_lists)
+    assert list_stats.nparticle_interactions == np.sum(nparticle_interactions)
+
+    # }}}
+
+    list_stats = by_key["from_sep_smaller", None]
+    assert list_stats.nentries == sum(
+            len(lev_list.lists) for lev_list in trav.from_sep_smaller_by_level)
+
+    assert (("from_sep_close_smaller", None) in by_key) == with_extent
+
+    # Each list is summarized for all levels.
+    assert sum(list_stats.level is None for list_stats in stats.lists) == (
+            7 if with_extent else 5)
+
+    import json
+    assert len(json.loads(stats.to_json())) == len(stats.lists)
+    assert len(stats.to_table().split("\n")) == len(stats.lists) + 2
+
+# }}}
+
+
+# {{{ saving and loading traversals
+
+@pytest.mark.opencl
+@pytest.mark.parametrize(("dims", "with_extent", "load_to_device"), [
+            (2, False, False),
+            (3, True, False),
+            (3, False, True),
+            ])
+def test_save_and_load_traversal(ctx_getter, tmpdir, dims, with_extent,
+        load_to_device):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    nsources = 4000
+    ntargets = 3000
+    dtype = np.float64
+
+    sources = make_normal_particle_array(queue, nsources, dims, dtype, seed=12)
+    targets = make_normal_particle_array(queue, ntargets, dims, dtype, seed=19)
+
+    if with_extent:
+        from pyopencl.clrandom import PhiloxGenerator
+        rng = PhiloxGenerator(queue.context, seed=13)
+        target_radii = rng.uniform(queue, ntargets, a=0, b=0.05, dtype=dtype)
+    else:
+        target_radii = None
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+    tree, _ = tb(queue, sources, targets=targets, target_radii=target_radii,
+            stick_out_factor=0.25, max_particles_in_box=30, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tg = FMMTraversalBuilder(ctx)
+    trav, _ = tg(queue, tree, debug=True)
+
+    from boxtree.serialization import save_record, load_record
+    filename = str(tmpdir.join("trav.boxtree"))
+    save_record(filename, trav, queue=queue)
+
+    if load_to_device:
+        loaded_trav = load_record(filename, queue=queue)
+        assert isinstance(loaded_trav.neighbor_source_boxes_lists, cl.array.Array)
+        loaded_trav = loaded_trav.get(queue=queue)
+    else:
+        loaded_trav = load_record(filename)
+        assert isinstance(loaded_trav.neighbor_source_boxes_lists, np.memmap)
+
+    trav = trav.get(queue=queue)
+
+    assert type(loaded_trav) is type(trav)
+    _assert_traversals_equal(trav, loaded_trav)
+
+    tree = trav.tree
+    loaded_tree = loaded_trav.tree
+    assert type(loaded_tree) is type(tree)
+    assert loaded_tree.nlevels == tree.nlevels
+    assert loaded_tree.coord_dtype == tree.coord_dtype
+    assert loaded_tree.extent_norm == tree.extent_norm
+    assert loaded_tree._is_pruned
+    for iaxis in range(dims):
+        assert (loaded_tree.sources[iaxis] == tree.sources[iaxis]).all()
+    assert (loaded_tree.box_flags == tree.box_flags).all()
+    assert (loaded_tree.user_source_ids == tree.user_source_ids).all()
+
+    if with_extent:
+        assert (loaded_tree.target_radii == tree.target_radii).all()
+
+# }}}
+
+
+# {{{ background build pipeline
+
+@pytest.mark.opencl
+def test_tree_and_traversal_pipeline(ctx_getter):
+    logging.basicConfig(level=logging.INFO)
+
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dims = 2
+    dtype = np.float64
+    nparticles = 10**4
+
+    particle_sets = [
+            make_normal_particle_array(queue, nparticles, dims, dtype, seed=seed)
+            for seed in [12, 13, 14]]
+
+    from boxtree import TreeBuilder
+    from boxtree.traversal import FMMTraversalBuilder
+    tb = TreeBuilder(ctx)
+    tg = FMMTraversalBuilder(ctx)
+
+    def build_directly(particles):
+        tree, _ = tb(queue, particles, max_particles_in_box=30)
+        trav, _ = tg(queue, tree)
+        return trav.get(queue=queue)
+
+    ref_travs = [build_directly(particles) for particles in particle_sets]
+
+    from boxtree.pipeline import TreeAndTraversalPipeline
+    with TreeAndTraversalPipeline(ctx) as pipeline:
+        futures = [
+                pipeline.submit(particles, max_particles_in_box=30)
+                for particles in particle_sets]
+
+        for ref_trav, future in zip(ref_travs, futures):
+            tree, trav = future.result()
+            assert trav.tree is tree
+            _assert_traversals_equal(ref_trav, trav.get(queue=queue))
+
+        import asyncio
+
+        async def build_async():
+            return await pipeline.submit_async(
+                    particle_sets[0], max_particles_in_box=30)
+
+        _, trav = asyncio.get_event_loop().run_until_complete(build_async())
+        _assert_traversals_equal(ref_travs[0], trav.get(queue=queue))
+
+# }}}
+
+
+# {{{ target box partitioning
+
+@pytest.mark.opencl
+@pytest.mark.parametrize(("dims", "sources_are_targets", "nparts"), [
+    (2, True, 4),
+    (2, False, 7),
+    (3, False, 4),
+    ])
+def test_partition_target_boxes(ctx_getter, dims, sources_are_targets, nparts):
+    logging.basicConfig(level=logging.INFO)
+
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+
+    sources = make_normal_particle_array(queue, 5 * 10**4, dims, dtype, seed=15)
+    if sources_are_targets:
+        targets = None
+    else:
+        targets = make_normal_particle_array(queue, 4 * 10**4, dims, dtype,
+                seed=18)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+    tree, _ = tb(queue, sources, max_particles_in_box=30, targets=targets,
+            debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tg = FMMTraversalBuilder(ctx)
+    trav, _ = tg(queue, tree, debug=True)
+    trav = trav.get(queue=queue)
+    tree = trav.tree
+
+    # {{{ morton order is a pre-order traversal
+
+    from boxtree.distributed import get_box_morton_order
+    morton_order = get_box_morton_order(tree)
+
+    assert (np.sort(morton_order) == np.arange(tree.nboxes)).all()
+    assert morton_order[0] == 0
+    for ibox in range(1, tree.nboxes):
+        assert morton_order[tree.box_parent_ids[ibox]] < morton_order[ibox]
+
+    # }}}
+
+    from boxtree.cost import count_fmm_work, FMMCostModel
+    box_costs = FMMCostModel().get_box_costs(count_fmm_work(trav))
+
+    from boxtree.distributed import partition_target_boxes
+    partitioning = partition_target_boxes(trav, nparts, box_costs)
+
+    logger.info("load imbalance: %g", partitioning.load_imbalance)
+    assert partitioning.load_imbalance < 1.2
+
+    # {{{ partitions are disjoint, complete and contiguous in morton order
+
+    all_owned = np.concatenate([
+        part.target_boxes for part in partitioning.parts])
+    assert len(all_owned) == len(trav.target_boxes)
+    assert (np.sort(all_owned) == np.sort(trav.target_boxes)).all()
+
+    assert (np.diff(morton_order[all_owned]) > 0).all()
+
+    for ipart, part in enumerate(partitioning.parts):
+        assert (partitioning.target_box_to_part[
+            np.searchsorted(trav.target_boxes, part.target_boxes)]
+            == ipart).all()
+        assert part.cost >= np.sum(box_costs[part.target_boxes])
+
+    # The partition costs account for all work, not just that of the target
+    # boxes, so the imbalance above is that of the full FMM.
+    assert np.isclose(np.sum(partitioning.part_costs), np.sum(box_costs))
+    assert np.isclose(
+            np.max(partitioning.part_costs) / np.mean(partitioning.part_costs),
+            partitioning.load_imbalance)
+
+    # }}}
+
+    # {{{ needed source boxes are complete
+
+    all_ttp_boxes = set(trav.target_or_target_parent_boxes)
+
+    for part in partitioning.parts:
+        direct = set(part.direct_source_boxes)
+        multipole = set(part.multipole_source_boxes)
+        ttp_boxes = set(part.target_or_target_parent_boxes)
+
+        for itgt_box in np.searchsorted(trav.target_boxes, part.target_boxes):
+            start, end = trav.neighbor_source_boxes_starts[itgt_box:itgt_box+2]
+            assert set(trav.neighbor_source_boxes_lists[start:end]) <= direct
+
+            ibox = trav.target_boxes[itgt_box]
+            while True:
+                if ibox in all_ttp_boxes:
+                    assert ibox in ttp_boxes
+                if ibox == 0:
+                    break
+                ibox = tree.box_parent_ids[ibox]
+
+        for ittp_box, ttp_ibox in enumerate(trav.target_or_target_parent_boxes):
+            if ttp_ibox not in ttp_boxes:
+                continue
+
+            start, end = trav.from_sep_siblings_starts[ittp_box:ittp_box+2]
+            assert set(trav.from_sep_siblings_lists[start:end]) <= multipole
+
+            start, end = trav.from_sep_bigger_starts[ittp_box:ittp_box+2]
+            assert set(trav.from_sep_bigger_lists[start:end]) <= direct
+
+    # }}}
+
+# }}}
+
+
 # {{{ visualization helper (not a test)
 
 def plot_traversal(ctx_getter, do_plot=False, well_sep_is_n_away=1):
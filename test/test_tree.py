@@ -1063,6 +1063,52 @@ def test_space_invader_query(ctx_getter, dims, dtype, do_plot=False):
 # }}}
 
 
+# {{{ saving and loading lookup structures
+
+@pytest.mark.opencl
+def test_save_and_load_area_query(ctx_getter, tmpdir):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dims = 2
+    dtype = np.float64
+
+    particles = make_normal_particle_array(queue, 10**4, dims, dtype)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+    tree, _ = tb(queue, particles, max_particles_in_box=30, debug=True)
+
+    nballs = 10**3
+    ball_centers = make_normal_particle_array(queue, nballs, dims, dtype)
+    ball_radii = cl.array.empty(queue, nballs, dtype).fill(0.1)
+
+    from boxtree.area_query import AreaQueryBuilder, PeerListFinder
+    peer_lists, _ = PeerListFinder(ctx)(queue, tree)
+    area_query, _ = AreaQueryBuilder(ctx)(
+            queue, tree, ball_centers, ball_radii, peer_lists=peer_lists)
+
+    from boxtree.serialization import save_record, load_record
+
+    for record, fields in [
+            (area_query, ["leaves_near_ball_starts", "leaves_near_ball_lists"]),
+            (peer_lists, ["peer_list_starts", "peer_lists"]),
+            ]:
+        filename = str(tmpdir.join(type(record).__name__))
+        save_record(filename, record, queue=queue)
+
+        record = record.get(queue=queue)
+        loaded_record = load_record(filename)
+
+        assert type(loaded_record) is type(record)
+        assert loaded_record.tree.nboxes == record.tree.nboxes
+        for field in fields:
+            assert (getattr(loaded_record, field)
+                    == getattr(record, field)).all()
+
+# }}}
+
+
 # {{{ test_same_tree_with_zero_weight_particles
 
 @pytest.mark.opencl